@@ -0,0 +1,122 @@
+"""
+Memory-budgeted cache for frame data.
+
+FrameCache - A least-recently-used cache whose limit is a number of bytes rather than a
+             number of entries. The raw JPEG bytes, decoded images and grayscale images
+             of frames share one budget, so a few 4K images and thousands of thumbnails
+             are treated fairly. Thread safe.
+"""
+
+import sys
+import threading
+import collections
+
+import numpy as np
+
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+ENTRY_OVERHEAD = 128        # bytes of the dictionary node and (value, size) pair that hold an entry
+
+def sizeof(value):
+    """Bytes of memory held by a cached value"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+def key_sizeof(key):
+    """Bytes of memory held by a key and its entry"""
+    size = sys.getsizeof(key) + ENTRY_OVERHEAD
+    if isinstance(key, tuple):
+        size += sum(sys.getsizeof(k) for k in key)
+    return size
+
+
+class FrameCache:
+    """LRU cache with a memory budget.
+    :param max_bytes: the budget. Values larger than the budget are returned but not cached.
+    :param charge_keys: also charge each entry for its key and bookkeeping. For caches of
+                        small values, such as scores, these are most of the memory.
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, charge_keys=False):
+        self.max_bytes = max_bytes
+        self.charge_keys = charge_keys
+        self.entries = collections.OrderedDict()   # key -> (value, size), least recently used first
+        self.bytes   = 0
+        self.hits    = 0
+        self.misses  = 0
+        self.evictions = 0
+        self.lock    = threading.Lock()
+        self.loading = {}       # key -> Event, while a thread is loading it
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key, loader):
+        """Return the value for key, calling loader() to produce it on a miss.
+        If another thread is already loading key, wait for it rather than loading it twice."""
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key][0]
+                event = self.loading.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = self.loading[key] = threading.Event()
+                    break
+            event.wait()
+        try:
+            value = loader()
+            self.put(key, value)
+            return value
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+    def peek(self, key, default=None):
+        """Return the value for key if it is cached, without counting a hit or a miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry[0] if entry is not None else default
+
+    def put(self, key, value):
+        size = sizeof(value)
+        if self.charge_keys:
+            size += key_sizeof(key)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.bytes += size
+            self.evict()
+
+    def evict(self):
+        """Remove least-recently-used entries until the cache is within budget. Call with the lock held."""
+        while self.bytes > self.max_bytes:
+            (_, (_, size)) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def set_budget(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,188 @@
+"""
+Live frames from several cameras at once.
+
+MultiCameraSource(cameras) - a reader thread for each camera reads its stream as fast as the
+    camera sends it and keeps only the latest frame, in a single slot. Iterating over the
+    source generates frames from all the cameras, taking them in turn.
+
+A consumer that is slower than the cameras therefore always gets the most recent frame of each
+camera rather than falling behind: frames it had no time for are dropped, and counted. Nothing
+queues up, so memory does not grow.
+
+A camera whose stream fails or ends is reopened, waiting reconnect_delay seconds at first and
+doubling up to max_reconnect_delay while it keeps failing.
+
+Cameras are opened with opener(url), by default an OpenCV VideoCapture. An opener returns an
+object with grab(), retrieve() and release() as VideoCapture has, or None if it cannot connect.
+Tests pass their own.
+"""
+
+import time
+import logging
+import threading
+import collections
+
+import cv2
+
+from .frame import Frame
+
+DEFAULT_RECONNECT_DELAY = 1.0       # seconds
+DEFAULT_MAX_RECONNECT_DELAY = 30.0
+
+def open_capture(url):
+    """Open a camera stream with OpenCV; return None if it cannot be opened"""
+    cap = cv2.VideoCapture(url)
+    if not cap.isOpened():
+        cap.release()
+        return None
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)   # do not let the backend queue up old frames
+    return cap
+
+class CameraStats:
+    """What happened to one camera's frames"""
+    __slots__ = ('frames','delivered','dropped','reconnects')
+    def __init__(self):
+        self.frames = 0         # read from the camera
+        self.delivered = 0      # given to the consumer
+        self.dropped = 0        # replaced by a newer frame before the consumer took it
+        self.reconnects = 0
+
+    def __repr__(self):
+        return (f"<CameraStats frames={self.frames} delivered={self.delivered} "
+                f"dropped={self.dropped} reconnects={self.reconnects}>")
+
+    def dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class MultiCameraSource:
+    """Frames from several cameras, interleaved, each the latest from its camera.
+    :param cameras: {name: url}, or a list of urls, which are named camera0, camera1, ...
+    :param fps: if given, take at most this many frames per second from each camera.
+                The others are read from the stream but not converted to images.
+    :param opener: opener(url) returns a capture, or None if the camera cannot be opened.
+    :param max_reconnects: give up on a camera after this many reconnections (None: never).
+    Frames have img, mtime (when they were read) and uri 'camera:<name>'.
+    """
+    def __init__(self, cameras, *, fps=None, opener=open_capture,
+                 reconnect_delay=DEFAULT_RECONNECT_DELAY, max_reconnect_delay=DEFAULT_MAX_RECONNECT_DELAY,
+                 max_reconnects=None):
+        if not isinstance(cameras, dict):
+            cameras = {f"camera{i}": url for (i, url) in enumerate(cameras)}
+        self.cameras = cameras
+        self.fps = fps
+        self.opener = opener
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.max_reconnects = max_reconnects
+        self.stats = {name: CameraStats() for name in cameras}
+        self.slots = {name: None for name in cameras}   # the latest frame of each camera not yet taken
+        self.order = collections.deque(cameras)         # whose turn it is
+        self.ready = threading.Condition()
+        self.running = 0        # reader threads still reading
+        self.stop = threading.Event()
+        self.threads = []
+
+    def __repr__(self):
+        return f"<MultiCameraSource {list(self.cameras)}>"
+
+    def start(self):
+        """Start the reader threads. Iterating starts them if need be."""
+        if self.threads:
+            return
+        self.running = len(self.cameras)
+        for (name, url) in self.cameras.items():
+            t = threading.Thread(target=self.read_camera, args=(name, url), name=f"camera-{name}", daemon=True)
+            self.threads.append(t)
+            t.start()
+
+    def close(self):
+        """Stop the reader threads and release the cameras"""
+        self.stop.set()
+        with self.ready:
+            self.ready.notify_all()
+        for t in self.threads:
+            t.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def put(self, name, f):
+        with self.ready:
+            if self.slots[name] is not None:
+                self.stats[name].dropped += 1
+            self.slots[name] = f
+            self.ready.notify()
+
+    def read_camera(self, name, url):
+        """The reader thread of one camera: keep its slot filled with its latest frame"""
+        stats = self.stats[name]
+        delay = self.reconnect_delay
+        interval = 1.0 / self.fps if self.fps else 0
+        last = 0
+        try:
+            while not self.stop.is_set():
+                try:
+                    cap = self.opener(url)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    logging.warning("camera %s: cannot open: %s", name, e)
+                    cap = None
+                if cap is not None:
+                    try:
+                        while not self.stop.is_set() and cap.grab():
+                            now = time.time()
+                            if now - last < interval:
+                                continue        # not wanted; do not convert it
+                            (ok, img) = cap.retrieve()
+                            if not ok:
+                                break
+                            last = now
+                            delay = self.reconnect_delay    # it is working again
+                            stats.frames += 1
+                            f = Frame(img=img, mtime=now)
+                            f.uri = f"camera:{name}"
+                            self.put(name, f)
+                    except Exception as e: # pylint: disable=broad-exception-caught
+                        logging.warning("camera %s: %s", name, e)     # and reconnect
+                    finally:
+                        cap.release()
+                if self.stop.is_set() or (self.max_reconnects is not None and stats.reconnects >= self.max_reconnects):
+                    break
+                logging.info("camera %s: reconnecting in %s seconds", name, delay)
+                if self.stop.wait(delay):
+                    break
+                delay = min(delay * 2, self.max_reconnect_delay)
+                stats.reconnects += 1
+        finally:
+            with self.ready:
+                self.running -= 1
+                self.ready.notify_all()
+
+    def take(self):
+        """Wait for a frame and return it, taking cameras in turn; None when there will be no more"""
+        with self.ready:
+            while not self.stop.is_set():
+                for _ in range(len(self.order)):
+                    name = self.order[0]
+                    self.order.rotate(-1)
+                    f = self.slots[name]
+                    if f is not None:
+                        self.slots[name] = None
+                        self.stats[name].delivered += 1
+                        return f
+                if self.running == 0:
+                    return None         # the cameras have all ended, and their last frames are taken
+                self.ready.wait()
+            return None
+
+    def __iter__(self):
+        self.start()
+        while (f := self.take()) is not None:
+            yield f
+
+    def dropped(self):
+        """Total frames dropped, over all the cameras"""
+        return sum(s.dropped for s in self.stats.values())
@@ -8,7 +8,10 @@ from .stage import Stage
 import cv2
 
 class OpenCVFaceDetector(Stage):
-    """OpenCV Face Detector using Harr cascades."""
+    """OpenCV Face Detector using Harr cascades.
+    :param roi: if given, only the region of interest is searched, and faces whose
+                centre is outside it are not tagged.
+    """
     @staticmethod
     def cv2_cascade(name):
         """Return a harr cascade from OpenCV installation."""
@@ -22,27 +25,30 @@ class OpenCVFaceDetector(Stage):
     frontal_face_cascade = cv2.CascadeClassifier( cv2_cascade('haarcascade_frontalface_default.xml'))
     profile_cascade = cv2.CascadeClassifier( cv2_cascade('haarcascade_profileface.xml'))
 
+    def __init__(self, roi=None):
+        super().__init__()
+        self.roi = roi
+
+    def faces(self, gray, cascade):
+        """Return (x, y, w, h) of the faces cascade finds in the region of interest of gray"""
+        (region, (ox, oy)) = self.roi.crop(gray) if self.roi else (gray, (0, 0))
+        found = cascade.detectMultiScale(
+            region, scaleFactor=1.1, minNeighbors=10,
+            minSize=(40,40), flags=cv2.CASCADE_SCALE_IMAGE)
+        (gh, gw) = gray.shape[:2]
+        return [(x+ox, y+oy, w, h) for (x,y,w,h) in found
+                if self.roi is None or self.roi.contains(x+ox + w//2, y+oy + h//2, gw, gh)]
+
     def process(self, f:Frame):
         # we will be adding tags, so make a copy of the frame.
         # We then output the tagged frame.
         f = f.copy()
-        front_faces = self.frontal_face_cascade.detectMultiScale(
-            f.img_grayscale, scaleFactor=1.1, minNeighbors=10,
-            minSize=(40,40), flags=cv2.CASCADE_SCALE_IMAGE)
-
-        for (x,y,w,h) in front_faces:
-            f.add_tag(Tag( TAG_FACE,
-                           patch = Patch(xy = (x,y), w=w, h=h),
-                           text = "cv2 frontal_face"))
-
-        profile_faces = self.profile_cascade.detectMultiScale(
-            f.img_grayscale, scaleFactor=1.1, minNeighbors=10,
-            minSize=(40,40), flags=cv2.CASCADE_SCALE_IMAGE)
+        gray = f.img_grayscale
+        for (x,y,w,h) in self.faces(gray, self.frontal_face_cascade):
+            f.add_tag(Patch(TAG_FACE, xy=(x,y), w=w, h=h, text="cv2 frontal_face"))
 
-        for (x,y,w,h) in profile_faces:
-            f.add_tag(Tag(TAG_FACE,
-                          patch = Patch(pt1=(x,y), w=w, h=h),
-                          text="cv2 profile_face"))
+        for (x,y,w,h) in self.faces(gray, self.profile_cascade):
+            f.add_tag(Patch(TAG_FACE, xy=(x,y), w=w, h=h, text="cv2 profile_face"))
 
         self.output(f)
 
@@ -12,9 +12,9 @@ import math
 import argparse
 from os.path import join,dirname,abspath
 
-from .stage import Stage,ShowTags,ShowFrames
+from .stage import Stage,BatchStage,ShowTags,ShowFrames
 from .face import ExtractFacesToFrames
-from .frame import Frame,Tag,TAG_FACE
+from .frame import Frame,Tag,Patch,TAG_FACE
 from .pipeline import SingleThreadedPipeline
 from .source import FrameStream
 
@@ -37,6 +37,8 @@ class YOLOv8_face:
         self.input_width = 640
         self.reg_max = 16
 
+        self.dynamic_batch = True   # until the model says otherwise
+
         self.project = np.arange(self.reg_max)
         self.strides = (8, 16, 32)
         self.feats_hw = [(math.ceil(self.input_height / self.strides[i]), math.ceil(self.input_width / self.strides[i]))
@@ -82,21 +84,42 @@ class YOLOv8_face:
             img = cv2.resize(srcimg, (self.input_width, self.input_height), interpolation=cv2.INTER_AREA)
         return img, newh, neww, top, left
 
-    def detect(self, srcimg):
-        input_img, newh, neww, padh, padw = self.resize_image(cv2.cvtColor(srcimg, cv2.COLOR_BGR2RGB))
-        scale_h, scale_w = srcimg.shape[0] / newh, srcimg.shape[1] / neww
-        input_img = input_img.astype(np.float32) / 255.0
-
-        blob = cv2.dnn.blobFromImage(input_img)
-        self.net.setInput(blob)
-        outputs = self.net.forward(self.net.getUnconnectedOutLayersNames())
+    def forward(self, inputs):
+        """Run the network on a list of preprocessed images with one forward pass.
+        Models exported with a fixed batch size of 1 reject larger blobs; for them,
+        run one image at a time."""
+        if self.dynamic_batch and len(inputs) > 1:
+            try:
+                self.net.setInput(cv2.dnn.blobFromImages(inputs))
+                return self.net.forward(self.net.getUnconnectedOutLayersNames())
+            except cv2.error: # pylint: disable=catching-non-exception
+                self.dynamic_batch = False
+        outputs = []
+        for input_img in inputs:
+            self.net.setInput(cv2.dnn.blobFromImage(input_img))
+            outputs.append(self.net.forward(self.net.getUnconnectedOutLayersNames()))
+        return [np.concatenate(layer, axis=0) for layer in zip(*outputs)]
+
+    def detect_batch(self, srcimgs):
+        """Detect the faces in a list of images. Returns a list of (det_bboxes, det_conf, det_classid, landmarks)"""
+        inputs = []
+        params = []
+        for srcimg in srcimgs:
+            input_img, newh, neww, padh, padw = self.resize_image(cv2.cvtColor(srcimg, cv2.COLOR_BGR2RGB))
+            inputs.append(input_img.astype(np.float32) / 255.0)
+            params.append((srcimg.shape[0] / newh, srcimg.shape[1] / neww, padh, padw))
+        outputs = self.forward(inputs)
 
         # if isinstance(outputs, tuple):
         #     outputs = list(outputs)
         # if float(cv2.__version__[:3])>=4.7:
         #     outputs = [outputs[2], outputs[0], outputs[1]] # "This step is required for OpenCV 4.7, but not for OpenCV 4.5"
         # Perform inference on the image
-        det_bboxes, det_conf, det_classid, landmarks = self.post_process(outputs, scale_h, scale_w, padh, padw)
+        return [self.post_process([out[i:i+1] for out in outputs], scale_h, scale_w, padh, padw)
+                for (i, (scale_h, scale_w, padh, padw)) in enumerate(params)]
+
+    def detect(self, srcimg):
+        det_bboxes, det_conf, det_classid, landmarks = self.detect_batch([srcimg])[0]
         return det_bboxes, det_conf, det_classid, landmarks
 
     def post_process(self, preds, scale_h, scale_w, padh, padw):
@@ -174,17 +197,35 @@ class FaceQualityAssessment():
         self.net = cv2.dnn.readNet(path)
         self.input_height = 112
         self.input_width = 112
+        self.dynamic_batch = True
 
-    def detect(self, srcimg):
+    def preprocess(self, srcimg):
         input_img = cv2.resize(cv2.cvtColor(srcimg, cv2.COLOR_BGR2RGB), (self.input_width, self.input_height))
-        input_img = (input_img.astype(np.float32) / 255.0 - 0.5) / 0.5
+        return ((input_img.astype(np.float32) / 255.0 - 0.5) / 0.5).astype(np.float32)
+
+    def detect_batch(self, srcimgs):
+        """Returns the quality probabilities for each image in srcimgs"""
+        inputs = [self.preprocess(srcimg) for srcimg in srcimgs]
+        if self.dynamic_batch and len(inputs) > 1:
+            try:
+                self.net.setInput(cv2.dnn.blobFromImages(inputs))
+                outputs = self.net.forward(self.net.getUnconnectedOutLayersNames())
+                return [row.reshape(-1) for row in outputs[0]]
+            except cv2.error: # pylint: disable=catching-non-exception
+                self.dynamic_batch = False
+        return [self.detect(srcimg) for srcimg in srcimgs]
 
-        blob = cv2.dnn.blobFromImage(input_img.astype(np.float32))
+    def detect(self, srcimg):
+        blob = cv2.dnn.blobFromImage(self.preprocess(srcimg))
         self.net.setInput(blob)
         outputs = self.net.forward(self.net.getUnconnectedOutLayersNames())
         return outputs[0].reshape(-1)
 
-class Yolo8FaceTag(Stage):
+class Yolo8FaceTag(BatchStage):
+    """Tag faces with YOLOv8. Frames are run through the network in batches.
+    :param roi: if given, only the region of interest is searched, and faces whose
+                centre is outside it are not tagged.
+    """
     # Initialize YOLOv8_face object detector
 
     face_detector = YOLOv8_face(YOLO8N_FACE_PATH,
@@ -192,26 +233,45 @@ class Yolo8FaceTag(Stage):
                                 iou_thres=NMS_THRESHOLD)
     fqa = FaceQualityAssessment(YOLO8N_QUALITY_ASSESSMENT)
 
-    def process(self, f:Frame):
-        # Detect Objects
-        # we will be adding tags, so make a copy of this frame
-        f = f.copy()
-        boxes, scores, classids, kpts = self.face_detector.detect(f.img)
-        for i, box in enumerate(boxes):
-            x, y, w, h = box.astype(int)
-            crop_img = f.img[y:y + h, x:x + w]  # crop - can also be done after facial alignment
-            fqa_probs = self.fqa.detect(crop_img)    # get the face quality
-            fqa_prob_mean = round(np.mean(fqa_probs), 2)
+    def __init__(self, roi=None, **kwargs):
+        super().__init__(**kwargs)
+        self.roi = roi
 
-            f.add_tag(Patch(TAG_FACE,
-                          xy=(x,y), w=w, h=h, fqa = fqa_prob_mean,
-                          text=f"fqa_score {fqa_prob_mean:4.2f}"))
-        # output the copy
-        self.output(f)
+    def process_batch(self, frames):
+        # Detect Objects
+        # we will be adding tags, so make a copy of each frame
+        frames = [f.copy() for f in frames]
+        # The network input is 640x640, so decode no more of each JPEG (or of its ROI) than that needs
+        side = max(self.face_detector.input_width, self.face_detector.input_height)
+        reduced = [f.img_at(self.roi.full_side(side) if self.roi else side) for f in frames]
+        crops = [self.roi.crop(img) if self.roi else (img, (0, 0)) for (img, scale) in reduced]
+        detections = self.face_detector.detect_batch([crop for (crop, origin) in crops])
+        faces = []              # (frame, x, y, w, h), in full-resolution coordinates
+        for (f, (img, scale), (_, (ox, oy)), (boxes, scores, classids, kpts)) in zip(frames, reduced, crops, detections):
+            for box in boxes:
+                box = box + np.array([ox, oy, 0, 0])    # from the ROI crop to the reduced image
+                rx, ry, rw, rh = box.astype(int)
+                if self.roi and not self.roi.contains(rx + rw // 2, ry + rh // 2, img.shape[1], img.shape[0]):
+                    continue
+                x, y, w, h = (box * scale).astype(int)
+                faces.append((f, x, y, w, h))
+        if faces:
+            # The quality network takes 112x112 faces; cut them from the full-resolution image,
+            # where a small face has the detail that the reduced image lost.
+            # (crop - can also be done after facial alignment)
+            face_imgs = [f.img[max(y, 0):y + h, max(x, 0):x + w] for (f, x, y, w, h) in faces]
+            # get the face quality of every face in the batch at once
+            for ((f, x, y, w, h), fqa_probs) in zip(faces, self.fqa.detect_batch(face_imgs)):
+                fqa_prob_mean = round(np.mean(fqa_probs), 2)
+                f.add_tag(Patch(TAG_FACE,
+                              xy=(x,y), w=w, h=h, fqa = fqa_prob_mean,
+                              text=f"fqa_score {fqa_prob_mean:4.2f}"))
+        # output the copies
+        return frames
 
 class Yolo8FaceQualityAssessemtn(Stage):
     """Just apply the FaceQualityAssessment to the face tags on the frame."""
-    TODO
+    # TODO
 
     face_detector = YOLOv8_face(YOLO8N_FACE_PATH,
                                 conf_thres=CONF_THRESHOLD,
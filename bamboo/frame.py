@@ -9,61 +9,119 @@ Tag - For adding (k,v) tags to Frames. The "v" is an arbitrary python value or o
 
 Frames based on disk files are cached in memory with an LRU
 cache. This allows millions of frames to be kept in memory using only
-megabytes rather than terabytes of RAM.
+megabytes rather than terabytes of RAM. The cache, frame_cache, is limited
+by bytes rather than by entries; change the limit with frame_cache.set_budget().
 
 """
 import os
-import functools
 from datetime import datetime
 import json
 import copy
 import errno
+import time
+import itertools
 
 import cv2
 import numpy as np
-import hashlib
 
 from .constants import C
-from .image_utils import img_sim
+from .cache import FrameCache
+from .probe import jpeg_dimensions,probe
+from .hashindex import hash_index
+from .image_utils import img_sim,signature,SimilarityEngine,DEFAULT_THUMB_SIDE
 from .storage import bamboo_load, bamboo_save
 
-MAXSIZE_CACHE=128
 DEFAULT_JPEG_QUALITY = 90
 
 TAG_FACE='face'
 TAG_FACE_COUNT='face_count'
 TAG_SKIPPED='skipped'
+TAG_MOTION='motion'
 
 ## several functions for reading images. All cache.
 ## This allows us to just pass around the path and read the bytes or the cv2 image rapidly from the cache
+## The raw bytes, decoded image and grayscale image of a file are cached separately in frame_cache.
 
-@functools.lru_cache(maxsize=MAXSIZE_CACHE)
-def bytes_read(path):
-    """Returns the file, which is compressed as a JPEG"""
+CACHE_BYTES = 'bytes'
+CACHE_IMAGE = 'img'
+CACHE_GRAYSCALE = 'gray'
+CACHE_REDUCED = 'reduced'
+CACHE_SIMILARITY = 'sim'
+CACHE_SIGNATURE = 'signature'
+
+# JPEG can be decoded at 1/2, 1/4 or 1/8 scale in the DCT domain, which is much faster than a full decode
+REDUCED_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4,
+                 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+frame_cache = FrameCache()
+
+# How Frame.similarity() compares frames, unless it is given an engine
+similarity_engine = SimilarityEngine()
+
+# Similarity scores of pairs of images, keyed by their content hashes and the engine settings.
+# The keys take far more memory than the scores, so they are charged to the budget too.
+SIMILARITY_MEMO_BYTES = 16 * 1024 * 1024
+similarity_memo = FrameCache(max_bytes=SIMILARITY_MEMO_BYTES, charge_keys=True)
+
+def _bytes_read(path):
     with open(path,"rb") as f:
         return f.read()
 
-@functools.lru_cache(maxsize=MAXSIZE_CACHE)
-def hash_read(path):
-    """Return the first 256 bits of a SHA-512 hash. We do this because SHA-512 is faster than SHA-256"""
-    return "SHA-512/256:" + hashlib.sha512(bytes_read(path)).digest()[:32].hex()
+def bytes_read(path):
+    """Returns the file, which is compressed as a JPEG"""
+    return frame_cache.get((CACHE_BYTES, path), lambda: _bytes_read(path))
+
+def hash_read(path, read=False):
+    """Return the first 256 bits of a SHA-512 hash, from the hash index if the file has been hashed before.
+    Files are hashed in chunks, so they are not read into the cache, unless read is set: then a file
+    that has to be hashed is read into the cache and hashed from there, for a caller about to decode it."""
+    if read:
+        return hash_index().hash(path, data=lambda: bytes_read(path))
+    return hash_index().hash(path, data=frame_cache.peek((CACHE_BYTES, path)))
 
 
-@functools.lru_cache(maxsize=MAXSIZE_CACHE)
+def _image_read(path):
+    img = cv2.imdecode(np.frombuffer( bytes_read(path), np.uint8), cv2.IMREAD_ANYCOLOR)
+    if img is None:
+        raise FileNotFoundError("cannot read:"+path)
+    img.flags.writeable = False
+    return img
+
 def image_read(path):
     """Caching image read. We cache to minimize what's stored in memory. We make it immutable to allow sharing"""
-    img = cv2.imdecode(np.frombuffer( bytes_read(path), np.uint8), cv2.IMREAD_ANYCOLOR)
+    return frame_cache.get((CACHE_IMAGE, path), lambda: _image_read(path))
+
+def _image_read_reduced(path, factor):
+    img = cv2.imdecode(np.frombuffer( bytes_read(path), np.uint8), REDUCED_FLAGS[factor])
     if img is None:
         raise FileNotFoundError("cannot read:"+path)
     img.flags.writeable = False
     return img
 
-@functools.lru_cache(maxsize=MAXSIZE_CACHE)
+def image_read_reduced(path, factor):
+    """Caching image read at 1/factor of full resolution. Each factor is cached separately."""
+    if factor == 1:
+        return image_read(path)
+    return frame_cache.get((CACHE_REDUCED, path, factor), lambda: _image_read_reduced(path, factor))
+
+def reduction_factor(full_side, max_side):
+    """The largest of 1, 2, 4 and 8 that keeps full_side at least max_side"""
+    factor = 1
+    while factor < 8 and full_side // (factor * 2) >= max_side:
+        factor *= 2
+    return factor
+
+def _image_grayscale(path):
+    img = image_read(path)
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        img.flags.writeable = False
+    return img
+
 def image_grayscale(path):
     """Caching image bw. We cache to minimize what's stored in memory"""
-    img = cv2.cvtColor(image_read(path), cv2.COLOR_BGR2GRAY)
-    img.flags.writable = False
-    return img
+    return frame_cache.get((CACHE_GRAYSCALE, path), lambda: _image_grayscale(path))
 
 def similarity_for_two(t):
     """Similarity of two CV2 images on a scale of 0 to 1.0.
@@ -71,42 +129,68 @@ def similarity_for_two(t):
     return (t[0],t[1],img_sim(t[2],t[3]))
 
 
+def filename_time(path):
+    """Return the time in the file name, for files named by ISO timestamp, or None"""
+    try:
+        return datetime.fromisoformat( os.path.splitext(os.path.basename(path))[0] ).timestamp()
+    except ValueError:
+        return None
+
 P_PATH = 'path'
 P_CROP = 'crop'
+P_FRAME = 'frame'               # made in memory (such as from a video or a camera); the value is unique to the frame
+
+_frame_numbers = itertools.count()
 
 class Frame:
     """Abstraction to hold an image frame.
-    If a stage modifies a Frame, it needs to make a copy first."""
+    If a stage modifies a Frame, it needs to make a copy first.
+    Frames use __slots__ so that millions of them can be held in memory. history and tags
+    are tuples, shared between copies; adding to them makes a new tuple.
+    mtime is seconds since the epoch. If it is not given, it comes from the file name or,
+    failing that, the file's modification time."""
+    __slots__ = ('path','uri','history','tags','mtime','w_','h_','depth_','img_','mime_type_')
     jpeg_quality = DEFAULT_JPEG_QUALITY
-    def __init__(self, *, path=None, img=None, src=None, mime_type=None):
+    def __init__(self, *, path=None, img=None, src=None, mime_type=None, mtime=None):
         self.path = path        # if read or written to a file, the path
         self.uri  = None        # the full uri; to replace path
         if src is not None:
-            self.history = copy.copy(src.history)
+            self.history = src.history
+            self.mtime   = src.mtime
+        elif path is not None:
+            self.history = ((P_PATH,path),)          # new history
+            self.mtime   = None
         else:
-            self.history  = [(P_PATH,path)]          # new history
-        self.tags = []
-        self.tags_added = 0
+            self.history = ((P_FRAME,f"{os.getpid()}.{next(_frame_numbers)}"),)
+            self.mtime   = None
+        self.tags = ()
 
         # These are for overriding the properties
         self.w_ = None
         self.h_ = None
         self.depth_ = None
-        self.bytes_ = None
         self.img_   = None
         self.mime_type_ = mime_type
 
         # Set the timestamp
-        if path is not None:
-            try:
-                self.mtime = datetime.fromisoformat( os.path.splitext(os.path.basename(path))[0] )
-            except ValueError:
-                self.mtime = datetime.fromtimestamp(os.path.getmtime(path))
+        if img is not None:
+            self.img_ = img
+        if mtime is not None:
+            self.mtime = mtime
+        elif path is not None:
+            self.mtime = filename_time(path)
+            if self.mtime is None:
+                self.mtime = os.path.getmtime(path)
         elif img is not None:
-            self.mtime = datetime.now()
+            self.mtime = time.time()
 
     def __lt__(self, b):
         return  self.mtime < b.mtime
+
+    @property
+    def src(self):
+        """Where the frame came from: its uri if it has one (such as a time in a video), otherwise its path"""
+        return self.uri or self.path
     def __repr__(self):
         return f"<Frame path={self.path} history={self.history} tags={[tag.tag_type for tag in self.tags]}>"
 
@@ -126,16 +210,16 @@ class Frame:
         return copy.copy(self)
 
     def writable_copy(self):
-        """Returns a copy into which we can write"""
+        """Returns a copy into which we can write. This is where the pixels of a crop are copied."""
         c = self.copy()
         c.img_ = self.img.copy()
-        c.img_.flags.writable=True
-        c.path_ = None
+        c.img_.flags.writeable=True
+        c.path = None
         return c
 
-    def hash(self):
-        """Return a unique hash of the image"""
-        return hash_read(self.path)
+    def hash(self, read=False):
+        """Return a unique hash of the image. See hash_read() for read."""
+        return hash_read(self.path, read)
 
     def annotate( self, i, xy, w, h, text, *, textcolor=C.GREEN, boxcolor=C.RED, thickness=2):
         cv2.rectangle(i, xy, (xy[0]+w, xy[1]+h), boxcolor, thickness=thickness)
@@ -143,12 +227,8 @@ class Frame:
                     cv2.FONT_HERSHEY_SIMPLEX, 0.8, textcolor, thickness=thickness)
 
     def add_tag(self, tag):
-        # Before we add the first tag, copy the tags array so that this frame
-        # has its own copy of the array
-        if self.tags_added == 0:
-            self.tags = copy.copy(self.tags)
-        self.tags.append(tag)
-        self.tags_added += 1
+        # The tags tuple may be shared with the frame this was copied from, so make a new one
+        self.tags = self.tags + (tag,)
 
     def show(self, i=None, title=None, wait=0):
         """show the frame, optionally waiting for keyboard"""
@@ -176,10 +256,26 @@ class Frame:
         """return an opencv image object that is not writable."""
         return self.img_ if self.img_ is not None else image_read(self.path)
 
+    def img_at(self, max_side):
+        """Return (img, scale): the image decoded at the lowest resolution whose longest
+        side is still at least max_side, and the factor by which coordinates in that image
+        are multiplied to get coordinates in the full-resolution image.
+        Use this for detectors that shrink the image anyway."""
+        if self.img_ is not None or self.path is None:
+            return (self.img, 1.0)
+        dims = jpeg_dimensions(bytes_read(self.path))
+        if dims is None:
+            return (self.img, 1.0)
+        factor = reduction_factor(max(dims), max_side)
+        img = image_read_reduced(self.path, factor)
+        return (img, max(dims) / max(img.shape[:2]))
+
     @property
     def img_grayscale(self):
         """return an opencv image object in grayscale."""
-        return image_read(self.path)
+        if self.img_ is not None:
+            return self.img_ if self.img_.ndim == 2 else cv2.cvtColor(self.img_, cv2.COLOR_BGR2GRAY)
+        return image_grayscale(self.path)
 
     @property
     def bytes(self):
@@ -188,28 +284,88 @@ class Frame:
             return bytes_read(self.path)
         return cv.imencode('.jpg', self.img_, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])[1]
 
+    def probe_dimensions(self, info=None):
+        """Set w_, h_ and depth_ for a frame read from a file.
+        They come from the image headers if possible (see probe.py), so the image is not decoded.
+        :param info: the ImageInfo for the file, if it has already been probed.
+        """
+        if info is None:
+            info = probe(self.path)
+        if info is not None and info.width is not None:
+            (w, h) = info.display_size
+            depth = info.components
+        else:
+            shape = image_read(self.path).shape
+            (w, h, depth) = (shape[1], shape[0], shape[2] if len(shape) > 2 else 1)
+        if self.w_ is None:
+            self.w_ = w
+        if self.h_ is None:
+            self.h_ = h
+        if self.depth_ is None:
+            self.depth_ = depth
+
     @property
-    @functools.lru_cache(maxsize=3)
     def w(self):
-        return self.w_ if self.w_ is not None else self.img.shape[1]
+        if self.w_ is None:
+            if self.img_ is not None:
+                return self.img_.shape[1]
+            self.probe_dimensions()
+        return self.w_
 
     @property
-    @functools.lru_cache(maxsize=3)
     def h(self):
         """height (y) is the first index in the shape. nparray goes from lsb to msb"""
-        return self.h_  if self.h_  is not None else self.img.shape[0]
+        if self.h_ is None:
+            if self.img_ is not None:
+                return self.img_.shape[0]
+            self.probe_dimensions()
+        return self.h_
 
     @property
-    @functools.lru_cache(maxsize=3)
     def depth(self):
-        return self.depth_ if self.depth_ is not None else self.img.shape[2]
-
-    @functools.lru_cache(maxsize=10)
-    def similarity(self, i2):
-        """Return the simularity score with img"""
+        if self.depth_ is None:
+            if self.img_ is not None:
+                return self.img_.shape[2] if self.img_.ndim > 2 else 1
+            self.probe_dimensions()
+        return self.depth_
+
+    def sim_image(self, engine):
+        """The image prepared for engine.compare(). For a file it is decoded at reduced
+        resolution and cached, so a reference frame is prepared only once."""
+        if self.img_ is not None or self.path is None:
+            return engine.prepare(self.img)
+        if engine.max_side is None:
+            return engine.prepare(self.img_grayscale) if engine.roi is not None else self.img_grayscale
+        need = engine.max_side if engine.roi is None else engine.roi.full_side(engine.max_side)
+        return frame_cache.get((CACHE_SIMILARITY, self.path, engine.key),
+                               lambda: engine.prepare(self.img_at(need)[0]))
+
+    def signature(self, side=DEFAULT_THUMB_SIDE, roi=None):
+        """The (dhash, thumbnail) signature used by SimilarityCascade, of the roi if one is given.
+        For a file it is cached by content hash, so copies of a file share one."""
+        if self.img_ is not None or self.path is None:
+            return signature(self.img, side, roi)
+        # the ROI is cropped from the reduced image, so decode enough that the crop is still side pixels
+        need = side if roi is None else roi.full_side(side)
+        # a file seen for the first time is read once, both to hash and to decode
+        key = (CACHE_SIGNATURE, self.hash(read=True), side) + ((roi.key,) if roi is not None else ())
+        return frame_cache.get(key,
+                               lambda: signature(self.img_at(need)[0], side, roi))
+
+    def similarity(self, i2, engine=None):
+        """Return the simularity score with img.
+        :param engine: the SimilarityEngine; by default, similarity_engine.
+        Scores of frames read from files are remembered by content hash, so comparing
+        the same two images again (or copies of them) costs only the hashing."""
         if i2 is None:
             return 0            # not similar at all
-        return img_sim(self.img, i2.img)
+        engine = engine or similarity_engine
+        def score():
+            return engine.compare(self.sim_image(engine), i2.sim_image(engine))
+        if self.path is None or i2.path is None or self.img_ is not None or i2.img_ is not None:
+            return score()
+        key = tuple(sorted((self.hash(read=True), i2.hash(read=True)))) + engine.key
+        return similarity_memo.get(key, score)
 
     def crop(self, *, xy, w, h):
         """Return a new Frame that is the old one cropped. So copy over the provenance."""
@@ -217,32 +373,66 @@ class Frame:
         return cf
 
 class CroppedFrame(Frame):
+    """A rectangle of another frame. The image is a read-only view into the source image,
+    which it keeps alive; nothing is copied until writable_copy() is called.
+    A view of a cached image keeps the whole image in memory even after it leaves frame_cache."""
+    __slots__ = ()
     def __init__(self, *, src, xy, w, h):
         super().__init__(src=src)
         self.w_ = w
         self.h_ = h
         # This is weird, but correct.
         # Slice order is y,x but the point stores x at xy[0].
-        self.img_ = np.copy(src.img[xy[1]:xy[1]+h, xy[0]:xy[0]+w])
-        self.history.append((P_CROP, (xy,(w,h))))
+        self.img_ = src.img[xy[1]:xy[1]+h, xy[0]:xy[0]+w]
+        self.img_.flags.writeable = False
+        self.history = self.history + ((P_CROP, (xy,(w,h))),)
 
 class Tag:
-    def __init__(self, tag_type, **kwargs):
-        self.text = ""
+    """A (k,v) tag. Keyword arguments become attributes of the tag.
+    The common ones have slots; any others are kept in attrs."""
+    __slots__ = ('tag_type','text','attrs')
+    def __init__(self, tag_type, *, text="", **kwargs):
+        self.text = text
         self.tag_type = tag_type
-        for (k,v) in kwargs.items():
-            setattr(self, k, v)
+        self.attrs = kwargs or None
+
+    def __getattr__(self, name):
+        # Only called for names that are not slots
+        if name != 'attrs' and self.attrs is not None and name in self.attrs:
+            return self.attrs[name]
+        raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{name}'")
 
     def __repr__(self):
-        return f"<{self.__class__.__name__} {self.tag_type} {self.__dict__.keys()}>"
+        return f"<{self.__class__.__name__} {self.tag_type} {self.dict().keys()}>"
+
+    def slot_names(self):
+        return [name for cls in reversed(type(self).__mro__)
+                for name in getattr(cls, '__slots__', ()) if name != 'attrs']
 
     def dict(self):
-        return self.__dict__
+        d = {name:getattr(self, name) for name in self.slot_names()}
+        d.update(self.attrs or {})
+        return d
+
+    def __setstate__(self, state):
+        """Unpickle. Tags pickled before Tag had slots (such as old .tag files) have
+        their __dict__ as their state, rather than (None, slots)."""
+        (d, slots) = state if isinstance(state, tuple) else (state, None)
+        d = {**(d or {}), **(slots or {})}
+        attrs = d.pop('attrs', None) or {}
+        for name in self.slot_names():
+            setattr(self, name, d.pop(name, None))
+        attrs.update(d)
+        self.attrs = attrs or None
 
 class Patch(Tag):
     """A Patch is a special kind of tag that refers to just a specific area of the Frame"""
-    def __init__(self, tag_type, **kwargs):
+    __slots__ = ('xy','w','h')
+    def __init__(self, tag_type, *, xy=None, w=None, h=None, **kwargs):
         super().__init__(tag_type, **kwargs)
+        self.xy = xy
+        self.w = w
+        self.h = h
 
 def FrameTagDict(f,t):
     return {'path':f.path, 'history':f.history, 'tag':t}
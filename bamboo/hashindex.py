@@ -0,0 +1,109 @@
+"""
+Content hashes of files, remembered across runs.
+
+hash_file(path) - SHA-512/256 of a file, read in fixed-size chunks rather than all at once.
+HashIndex - An SQLite table of hashes keyed by (path, size, mtime). A file is hashed once;
+            later lookups, in this run or any other, cost a stat() and a query.
+            A file that changes size or modification time is hashed again.
+
+The index used by Frame.hash() is in $BAMBOO_HASH_INDEX, by default ~/.bamboo-hash-index.sqlite.
+"""
+
+import os
+import hashlib
+import sqlite3
+import threading
+import logging
+
+HASH_PREFIX = "SHA-512/256:"
+CHUNK_SIZE = 1024 * 1024
+HASH_INDEX_ENVIRON = 'BAMBOO_HASH_INDEX'
+DEFAULT_HASH_INDEX = os.path.join(os.getenv('HOME', ''), '.bamboo-hash-index.sqlite')
+
+def hash_bytes(data):
+    """Return the first 256 bits of a SHA-512 hash. We do this because SHA-512 is faster than SHA-256"""
+    return HASH_PREFIX + hashlib.sha512(data).digest()[:32].hex()
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """hash_bytes() of the file at path, reading it chunk_size bytes at a time into one buffer"""
+    h = hashlib.sha512()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while (n := f.readinto(buf)):
+            h.update(view[:n])
+    return HASH_PREFIX + h.digest()[:32].hex()
+
+class HashIndex:
+    """Persistent map of (path, size, mtime) to content hash.
+    :param db_path: the SQLite file, or ':memory:' for an index that lasts only this run.
+    Each thread and each process has its own connection."""
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.conn()             # create the table now, so errors show up here
+
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            if self.db_path != ':memory:':
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS hashes "
+                         "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def lookup(self, path, st=None):
+        """Return the hash recorded for path if the file has not changed since, otherwise None"""
+        st = st or os.stat(path)
+        row = self.conn().execute("SELECT hash FROM hashes WHERE path=? AND size=? AND mtime_ns=?",
+                                  (os.path.abspath(path), st.st_size, st.st_mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def record(self, path, st, digest):
+        conn = self.conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO hashes (path, size, mtime_ns, hash) VALUES (?,?,?,?)",
+                         (os.path.abspath(path), st.st_size, st.st_mtime_ns, digest))
+
+    def hash(self, path, data=None):
+        """Return the hash of the file at path, from the index or by hashing it.
+        :param data: the contents of the file, if they are already in memory, or a function
+                     that returns them, which is only called if the file has to be hashed.
+        """
+        st = os.stat(path)
+        digest = self.lookup(path, st)
+        if digest is not None:
+            self.hits += 1
+            return digest
+        self.misses += 1
+        if callable(data):
+            data = data()
+        digest = hash_bytes(data) if data is not None else hash_file(path)
+        try:
+            self.record(path, st, digest)
+        except sqlite3.OperationalError as e:
+            logging.warning("cannot record hash of %s in %s: %s", path, self.db_path, e)
+        return digest
+
+_hash_index = None
+_hash_index_lock = threading.Lock()
+
+def hash_index():
+    """Return the HashIndex used by Frame.hash(), opening it on first use"""
+    global _hash_index          # pylint: disable=global-statement
+    with _hash_index_lock:
+        if _hash_index is None:
+            _hash_index = HashIndex(os.getenv(HASH_INDEX_ENVIRON, DEFAULT_HASH_INDEX))
+        return _hash_index
+
+def set_hash_index(db_path):
+    """Use the index in db_path from now on"""
+    global _hash_index          # pylint: disable=global-statement
+    with _hash_index_lock:
+        _hash_index = HashIndex(db_path)
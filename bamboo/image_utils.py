@@ -5,26 +5,212 @@
 
 pip install --upgrade scikit-image
 pip install --upgrade imutils
+
+SimilarityEngine - SSIM of two images at reduced resolution. Each image is reduced once with
+                   prepare(), so a reference image can be compared with many others.
+                   The SSIM is either scikit-image's or the same formula computed with
+                   OpenCV box filters, which is several times faster.
+SimilarityCascade - Decides whether two frames are less similar than a threshold, from a
+                   dHash and the SSIM of tiny thumbnails, computing the full SSIM only
+                   when they are in the ambiguous band around the threshold.
+
+Each of them takes an roi (see roi.py): images are cropped to the region of interest before
+anything is computed, and pixels outside it do not count towards the score.
 """
 
 from skimage.metrics import structural_similarity as compare_ssim
 import argparse
 import imutils
+import collections
+import threading
 import cv2
+import numpy as np
+
+BOX = 'box'
+SKIMAGE = 'skimage'
+DEFAULT_SIM_MAX_SIDE = 640         # agreed with full-resolution SSIM in benchmarks/similarity.py
+SSIM_WIN_SIZE = 7               # scikit-image's default
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+DEFAULT_THUMB_SIDE = 64
+DHASH_NEAR = 4                  # of 64 bits
+# Thumbnail SSIM is seldom more than 0.02 above the full score, but a small change such as a
+# person entering fills more of a thumbnail and can make it 0.1 below, so the band is lopsided.
+DEFAULT_BAND = (0.20, 0.05)     # (below, above) the threshold
+
+def grayscale(img):
+    return img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+def dhash(gray, mask=None):
+    """64-bit difference hash: whether each of 8x8 pixels is brighter than its right neighbour.
+    Pixels where mask is 0 are ignored."""
+    if mask is not None:
+        gray = np.where(mask > 0, gray, np.uint8(0))
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
 
-def img_sim(imageA, imageB):
+def signature(img, side=DEFAULT_THUMB_SIDE, roi=None):
+    """Return (dhash, thumbnail), the cheap signature that SimilarityCascade compares.
+    The thumbnail is grayscale with its longest side reduced to side."""
+    engine = SimilarityEngine(max_side=side, roi=roi)
+    thumb = engine.prepare(img)
+    return (dhash(thumb, engine.mask(thumb)), thumb)
+
+def masked_mean(s, mask, pad):
+    """Mean of the SSIM map s where mask is set, leaving out the pad pixels at the edges"""
+    s = s[pad:-pad, pad:-pad]
+    if mask is None:
+        return float(s.mean(dtype=np.float64))
+    mask = mask[pad:-pad, pad:-pad] > 0
+    if not mask.any():
+        return 1.0              # nothing that matters is different
+    return float(s[mask].mean(dtype=np.float64))
+
+def img_sim(imageA, imageB, roi=None):
+    """SSIM of two images at full resolution, as computed by scikit-image.
+    :param roi: if given, only the region of interest is compared"""
     # convert the images to grayscale
-    grayA = cv2.cvtColor(imageA, cv2.COLOR_BGR2GRAY)
-    grayB = cv2.cvtColor(imageB, cv2.COLOR_BGR2GRAY)
-
-    # compute the Structural Similarity Index (SSIM) between the two
-    # images, ensuring that the difference image is returned
-    if grayA.shape == grayB.shape:
-        (score, diff) = compare_ssim(grayA, grayB, full=True)
-        return score
-    else:
+    grayA = grayscale(imageA)
+    grayB = grayscale(imageB)
+
+    # compute the Structural Similarity Index (SSIM) between the two images
+    if grayA.shape != grayB.shape:
         return 0
+    if roi is None:
+        return compare_ssim(grayA, grayB)
+    (grayA, _) = roi.crop(grayA)
+    (grayB, _) = roi.crop(grayB)
+    (_, s) = compare_ssim(grayA, grayB, full=True)
+    return masked_mean(s, roi.box_mask(grayA.shape[1], grayA.shape[0]), (SSIM_WIN_SIZE - 1) // 2)
+
+def ssim_box(grayA, grayB, win_size=SSIM_WIN_SIZE, data_range=255, mask=None):
+    """Mean SSIM with a uniform window, computed with OpenCV box filters.
+    This is the same formula as scikit-image's default (uniform window, sample covariance),
+    and gives the same score to within float32 rounding.
+    :param mask: if given, only pixels where it is set are averaged"""
+    a = grayA.astype(np.float32)
+    b = grayB.astype(np.float32)
+    def mean(x):
+        return cv2.blur(x, (win_size, win_size))
+    ua = mean(a)
+    ub = mean(b)
+    cov_norm = win_size * win_size / (win_size * win_size - 1)
+    va  = cov_norm * (mean(a * a) - ua * ua)
+    vb  = cov_norm * (mean(b * b) - ub * ub)
+    vab = cov_norm * (mean(a * b) - ua * ub)
+    c1 = (SSIM_K1 * data_range) ** 2
+    c2 = (SSIM_K2 * data_range) ** 2
+    s = ((2 * ua * ub + c1) * (2 * vab + c2)) / ((ua * ua + ub * ub + c1) * (va + vb + c2))
+    return masked_mean(s, mask, (win_size - 1) // 2)   # windows that hang over the edge are not counted
+
+
+class SimilarityEngine:
+    """Compares images by the SSIM of their grayscale at reduced resolution.
+    :param max_side: images are shrunk so that their longest side is at most max_side.
+                     None compares at full resolution.
+    :param method: BOX (OpenCV box filters) or SKIMAGE (scikit-image)
+    :param roi: if given, images are cropped to it and only it is compared.
+                max_side then applies to the crop.
+    """
+    def __init__(self, max_side=DEFAULT_SIM_MAX_SIDE, method=BOX, roi=None):
+        if method not in (BOX, SKIMAGE):
+            raise ValueError(f"unknown similarity method {method}")
+        self.max_side = max_side
+        self.method = method
+        self.roi = roi
+
+    def __repr__(self):
+        return f"<SimilarityEngine max_side={self.max_side} method={self.method} roi={self.roi}>"
+
+    @property
+    def key(self):
+        """Identifies the settings, for caching prepared images and scores"""
+        return (self.max_side, self.method, self.roi.key if self.roi is not None else None)
+
+    def mask(self, gray):
+        """The ROI mask for a prepared image, or None"""
+        return self.roi.box_mask(gray.shape[1], gray.shape[0]) if self.roi is not None else None
+
+    def prepare(self, img):
+        """Return the grayscale, reduced image that compare() takes"""
+        gray = grayscale(img)
+        if self.roi is not None:
+            (gray, _) = self.roi.crop(gray)
+        (h, w) = gray.shape[:2]
+        if self.max_side is not None and max(h, w) > self.max_side:
+            scale = self.max_side / max(h, w)
+            gray = cv2.resize(gray, (max(round(w * scale), 1), max(round(h * scale), 1)),
+                              interpolation=cv2.INTER_AREA)
+        gray.flags.writeable = False
+        return gray
+
+    def compare(self, grayA, grayB):
+        """SSIM of two prepared images, or 0 if their shapes differ"""
+        if grayA.shape != grayB.shape or min(grayA.shape) < SSIM_WIN_SIZE:
+            return 0
+        if self.method == BOX:
+            return ssim_box(grayA, grayB, mask=self.mask(grayA))
+        if self.roi is None:
+            return compare_ssim(grayA, grayB)
+        (_, s) = compare_ssim(grayA, grayB, full=True)
+        return masked_mean(s, self.mask(grayA), (SSIM_WIN_SIZE - 1) // 2)
+
+    def similarity(self, imageA, imageB):
+        return self.compare(self.prepare(imageA), self.prepare(imageB))
+
+
+class SimilarityCascade:
+    """Compares frames against a threshold score in tiers, most of which are cheap:
+    1. If the thumbnails' SSIM is at least band above the threshold and the dHashes
+       differ by at most DHASH_NEAR bits, the frames are similar.
+    2. If the thumbnails' SSIM is more than band below the threshold, they are not.
+    3. Otherwise the full SSIM is computed with engine.
+    similarity() returns a score on the same side of the threshold as the full SSIM,
+    but in tiers 1 and 2 it is the thumbnail SSIM, not the full one.
+    counts records how many comparisons were settled by each tier.
+
+    :param score: the threshold
+    :param band: (below, above) the threshold, where the thumbnails cannot decide
+    :param roi: compare only the region of interest
+    """
+    def __init__(self, score, *, engine=None, band=DEFAULT_BAND, thumb_side=DEFAULT_THUMB_SIDE, roi=None):
+        self.score = score
+        if engine is None and roi is not None:
+            engine = SimilarityEngine(roi=roi)
+        self.engine = engine
+        self.roi = roi
+        self.band = band
+        self.thumb_side = thumb_side
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def count(self, tier):
+        with self.lock:
+            self.counts[tier] += 1
+
+    def compare(self, sigA, sigB, full):
+        """Compare two signatures; full() returns the full SSIM when it is needed."""
+        (hashA, thumbA) = sigA
+        (hashB, thumbB) = sigB
+        if thumbA.shape == thumbB.shape:
+            quick = SimilarityEngine(max_side=None, roi=self.roi).compare(thumbA, thumbB)
+            if quick >= self.score + self.band[1] and bin(hashA ^ hashB).count('1') <= DHASH_NEAR:
+                self.count('similar')
+                return quick
+            if quick < self.score - self.band[0]:
+                self.count('dissimilar')
+                return quick
+        self.count('full')
+        return full()
 
+    def similarity(self, f1, f2):
+        """Similarity of two Frames, judged against the threshold"""
+        if f2 is None:
+            return 0
+        return self.compare(f1.signature(self.thumb_side, self.roi), f2.signature(self.thumb_side, self.roi),
+                            lambda: f1.similarity(f2, self.engine))
 
 
 def show(imageA, imageB, diff):
@@ -64,5 +250,5 @@ if __name__=="__main__":
     imageA = cv2.imread(args.first)
     imageB = cv2.imread(args.second)
 
-    (score,diff) = img_sim(imageA, imageB)
-    show(imageA, imageB, diff)
+    (score,diff) = compare_ssim(grayscale(imageA), grayscale(imageB), full=True)
+    show(imageA, imageB, (diff * 255).astype("uint8"))
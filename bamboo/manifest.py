@@ -0,0 +1,220 @@
+"""
+A manifest of the images in an archive, so that repeated runs do not rescan it.
+
+The archive is laid out as {root}/{camera}/{YYYY-MM}/{image} (see README.md). The manifest
+is an SQLite file with a row for each image: its path, camera, size, modification time,
+capture time, dimensions, content hash (optional) and which stages have processed it.
+
+Manifest.update(root) - brings the manifest up to date with the files under root.
+    A directory whose modification time has not changed since the last update is not
+    listed again: files added to, removed from or renamed in a directory change its
+    modification time, so only the directories with new images are read. The cost of
+    an update is a stat() per directory plus the work on the new images.
+Manifest.frames(...) - generates Frames for camera X between t1 and t2 that stage Y has not processed,
+    with their dimensions and times from the manifest, so no file is opened.
+Manifest.mark_processed(frames, stage) - records that stage has processed them.
+MarkProcessed(manifest, stage) - a pipeline Stage that does that for each frame it sees.
+
+Images replaced in place with the same name do not change the directory's modification time;
+use update(root, full=True) to check every file.
+"""
+
+import os
+import sys
+import sqlite3
+import threading
+import time
+import logging
+
+from .frame import Frame
+from .probe import ImageInfo,probe
+from .scan import scan_dir
+from .stage import Stage
+from .source import frame_time
+from .hashindex import hash_index
+
+class Manifest:
+    """The images under one or more roots, and what has been done with them.
+    :param db_path: the SQLite file, or ':memory:' for a manifest that lasts only this run.
+    Each thread and each process has its own connection."""
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.conn()             # create the tables now, so errors show up here
+
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            if self.db_path != ':memory:':
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS dirs "
+                             "(path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)")
+                conn.execute("CREATE TABLE IF NOT EXISTS frames "
+                             "(path TEXT PRIMARY KEY, dir TEXT, camera TEXT, mime_type TEXT, size INTEGER, "
+                             "mtime_ns INTEGER, time REAL, width INTEGER, height INTEGER, depth INTEGER, hash TEXT)")
+                conn.execute("CREATE INDEX IF NOT EXISTS frames_camera_time ON frames (camera, time)")
+                conn.execute("CREATE INDEX IF NOT EXISTS frames_dir ON frames (dir)")
+                conn.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)")
+                conn.execute("CREATE TABLE IF NOT EXISTS processed "
+                             "(path TEXT, stage TEXT, time REAL, PRIMARY KEY (path, stage))")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def __len__(self):
+        return self.conn().execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+
+    ################################################################
+    ## Updating
+
+    def update(self, root, *, camera=None, full=False, hashes=False):
+        """Bring the manifest up to date with the images under root.
+        :param camera: the camera of every image under root. By default, the camera of an
+                       image is the first directory of its path under root.
+        :param full: list every directory, even those that have not changed.
+        :param hashes: record the content hash of each new image (this reads all of it).
+        Returns the number of images added or changed.
+        """
+        root = os.path.abspath(root)
+        conn = self.conn()
+        changed = 0
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError as e:
+                print(f"Cannot read '{path}': {e}",file=sys.stderr)
+                self.forget(path)
+                continue
+            row = conn.execute("SELECT mtime_ns FROM dirs WHERE path=?", (path,)).fetchone()
+            if row is not None and row[0] == mtime_ns and not full:
+                subdirs = [r[0] for r in conn.execute("SELECT path FROM dirs WHERE parent=?", (path,))]
+            else:
+                (files, subdirs) = scan_dir(path)
+                changed += self.update_dir(path, files, root, camera, hashes)
+                with conn:
+                    for gone in conn.execute("SELECT path FROM dirs WHERE parent=?", (path,)).fetchall():
+                        if gone[0] not in subdirs:
+                            self.forget(gone[0])
+                    conn.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime_ns) VALUES (?,?,?)",
+                                 (path, os.path.dirname(path) if path != root else None, mtime_ns))
+            stack.extend(reversed(subdirs))
+        return changed
+
+    def update_dir(self, path, files, root, camera, hashes):
+        """Record the images listed in directory path, and forget those that are gone"""
+        conn = self.conn()
+        known = {p: (size, mtime_ns) for (p, size, mtime_ns)
+                 in conn.execute("SELECT path, size, mtime_ns FROM frames WHERE dir=?", (path,))}
+        rows = []
+        for (fpath, mtype, st) in files:
+            if known.pop(fpath, None) == (st.st_size, st.st_mtime_ns):
+                continue
+            try:
+                info = probe(fpath) if mtype.startswith('image/') else None
+                digest = hash_index().hash(fpath) if hashes else None
+            except OSError as e:
+                print(f"Cannot read '{fpath}': {e}",file=sys.stderr)
+                continue
+            (w, h) = info.display_size if info is not None and info.width is not None else (None, None)
+            rows.append((fpath, path, camera if camera is not None else camera_of(fpath, root), mtype,
+                         st.st_size, st.st_mtime_ns, frame_time(fpath, info, st),
+                         w, h, info.components if info is not None else None, digest))
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO frames "
+                             "(path, dir, camera, mime_type, size, mtime_ns, time, width, height, depth, hash) "
+                             "VALUES (?,?,?,?,?,?,?,?,?,?,?)", rows)
+            # changed files need processing again; removed ones are forgotten
+            conn.executemany("DELETE FROM processed WHERE path=?", [(r[0],) for r in rows] + [(p,) for p in known])
+            conn.executemany("DELETE FROM frames WHERE path=?", [(p,) for p in known])
+        if rows or known:
+            logging.info("manifest %s: %s new or changed, %s removed", path, len(rows), len(known))
+        return len(rows)
+
+    def forget(self, path):
+        """Remove directory path and everything under it"""
+        conn = self.conn()
+        under = path.rstrip(os.sep) + os.sep
+        n = len(under)
+        # substr() rather than LIKE, which would take _ and % in names as wildcards
+        with conn:
+            conn.execute("DELETE FROM processed WHERE substr(path, 1, ?)=?", (n, under))
+            conn.execute("DELETE FROM frames WHERE dir=? OR substr(dir, 1, ?)=?", (path, n, under))
+            conn.execute("DELETE FROM dirs WHERE path=? OR substr(path, 1, ?)=?", (path, n, under))
+
+    ################################################################
+    ## Queries
+
+    def frames(self, *, camera=None, start=None, end=None, unprocessed_by=None, limit=None):
+        """Generate Frames in time order.
+        :param camera: only frames of this camera
+        :param start, end: only frames taken in [start, end), each a datetime or seconds since the epoch
+        :param unprocessed_by: only frames that this stage has not processed
+        """
+        query = "SELECT path, mime_type, time, width, height, depth FROM frames"
+        (where, args) = ([], [])
+        if camera is not None:
+            where.append("camera=?")
+            args.append(camera)
+        if start is not None:
+            where.append("time>=?")
+            args.append(start.timestamp() if hasattr(start, 'timestamp') else start)
+        if end is not None:
+            where.append("time<?")
+            args.append(end.timestamp() if hasattr(end, 'timestamp') else end)
+        if unprocessed_by is not None:
+            where.append("NOT EXISTS (SELECT 1 FROM processed WHERE processed.path=frames.path AND stage=?)")
+            args.append(unprocessed_by)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY time, path"
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        for (path, mtype, t, w, h, depth) in self.conn().execute(query, args).fetchall():
+            f = Frame(path=path, mime_type=mtype, mtime=t)
+            if w is not None:
+                f.probe_dimensions(ImageInfo(width=w, height=h, components=depth))
+            yield f
+
+    def hash(self, path):
+        """The content hash recorded for path, or None"""
+        row = self.conn().execute("SELECT hash FROM frames WHERE path=?", (os.path.abspath(path),)).fetchone()
+        return row[0] if row else None
+
+    def mark_processed(self, frames, stage):
+        """Record that stage has processed frames (Frames or paths)"""
+        now = time.time()
+        conn = self.conn()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO processed (path, stage, time) VALUES (?,?,?)",
+                             [(os.path.abspath(f.path if isinstance(f, Frame) else f), stage, now)
+                              for f in frames])
+
+    def processed(self, path, stage):
+        """True if stage has processed path"""
+        return self.conn().execute("SELECT 1 FROM processed WHERE path=? AND stage=?",
+                                   (os.path.abspath(path), stage)).fetchone() is not None
+
+
+def camera_of(path, root):
+    """The camera of an image in the archive: the first directory of its path under root"""
+    parts = os.path.relpath(path, root).split(os.sep)
+    return parts[0] if len(parts) > 1 else None
+
+
+class MarkProcessed(Stage):
+    """Record in a manifest that the frames reaching this stage have been processed by stage_name"""
+    def __init__(self, manifest, stage_name):
+        super().__init__()
+        self.manifest = manifest
+        self.stage_name = stage_name
+
+    def process(self, f:Frame):
+        if f.path is not None:
+            self.manifest.mark_processed([f], self.stage_name)
+        self.output(f)
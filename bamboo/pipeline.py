@@ -10,25 +10,168 @@ import sys
 from abc import ABC,abstractmethod
 import atexit
 import logging
+import threading
+import copy
+import concurrent.futures
+import asyncio
+import inspect
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
 
 from .frame import Frame
-from .stage import Connect
+from .stage import Connect,BatchStage
+from .trace import write_chrome_trace
+from .profiling import StageProfiler,CPROFILE,SAMPLE,CPROFILE_SEES_ALL_THREADS
+
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_CONCURRENCY = 8
+DEFAULT_MAX_PENDING = 256
+
+# What happens when a frame is queued for a stage whose queue is full
+BLOCK = 'block'                 # wait (or, in a single thread, run the stage) until there is room
+DROP_OLDEST = 'drop_oldest'     # discard the oldest waiting frame; good for live cameras
+
+def stage_option(options, stage, default):
+    """Look up a per-stage option by stage instance or by stage class name."""
+    if stage in options:
+        return options[stage]
+    return options.get(stage.__class__.__name__, default)
+
+
+class FrameQueue:
+    """The frames waiting at the input of a stage. Thread safe.
+    :param limit: maximum number of frames; None for no limit.
+    :param policy: BLOCK or DROP_OLDEST.
+    """
+    def __init__(self, limit=None, policy=BLOCK):
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError(f"unknown queue policy {policy}")
+        self.frames = collections.deque()
+        self.limit  = limit
+        self.policy = policy
+        self.high_water = 0     # most frames ever waiting
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full  = threading.Condition(self.lock)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def full(self):
+        return self.limit is not None and len(self.frames) >= self.limit
+
+    def put(self, f, force=False, on_drop=None):
+        """Add f, waiting for room if the policy is BLOCK.
+        Returns the number of frames dropped to make room. force ignores the limit.
+        on_drop(frame) is called for each frame that is dropped."""
+        dropped = 0
+        with self.lock:
+            while self.full() and not force:
+                if self.policy == DROP_OLDEST:
+                    (old, _) = self.frames.popleft()
+                    self.dropped += 1
+                    dropped += 1
+                    if on_drop is not None:
+                        on_drop(old)
+                else:
+                    self.not_full.wait()
+            self.frames.append((f, time.time()))
+            self.high_water = max(self.high_water, len(self.frames))
+            self.not_empty.notify()
+        return dropped
+
+    def get(self, block=True):
+        """Remove the oldest frame and return (frame, seconds it waited).
+        Raises IndexError if empty and not blocking."""
+        with self.lock:
+            while block and not self.frames:
+                self.not_empty.wait()
+            (f, t) = self.frames.popleft()
+            self.not_full.notify()
+            return (f, time.time() - t)
+
+    def get_batch(self, n, max_wait=None):
+        """Remove up to n frames and return a list of (frame, seconds it waited).
+        If blocking (max_wait is not None), wait for the first frame, and then up to
+        max_wait seconds for the batch to fill."""
+        with self.lock:
+            if max_wait is not None:
+                while not self.frames:
+                    self.not_empty.wait()
+                deadline = self.frames[0][1] + max_wait
+                while len(self.frames) < n and (remaining := deadline - time.time()) > 0:
+                    self.not_empty.wait(remaining)
+            now = time.time()
+            batch = [(f, now - t) for (f, t) in
+                     (self.frames.popleft() for i in range(min(n, len(self.frames))))]
+            self.not_full.notify(len(batch))
+            return batch
+
+    def oldest_age(self):
+        """Seconds that the oldest frame has been waiting"""
+        with self.lock:
+            return time.time() - self.frames[0][1] if self.frames else 0.0
 
 
 class Pipeline(ABC):
-    """Base pipeline class"""
-    def __init__(self):
-        self.queued_output_stage_frame_pairs = collections.deque()
+    """Base pipeline class.
+    Each stage has a FrameQueue of the frames waiting for it.
+
+    :param queue_limit: default maximum number of frames waiting at the input of each stage.
+    :param queue_policy: what to do when a queue is full: BLOCK or DROP_OLDEST.
+    :param queue_limits: dictionary of per-stage limits, keyed by stage or by stage class name.
+                         A value may be a limit or a (limit, policy) tuple.
+    :param trace: if not None, record a span for every stage call and write them to this
+                  path as Chrome trace JSON when the pipeline is closed.
+    :param profile_stages: set of stages or stage class names to profile. Only time inside
+                  process() is profiled. Profiles are written to profile_dir when the pipeline is closed.
+    :param profile_method: CPROFILE (writes {stage}.pstats) or SAMPLE (writes {stage}.collapsed).
+    """
+    def __init__(self, *, queue_limit=None, queue_policy=BLOCK, queue_limits=None, trace=None,
+                 profile_stages=None, profile_dir='.', profile_method=CPROFILE):
         self.head = None
         self.stages = set()
         self.count  = 0
+        self.queue_limit  = queue_limit
+        self.queue_policy = queue_policy
+        self.queue_limits = queue_limits if queue_limits is not None else {}
+        self.queues = {}        # stage -> FrameQueue, in the order that frames first reached them
+        self.trace  = trace
+        self.profile_stages = profile_stages if profile_stages is not None else set()
+        self.profile_dir = profile_dir
+        self.profiler = StageProfiler(profile_method) if self.profile_stages else None
+
+    def queue_for(self, stage):
+        """Return the queue of frames waiting for stage, creating it if needed."""
+        try:
+            return self.queues[stage]
+        except KeyError:
+            pass
+        limit = stage_option(self.queue_limits, stage, self.queue_limit)
+        policy = self.queue_policy
+        if isinstance(limit, tuple):
+            (limit, policy) = limit
+        if isinstance(stage, BatchStage) and limit is not None and limit < stage.batch_size:
+            # otherwise its batches could never fill
+            logging.warning("%s: raising its queue limit from %s to its batch size %s", stage, limit, stage.batch_size)
+            limit = stage.batch_size
+        return self.queues.setdefault(stage, FrameQueue(limit, policy))
 
     def queue_output_stage_frame_pair(self, pair):
-        self.queued_output_stage_frame_pairs.append(pair)
+        (s,f) = pair
+        self.queue_for(s).put(f)
 
     def addLinearPipeline(self, stages:list):
         self.head = stages[0]
         self.stages.update(stages)   # collect all stages for printing stats
+        for stage in stages:
+            if self.trace is not None and stage.spans is None:
+                stage.spans = []
+            if stage in self.profile_stages or stage.__class__.__name__ in self.profile_stages:
+                stage.profiler = self.profiler
         for i in range(len(stages)-1):
             stages[i].pipeline = self
             stages[i+1].pipeline = self
@@ -44,38 +187,642 @@ class Pipeline(ABC):
     def process_list(self, flist):
         for f in flist:
             self.process(f)
+        self.join()
 
     def process_stream(self, fstream):
         for f in fstream:
             self.process(f)
+        self.join()
+
+    def join(self):
+        """Wait until every queued frame has been processed."""
+
+    def close(self):
+        """Release any threads or processes held by the pipeline, and write the trace.
+        Subclasses call this after they have finished processing."""
+        if self.trace is not None:
+            write_chrome_trace(self.trace, self.stages)
+        if self.profiler is not None:
+            self.profiler.dump(self.profile_dir)
 
     def print_stats(self, out=sys.stdout):
         for stage in self.stages:
             name = stage.__class__.__name__
-            print(f"{name}: calls: {stage.count}  mean: {stage.t_mean:.2}s  stddev: {stage.t_stddev:.2}",
-                  file=out)
+            print(f"{name}: {stage.stats.summary()}", file=out)
+            if stage in self.queues:
+                q = self.queues[stage]
+                print(f"   queue high water: {q.high_water}  dropped: {q.dropped}", file=out)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
         self.print_stats(out=self.out)
         return self
 
 
 class SingleThreadedPipeline(Pipeline):
-    """Runs the pipeline in the caller's thread. Print stats on exit"""
-    def __init__(self, out=sys.stdout):
-        super().__init__()
+    """Runs the pipeline in the caller's thread. Print stats on exit.
+    When a BLOCK queue is full, the caller runs that stage until there is room."""
+    def __init__(self, out=sys.stdout, **kwargs):
+        super().__init__(**kwargs)
         self.out = out
 
-    def run_queue(self):
-        # Now pass to the next. This logic needs to be moved into the linear pipeline
-        # and have the output function store (s,f) pairs.
+    def queue_output_stage_frame_pair(self, pair):
+        (s,f) = pair
+        q = self.queue_for(s)
+        while q.full() and q.policy == BLOCK:
+            self.run_one(s, q)
+        q.put(f)
+
+    def run_one(self, s, q):
+        if isinstance(s, BatchStage):
+            (frames, waits) = zip(*q.get_batch(s.batch_size))
+            logging.debug("%s processing %d frames",s,len(frames))
+            s._run_batch(list(frames), list(waits))
+            return
+        (f, wait) = q.get(block=False)
+        logging.debug("%s processing %s",s,f)
+        s._run_frame(f, wait)
+
+    def runnable(self, s, q, flush):
+        """A batch stage waits for a full batch, or max_wait, or the end of the input."""
+        if not len(q):
+            return False
+        if flush or not isinstance(s, BatchStage):
+            return True
+        return len(q) >= s.batch_size or q.oldest_age() >= s.max_wait
+
+    def run_queue(self, flush=False):
+        # Run the most downstream work first, which keeps the fewest frames waiting.
         while True:
+            for (s,q) in reversed(list(self.queues.items())):
+                if self.runnable(s, q, flush):
+                    self.run_one(s, q)
+                    break
+            else:
+                return
+
+    def join(self):
+        self.run_queue(flush=True)
+
+    def close(self):
+        self.join()
+        super().close()
+
+
+_STOP = object()
+
+class ThreadedPipeline(Pipeline):
+    """Runs each stage on its own pool of worker threads. Stages are connected by
+    bounded queues, so a fast stage blocks rather than buffering frames without limit.
+    Stages with parallel=False get a single worker.
+    Threads help when stages run OpenCV or TensorFlow code that releases the GIL.
+
+    :param workers: default number of worker threads per stage.
+    :param stage_workers: dictionary of per-stage worker counts, keyed by stage or by stage class name.
+    :param queue_limit: the maximum number of frames waiting at the input of each stage.
+    Other queue options are as for Pipeline.
+    """
+    def __init__(self, out=sys.stdout, *, workers=None, stage_workers=None,
+                 queue_limit=DEFAULT_QUEUE_SIZE, **kwargs):
+        super().__init__(queue_limit=queue_limit, **kwargs)
+        self.out = out
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.stage_workers = stage_workers if stage_workers is not None else {}
+        self.threads = []
+        self.pending = 0        # frames queued or being processed
+        self.pending_cv = threading.Condition()
+        self.error = None
+        if self.profiler is not None and self.profiler.method == CPROFILE and CPROFILE_SEES_ALL_THREADS:
+            # the workers' profiles would each record every thread, and the second to start would raise
+            logging.warning("cProfile cannot profile stages in separate threads on Python %d.%d; sampling instead",
+                            *sys.version_info[:2])
+            self.profiler = StageProfiler(SAMPLE)
+
+    def start(self):
+        """Create the queues and start the workers. Called automatically by the first process()."""
+        for stage in self.stages:
+            stage.pipeline = self
+            self.queue_for(stage)
+            workers = stage_option(self.stage_workers, stage, self.workers) if stage.parallel else 1
+            for i in range(max(workers,1)):
+                t = threading.Thread(target=self.worker, args=(stage,), daemon=True,
+                                     name=f"{stage.__class__.__name__}-{i}")
+                t.start()
+                self.threads.append((stage,t))
+
+    def done(self, n=1):
+        """n frames have been processed or dropped"""
+        with self.pending_cv:
+            self.pending -= n
+            if self.pending == 0:
+                self.pending_cv.notify_all()
+
+    def worker(self, stage):
+        q = self.queues[stage]
+        while True:
+            if isinstance(stage, BatchStage):
+                batch = q.get_batch(stage.batch_size, stage.max_wait)
+            else:
+                batch = [q.get()]
+            stops = sum(1 for (f, _) in batch if f is _STOP)
+            # close() puts one _STOP for each worker; a batch may take several, so leave the others theirs
+            for _ in range(stops - 1):
+                q.put(_STOP, force=True)
+            frames = [f for (f, _) in batch if f is not _STOP]
+            waits  = [wait for (f, wait) in batch if f is not _STOP]
             try:
-                (s,f) = self.queued_output_stage_frame_pairs.popleft()
-            except IndexError:
+                if frames:
+                    logging.debug("%s processing %s",stage,frames)
+                    if isinstance(stage, BatchStage):
+                        stage._run_batch(frames, waits)
+                    else:
+                        stage._run_frame(frames[0], waits[0])
+            except Exception as e: # pylint: disable=broad-exception-caught
+                logging.exception("%s failed on %s",stage,frames)
+                if self.error is None:
+                    self.error = e
+            finally:
+                if frames:
+                    self.done(len(frames))
+            if stops:
+                break
+
+    def queue_output_stage_frame_pair(self, pair):
+        (s,f) = pair
+        with self.pending_cv:
+            self.pending += 1
+        dropped = self.queue_for(s).put(f)   # blocks when the next stage is behind
+        if dropped:
+            self.done(dropped)
+
+    def process(self, f):
+        if not self.threads:
+            self.start()
+        self.count += 1
+        self.queue_output_stage_frame_pair( (self.head, f))
+
+    def join(self):
+        with self.pending_cv:
+            while self.pending > 0:
+                self.pending_cv.wait()
+        if self.error is not None:
+            (e, self.error) = (self.error, None)
+            raise e
+
+    def close(self):
+        if not self.threads:
+            super().close()
+            return
+        self.join()
+        for (stage,t) in self.threads:
+            self.queues[stage].put(_STOP, force=True)
+        for (stage,t) in self.threads:
+            t.join()
+        self.threads = []
+        super().close()
+
+
+################################################################
+## Shared-memory frame transport for the ProcessPoolPipeline.
+## A frame whose image is held in memory is sent to another process as a
+## pickled copy without the image, plus a handle (name, offset, shape, strides, dtype)
+## that locates the image in a multiprocessing.shared_memory segment.
+## Frames that only have a path are sent as is; the other process reads the file.
+
+def attach_segment(name):
+    """Attach to an existing segment. Worker processes share the creator's resource tracker,
+    whose registrations are a set, so attaching does not need to be balanced."""
+    return shared_memory.SharedMemory(name=name)
+
+def segment_view(shm, handle):
+    """Return a read-only ndarray for handle inside segment shm.
+    The view holds a buffer export, so shm.close() raises BufferError rather than
+    unmapping memory that is still in use."""
+    (_, offset, shape, strides, dtype) = handle
+    img = np.ndarray(shape, dtype=dtype, buffer=np.frombuffer(shm.buf, dtype=np.uint8),
+                     offset=offset, strides=strides)
+    img.flags.writeable = False
+    return img
+
+def export_frame(f, segments):
+    """Return (packed, handle, new_segment) for sending f to another process.
+    :param segments: list of (shm, handle, view) for the images this process received.
+      An image that is a view into one of them is sent as a handle into the same segment,
+      without copying.
+    new_segment is the SharedMemory that was created for f's image, or None.
+    """
+    img = f.img_
+    if img is None:
+        return (f, None, None)
+    packed = copy.copy(f)
+    packed.img_ = None
+    for (shm, handle, view) in segments:
+        if np.may_share_memory(img, view):
+            base = view.__array_interface__['data'][0] - handle[1]
+            offset = img.__array_interface__['data'][0] - base
+            return (packed, (shm.name, offset, img.shape, img.strides, img.dtype.str), None)
+    shm = shared_memory.SharedMemory(create=True, size=max(img.nbytes,1))
+    dst = np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)
+    dst[...] = img
+    handle = (shm.name, 0, dst.shape, dst.strides, dst.dtype.str)
+    del dst
+    return (packed, handle, shm)
+
+_worker_stages = []         # the stages, as inherited or unpickled by each worker process
+_worker_lingering = []      # segments that could not be closed because a stage still holds a view
+
+class CapturePipeline:
+    """Stand-in pipeline used in a worker process; collects the outputs of one stage call."""
+    def __init__(self):
+        self.outputs = []
+    def queue_output_stage_frame_pair(self, pair):
+        self.outputs.append(pair)
+
+def worker_init(stages):
+    _worker_stages[:] = stages
+
+def worker_close(shm):
+    try:
+        shm.close()
+    except BufferError:
+        _worker_lingering.append(shm)
+
+def worker_run(index, items):
+    """Run stage index in a worker process on items, a list of (packed, handle, time queued).
+    A BatchStage gets all of them as one batch; other stages get one item.
+    Returns (report, outputs), where report has the stage's statistics, trace spans
+    and profile for this call."""
+    for shm in _worker_lingering[:]:
+        _worker_lingering.remove(shm)
+        worker_close(shm)
+    stage = _worker_stages[index]
+    segments = []
+    frames = []
+    t0 = time.time()
+    try:
+        for (packed, handle, _) in items:
+            if handle is not None:
+                shm = attach_segment(handle[0])
+                packed.img_ = segment_view(shm, handle)
+                segments.append((shm, handle, packed.img_))
+            frames.append(packed)
+        waits = [t0 - t for (_, _, t) in items]
+        capture = CapturePipeline()
+        stage.pipeline = capture
+        if isinstance(stage, BatchStage):
+            stage._run_batch(frames, waits)
+        else:
+            stage._run_frame(frames[0], waits[0])
+        outputs = []
+        for (s,f) in capture.outputs:
+            (out, out_handle, new_shm) = export_frame(f, segments)
+            if new_shm is not None:
+                new_shm.close()     # the parent owns it now
+            outputs.append((_worker_stages.index(s), out, out_handle))
+        return (stage.take_report(), outputs)
+    finally:
+        # drop our views so that the segments can be closed
+        shms = [shm for (shm, _, _) in segments]
+        items = packed = frames = capture = f = segments = None
+        for shm in shms:
+            worker_close(shm)
+
+
+class ProcessPoolPipeline(Pipeline):
+    """Runs stages in a pool of worker processes, so CPU-bound Python stages use every core.
+    Each call of a stage is a task; its output frames come back to the caller, which
+    sends them on to the next stages. Images move between processes in shared memory;
+    only the tags and history are pickled.
+    A BatchStage gets the frames that are ready for it, up to batch_size, as one task.
+    Stages with parallel=False run in the caller's process.
+
+    Frames wait for their stage in its queue, which applies the queue limit and policy.
+    Only the caller's process can empty a queue, so it does not wait on a full BLOCK queue:
+    the outputs of a task are queued even if that passes the limit. process() does not
+    return, and so the source is not read, until every queue is empty.
+
+    :param processes: number of worker processes.
+    :param max_pending: most stage calls outstanding at once; bounds the memory in flight.
+    :param start_method: multiprocessing start method. 'fork' inherits the stages.
+    Other options are as for Pipeline.
+    """
+    def __init__(self, out=sys.stdout, *, processes=None, max_pending=None, start_method=None, **kwargs):
+        super().__init__(**kwargs)
+        self.out = out
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.max_pending = max_pending if max_pending is not None else 2 * self.processes
+        if start_method is None:
+            start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.start_method = start_method
+        self.executor = None
+        self.stage_list = []
+        self.futures = {}                    # future -> (stage, [(packed, handle, time queued)])
+        self.segments = {}                   # name -> [SharedMemory, references]
+        self.error = None
+
+    def start(self):
+        self.stage_list = list(self.stages)
+        for stage in self.stage_list:
+            stage.pipeline = self
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context(self.start_method),
+            initializer=worker_init, initargs=(self.stage_list,))
+
+    def add_reference(self, handle, shm=None):
+        if handle is None:
+            return
+        name = handle[0]
+        if name not in self.segments:
+            self.segments[name] = [shm if shm is not None else attach_segment(name), 0]
+        self.segments[name][1] += 1
+
+    def release(self, handle):
+        if handle is None:
+            return
+        entry = self.segments[handle[0]]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.segments[handle[0]]
+            entry[0].unlink()
+            entry[0].close()
+
+    def enqueue(self, stage, packed, handle):
+        """Queue a packed frame for stage. A frame that the queue drops is released."""
+        q = self.queue_for(stage)
+        q.put((packed, handle), force=(q.policy == BLOCK), on_drop=lambda item: self.release(item[1]))
+
+    def queue_output_stage_frame_pair(self, pair):
+        """Called in this process by stages with parallel=False"""
+        (s,f) = pair
+        (packed, handle, shm) = export_frame(f, [])
+        self.add_reference(handle, shm)
+        self.enqueue(s, packed, handle)
+
+    def run_local(self, stage, items):
+        """Run a stage in this process. It gets its own copy of the image, because
+        stages like this are often sinks that keep their frames."""
+        frames = []
+        for (packed, handle, _) in items:
+            if handle is not None:
+                img = segment_view(self.segments[handle[0]][0], handle)
+                packed.img_ = img.copy()
+                packed.img_.flags.writeable = False
+                del img
+            frames.append(packed)
+        now = time.time()
+        waits = [now - t for (_, _, t) in items]
+        try:
+            if isinstance(stage, BatchStage):
+                stage._run_batch(frames, waits)
+            else:
+                stage._run_frame(frames[0], waits[0])
+        finally:
+            for (_, handle, _) in items:
+                self.release(handle)
+
+    def collect(self, future):
+        (stage, items) = self.futures.pop(future)
+        try:
+            (report, outputs) = future.result()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logging.error("%s failed: %s",stage,e)
+            if self.error is None:
+                self.error = e
+        else:
+            stage.merge_report(report)
+            for (index, packed, out_handle) in outputs:
+                self.add_reference(out_handle)
+                self.enqueue(self.stage_list[index], packed, out_handle)
+        for (_, handle, _) in items:
+            self.release(handle)
+
+    def waiting(self):
+        return any(len(q) for q in self.queues.values())
+
+    def take(self):
+        """Remove the next task from the queues: (stage, list of (packed, handle, time queued)),
+        or None if no frames are waiting. The most downstream stage goes first, which keeps
+        the fewest frames waiting. A batch stage gets as many of its frames as fit in a batch."""
+        for (stage, q) in reversed(list(self.queues.items())):
+            if len(q):
+                n = stage.batch_size if isinstance(stage, BatchStage) else 1
+                now = time.time()
+                return (stage, [(packed, handle, now - wait) for ((packed, handle), wait) in q.get_batch(n)])
+        return None
+
+    def pump(self, wait_all=False):
+        """Dispatch waiting frames; collect finished tasks."""
+        while self.waiting() or (wait_all and self.futures):
+            while len(self.futures) < self.max_pending and (task := self.take()) is not None:
+                (stage, items) = task
+                if stage.parallel:
+                    future = self.executor.submit(worker_run, self.stage_list.index(stage), items)
+                    self.futures[future] = (stage, items)
+                else:
+                    self.run_local(stage, items)
+            if not self.futures:
+                continue
+            if not wait_all and len(self.futures) < self.max_pending:
                 break
-            logging.debug("%s processing %s",s,f)
-            s._run_frame(f)
+            (done, _) = concurrent.futures.wait(self.futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                self.collect(future)
+
+    def process(self, f):
+        if self.executor is None:
+            self.start()
+        self.count += 1
+        (packed, handle, shm) = export_frame(f, [])
+        self.add_reference(handle, shm)
+        self.enqueue(self.head, packed, handle)
+        self.pump()
+
+    def join(self):
+        if self.executor is None:
+            return
+        self.pump(wait_all=True)
+        if self.error is not None:
+            (e, self.error) = (self.error, None)
+            raise e
+
+    def close(self):
+        if self.executor is None:
+            super().close()
+            return
+        try:
+            self.join()
+        finally:
+            self.executor.shutdown()
+            self.executor = None
+            for (shm, _) in self.segments.values():
+                shm.unlink()
+                shm.close()
+            self.segments = {}
+        super().close()
+
+
+class AsyncPipeline(Pipeline):
+    """Runs stage calls as asyncio tasks, for stages that wait on the network (S3, Rekognition, HTTP).
+    A stage whose process() is a coroutine (async def process) runs on the event loop;
+    other stages run in a thread pool. Each stage has at most `concurrency` calls in flight,
+    or 1 if it has parallel=False. A BatchStage is called, in the thread pool, with up to batch_size
+    frames once that many are waiting or the oldest has waited max_wait.
+
+    Frames wait for a free call in their stage's queue, which applies the queue limit and policy.
+    The event loop cannot wait on a full BLOCK queue, so the frame is queued anyway and the
+    source is not read until the queue has room again.
+
+    :param concurrency: default calls in flight per stage.
+    :param stage_concurrency: dictionary of per-stage limits, keyed by stage or by stage class name.
+    :param max_pending: most stage calls queued or in flight; the source is not read past this.
+    :param workers: threads for synchronous stages.
+    Stages are profiled with the sampling profiler, whatever profile_method is.
+    """
+    def __init__(self, out=sys.stdout, *, concurrency=DEFAULT_CONCURRENCY, stage_concurrency=None,
+                 max_pending=DEFAULT_MAX_PENDING, workers=None, **kwargs):
+        super().__init__(**kwargs)
+        self.out = out
+        self.concurrency = concurrency
+        self.stage_concurrency = stage_concurrency if stage_concurrency is not None else {}
+        self.max_pending = max_pending
+        self.workers = workers
+        self.loop = None
+        self.executor = None
+        self.semaphores = {}
+        self.filled = {}        # BatchStage -> asyncio.Event set when its queue holds a full batch
+        self.tasks = set()
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.changed = None     # asyncio.Event set when pending goes down
+        self.error = None
+        if self.profiler is not None and self.profiler.method == CPROFILE:
+            # coroutines take turns on the event loop's thread, and the other stages run in threads
+            logging.warning("cProfile cannot profile the stages of an AsyncPipeline; sampling instead")
+            self.profiler = StageProfiler(SAMPLE)
+
+    def semaphore(self, stage):
+        if stage not in self.semaphores:
+            limit = stage_option(self.stage_concurrency, stage, self.concurrency) if stage.parallel else 1
+            self.semaphores[stage] = asyncio.Semaphore(limit)
+        return self.semaphores[stage]
+
+    def queue_output_stage_frame_pair(self, pair):
+        """Called on the event loop by async stages and in the thread pool by synchronous ones."""
+        with self.pending_lock:
+            self.pending += 1
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.schedule(pair)
+        else:
+            self.loop.call_soon_threadsafe(self.schedule, pair)
+
+    def schedule(self, pair):
+        (stage, f) = pair
+        q = self.queue_for(stage)
+        dropped = q.put(f, force=(q.policy == BLOCK))
+        if dropped:
+            self.done(dropped)
+        if stage in self.filled and len(q) >= stage.batch_size:
+            self.filled[stage].set()
+        task = self.loop.create_task(self.run_stage(stage))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def done(self, n=1):
+        """n frames have been processed or dropped"""
+        with self.pending_lock:
+            self.pending -= n
+        self.changed.set()
+
+    async def wait_batch(self, stage, q):
+        """Wait until q holds a full batch for stage, or its oldest frame has waited max_wait"""
+        event = self.filled.setdefault(stage, asyncio.Event())
+        while 0 < len(q) < stage.batch_size and (remaining := stage.max_wait - q.oldest_age()) > 0:
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_stage(self, stage):
+        """Run stage on the oldest frame in its queue (or, for a BatchStage, a batch of them),
+        once the stage has a call free. There is a task for each frame queued, so there is one
+        for each frame that was not dropped; tasks that find the queue empty have nothing to do."""
+        async with self.semaphore(stage):
+            q = self.queues[stage]
+            if isinstance(stage, BatchStage):
+                await self.wait_batch(stage, q)
+                batch = q.get_batch(stage.batch_size)
+            else:
+                batch = [q.get(block=False)] if len(q) else []
+            if not batch:
+                return          # frames were dropped, or taken in a batch, while this task waited
+            frames = [f for (f, _) in batch]
+            waits  = [wait for (_, wait) in batch]
+            try:
+                logging.debug("%s processing %s",stage,frames)
+                if isinstance(stage, BatchStage):
+                    await self.loop.run_in_executor(self.executor, stage._run_batch, frames, waits)
+                elif inspect.iscoroutinefunction(stage.process):
+                    await stage._run_frame_async(frames[0], waits[0])
+                else:
+                    await self.loop.run_in_executor(self.executor, stage._run_frame, frames[0], waits[0])
+            except Exception as e: # pylint: disable=broad-exception-caught
+                logging.exception("%s failed on %s",stage,frames)
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.done(len(batch))
+
+    def backlogged(self):
+        """True if a BLOCK queue is full"""
+        return any(q.full() and q.policy == BLOCK for q in self.queues.values())
+
+    async def wait_pending(self, limit):
+        """Wait until no more than limit stage calls are queued or running, and no BLOCK queue is full"""
+        while self.pending > limit or self.backlogged():
+            self.changed.clear()
+            await self.changed.wait()
+
+    async def run_stream(self, fstream):
+        """Run every frame of fstream, which may be an iterable or an async iterable, through the pipeline.
+        Use this from code that is already running an event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.semaphores = {}
+        self.filled = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as self.executor:
+            for stage in self.stages:
+                stage.pipeline = self
+            if hasattr(fstream, '__aiter__'):
+                async for f in fstream:
+                    await self.wait_pending(self.max_pending - 1)
+                    self.count += 1
+                    self.queue_output_stage_frame_pair( (self.head, f))
+            else:
+                for f in fstream:
+                    await self.wait_pending(self.max_pending - 1)
+                    self.count += 1
+                    self.queue_output_stage_frame_pair( (self.head, f))
+            await self.wait_pending(0)
+        self.executor = None
+        self.loop = None
+        if self.error is not None:
+            (e, self.error) = (self.error, None)
+            raise e
+
+    def process(self, f):
+        self.process_stream([f])
+
+    def process_list(self, flist):
+        self.process_stream(flist)
+
+    def process_stream(self, fstream):
+        asyncio.run(self.run_stream(fstream))
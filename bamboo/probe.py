@@ -0,0 +1,379 @@
+"""
+Read image metadata from file headers without decoding pixels.
+
+probe(path) - An ImageInfo with the width, height, orientation and capture time of a
+              JPEG or HEIC file, or None. Only the headers are read.
+jpeg_dimensions - (width, height) from the SOF marker of JPEG data.
+jpeg_file_header - (width, height, components) of a JPEG file, reading only its header segments.
+
+JPEG: the dimensions come from the SOF segment, orientation and capture time from EXIF in APP1.
+HEIC: the dimensions come from the ispe property of the primary item, the orientation from its
+      irot property, and the capture time from the Exif item.
+"""
+
+import struct
+from datetime import datetime
+
+# Start-of-frame markers. C4 (DHT), C8 (JPG) and CC (DAC) share the range but are not SOF.
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+STANDALONE_MARKERS = set(range(0xD0, 0xDA)) | {0x01}    # RSTn, SOI, EOI and TEM have no length
+SOS  = 0xDA
+APP1 = 0xE1
+EXIF_HEADER = b'Exif\x00\x00'
+
+# EXIF tags
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+EXIF_TIME_FORMAT = "%Y:%m:%d %H:%M:%S"
+TIFF_ASCII = 2
+TIFF_SHORT = 3
+
+HEIC_BRANDS = {b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1'}
+IROT_ORIENTATION = {0:1, 1:8, 2:3, 3:6}     # irot turns anti-clockwise in 90 degree steps
+MAX_META_BOX = 16 * 1024 * 1024
+
+
+class ImageInfo:
+    """What probe() learns from the headers of an image file.
+    width and height are as stored; display_size is after applying orientation."""
+    __slots__ = ('width','height','components','orientation','capture_time')
+    def __init__(self, width=None, height=None, components=None, orientation=1, capture_time=None):
+        self.width = width
+        self.height = height
+        self.components = components
+        self.orientation = orientation      # EXIF orientation, 1-8
+        self.capture_time = capture_time    # datetime, local time
+
+    def __repr__(self):
+        return (f"<ImageInfo {self.width}x{self.height}x{self.components} "
+                f"orientation={self.orientation} capture_time={self.capture_time}>")
+
+    @property
+    def display_size(self):
+        """(width, height) once rotated as the orientation says. This is the shape OpenCV decodes to."""
+        if self.orientation in (5, 6, 7, 8):
+            return (self.height, self.width)
+        return (self.width, self.height)
+
+    @property
+    def timestamp(self):
+        """capture time in seconds since the epoch, or None"""
+        return self.capture_time.timestamp() if self.capture_time is not None else None
+
+
+################################################################
+## EXIF
+
+def parse_exif(tiff):
+    """Return (orientation, capture_time) from EXIF data in TIFF format.
+    DateTimeOriginal is preferred to DateTime. Damaged EXIF gives what could be read."""
+    orientation = 1
+    capture_time = None
+    if tiff[:2] == b'II':
+        e = '<'
+    elif tiff[:2] == b'MM':
+        e = '>'
+    else:
+        return (orientation, capture_time)
+
+    def entries(offset):
+        (count,) = struct.unpack_from(e+'H', tiff, offset)
+        for i in range(count):
+            yield struct.unpack_from(e+'HHI4s', tiff, offset + 2 + i*12)
+
+    def ascii_value(count, value):
+        if count > 4:
+            (offset,) = struct.unpack(e+'I', value)
+            value = tiff[offset:offset+count]
+        return value[:count].split(b'\x00')[0].decode('ascii', errors='replace')
+
+    def parse_time(s):
+        try:
+            return datetime.strptime(s.strip(), EXIF_TIME_FORMAT)
+        except ValueError:
+            return None
+
+    try:
+        (ifd0,) = struct.unpack_from(e+'I', tiff, 4)
+        exif_ifd = None
+        for (tag, typ, count, value) in entries(ifd0):
+            if tag == TAG_ORIENTATION and typ == TIFF_SHORT:
+                (orientation,) = struct.unpack(e+'H', value[:2])
+            elif tag == TAG_DATETIME and typ == TIFF_ASCII:
+                capture_time = parse_time(ascii_value(count, value))
+            elif tag == TAG_EXIF_IFD:
+                (exif_ifd,) = struct.unpack(e+'I', value)
+        if exif_ifd:
+            for (tag, typ, count, value) in entries(exif_ifd):
+                if tag == TAG_DATETIME_ORIGINAL and typ == TIFF_ASCII:
+                    capture_time = parse_time(ascii_value(count, value)) or capture_time
+    except struct.error:
+        pass
+    if not 1 <= orientation <= 8:
+        orientation = 1
+    return (orientation, capture_time)
+
+
+################################################################
+## JPEG
+
+def jpeg_segments(read):
+    """Yield (marker, length) for each segment of a JPEG up to the start of scan.
+    :param read: read(n) returns the next n bytes of the JPEG
+    The caller must read or skip the length bytes of payload before the next iteration.
+    Iteration stops early if the data is not a JPEG or is truncated."""
+    if read(2) != b'\xff\xd8':
+        return
+    while True:
+        b = read(2)
+        if len(b) < 2 or b[0] != 0xFF:
+            return
+        marker = b[1]
+        while marker == 0xFF:           # fill bytes
+            b = read(1)
+            if not b:
+                return
+            marker = b[0]
+        if marker in STANDALONE_MARKERS:
+            continue
+        b = read(2)
+        if len(b) < 2 or marker == SOS:
+            return
+        (length,) = struct.unpack(">H", b)
+        yield (marker, length - 2)
+
+def parse_sof(payload):
+    """Return (width, height, components) from the payload of a SOF segment"""
+    (height, width, components) = struct.unpack(">HHB", payload[1:6])
+    return (width, height, components)
+
+class BufferReader:
+    """read() and skip() over bytes in memory"""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+    def read(self, n):
+        b = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return bytes(b)
+    def skip(self, n):
+        self.pos += n
+    def seek(self, pos):
+        self.pos = pos
+
+class FileReader:
+    """read() and skip() over an open file, seeking past what is skipped"""
+    def __init__(self, f):
+        self.f = f
+    def read(self, n):
+        return self.f.read(n)
+    def skip(self, n):
+        self.f.seek(n, 1)
+    def seek(self, pos):
+        self.f.seek(pos)
+
+def jpeg_header(reader):
+    """Return (width, height, components) from the JPEG read by reader, or None"""
+    for (marker, length) in jpeg_segments(reader.read):
+        if marker in SOF_MARKERS:
+            payload = reader.read(length)
+            return parse_sof(payload) if len(payload) >= 6 else None
+        reader.skip(length)
+    return None
+
+def jpeg_dimensions(data):
+    """Return (width, height) of the JPEG in data, or None if data is not a JPEG
+    or is truncated before the SOF marker. Only the headers need to be present."""
+    header = jpeg_header(BufferReader(data))
+    return header[0:2] if header is not None else None
+
+def jpeg_file_header(path):
+    """Return (width, height, components) of a JPEG file, or None if it is not a JPEG.
+    Only the header segments are read; the EXIF thumbnail and the scan are skipped over."""
+    with open(path, "rb") as f:
+        return jpeg_header(FileReader(f))
+
+def probe_jpeg(reader):
+    info = None
+    exif = None
+    for (marker, length) in jpeg_segments(reader.read):
+        if marker == APP1 and exif is None and length > len(EXIF_HEADER):
+            head = reader.read(len(EXIF_HEADER))
+            if head == EXIF_HEADER:
+                exif = parse_exif(reader.read(length - len(EXIF_HEADER)))
+            else:
+                reader.skip(length - len(head))
+        elif marker in SOF_MARKERS:
+            payload = reader.read(length)
+            if len(payload) < 6:
+                return None
+            info = ImageInfo(*parse_sof(payload))
+            break                       # EXIF comes before the frame header
+        else:
+            reader.skip(length)
+    if info is not None and exif is not None:
+        (info.orientation, info.capture_time) = exif
+    return info
+
+
+################################################################
+## HEIC (ISO base media file format)
+
+def boxes(data, start=0, end=None):
+    """Yield (type, payload_start, payload_end) for the boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        (size, typ) = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, pos + 8)
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield (typ, pos + header, min(pos + size, end))
+        pos += size
+
+def parse_heic_meta(meta):
+    """Return (ImageInfo, exif_location) from the payload of the meta box.
+    exif_location is (offset, length) of the Exif item in the file, or None."""
+    children = {typ:(start, end) for (typ, start, end) in boxes(meta, 4)}   # meta is a full box
+    primary = None
+    if b'pitm' in children:
+        (start, _) = children[b'pitm']
+        primary = struct.unpack_from(">H" if meta[start] == 0 else ">I", meta, start + 4)[0]
+
+    # Find the Exif item
+    exif_item = None
+    if b'iinf' in children:
+        (start, end) = children[b'iinf']
+        skip = 6 if meta[start] == 0 else 8
+        for (typ, s, _) in boxes(meta, start + skip, end):
+            if typ == b'infe' and meta[s] >= 2:
+                (item_id, pos) = (struct.unpack_from(">H", meta, s + 4)[0], s + 6) if meta[s] == 2 else \
+                                 (struct.unpack_from(">I", meta, s + 4)[0], s + 8)
+                if meta[pos + 2:pos + 6] == b'Exif':
+                    exif_item = item_id
+
+    # Find where the Exif item is
+    exif_location = None
+    if b'iloc' in children and exif_item is not None:
+        (start, _) = children[b'iloc']
+        version = meta[start]
+        (sizes, more) = struct.unpack_from(">BB", meta, start + 4)
+        (offset_size, length_size, base_offset_size) = (sizes >> 4, sizes & 15, more >> 4)
+        index_size = more & 15 if version in (1, 2) else 0
+        pos = start + 6
+
+        def number(size):
+            nonlocal pos
+            value = int.from_bytes(meta[pos:pos + size], 'big') if size else 0
+            pos += size
+            return value
+
+        item_count = number(2 if version < 2 else 4)
+        for i in range(item_count):
+            item_id = number(2 if version < 2 else 4)
+            if version in (1, 2):
+                number(2)                # construction method
+            number(2)                    # data reference index
+            base_offset = number(base_offset_size)
+            extents = []
+            for j in range(number(2)):
+                number(index_size)
+                extents.append((base_offset + number(offset_size), number(length_size)))
+            if item_id == exif_item and extents:
+                exif_location = extents[0]
+                break
+
+    # Find the properties of the primary item
+    info = ImageInfo(components=3)
+    if b'iprp' in children:
+        (start, end) = children[b'iprp']
+        iprp = {typ:(s, e) for (typ, s, e) in boxes(meta, start, end)}
+        properties = [(typ, s) for (typ, s, _) in boxes(meta, *iprp[b'ipco'])] if b'ipco' in iprp else []
+        associated = range(1, len(properties) + 1)
+        if b'ipma' in iprp:
+            (s, _) = iprp[b'ipma']
+            (version, flags) = (meta[s], int.from_bytes(meta[s+1:s+4], 'big'))
+            (count,) = struct.unpack_from(">I", meta, s + 4)
+            pos = s + 8
+            for i in range(count):
+                if version < 1:
+                    (item_id,) = struct.unpack_from(">H", meta, pos)
+                    pos += 2
+                else:
+                    (item_id,) = struct.unpack_from(">I", meta, pos)
+                    pos += 4
+                n = meta[pos]
+                pos += 1
+                width = 2 if flags & 1 else 1
+                indices = [int.from_bytes(meta[pos + k*width:pos + (k+1)*width], 'big') & (0x7FFF if width == 2 else 0x7F)
+                           for k in range(n)]
+                pos += n * width
+                if item_id == primary:
+                    associated = indices
+        for index in associated:
+            if not 1 <= index <= len(properties):
+                continue
+            (typ, s) = properties[index - 1]
+            if typ == b'ispe' and info.width is None:
+                (info.width, info.height) = struct.unpack_from(">II", meta, s + 4)
+            elif typ == b'irot':
+                info.orientation = IROT_ORIENTATION[meta[s] & 3]
+    return (info, exif_location)
+
+def probe_heic(reader):
+    """Read the top-level boxes until the meta box, then the Exif item"""
+    while True:
+        header = reader.read(8)
+        if len(header) < 8:
+            return None
+        (size, typ) = struct.unpack(">I4s", header)
+        if size == 1:
+            (size,) = struct.unpack(">Q", reader.read(8))
+            size -= 8
+        if size < 8:
+            return None
+        if typ == b'meta':
+            if size > MAX_META_BOX:
+                return None
+            meta = reader.read(size - 8)
+            break
+        reader.skip(size - 8)
+    (info, exif_location) = parse_heic_meta(meta)
+    if exif_location is not None:
+        (offset, length) = exif_location
+        reader.seek(offset)
+        exif = reader.read(length)
+        if len(exif) >= 4:
+            (tiff_offset,) = struct.unpack(">I", exif[:4])     # the TIFF header follows "Exif\0\0"
+            (_, info.capture_time) = parse_exif(exif[4 + tiff_offset:])
+    return info
+
+
+def probe_reader(reader):
+    head = reader.read(12)
+    reader.seek(0)
+    if head[:2] == b'\xff\xd8':
+        return probe_jpeg(reader)
+    if head[4:8] == b'ftyp' and head[8:12] in HEIC_BRANDS:
+        try:
+            return probe_heic(reader)
+        except (struct.error, IndexError, KeyError):
+            return None
+    return None
+
+def probe(path):
+    """Return an ImageInfo for the JPEG or HEIC file at path, or None if it is neither
+    or its headers cannot be read. Pixels are never decoded."""
+    with open(path, "rb") as f:
+        return probe_reader(FileReader(f))
+
+def probe_bytes(data):
+    """Like probe(), for a file that is already in memory"""
+    return probe_reader(BufferReader(data))
@@ -0,0 +1,197 @@
+"""
+Per-stage profiling.
+
+A pipeline created with profile_stages={'Yolo8FaceTag'} attaches a StageProfiler to those
+stages. Only the time spent inside the stage's process() is profiled, so the results
+are not drowned out by directory walking and image decoding elsewhere in the program.
+When the pipeline closes, each profiled stage is written to profile_dir as:
+
+  {stage}.pstats     - cProfile statistics (method='cprofile'); view with pstats or snakeviz.
+  {stage}.collapsed  - collapsed stacks from a sampling profiler (method='sample');
+                       one "frame;frame;frame count" line per stack, for flamegraph.pl or speedscope.
+"""
+
+import os
+import sys
+import time
+import cProfile
+import pstats
+import threading
+import collections
+import logging
+
+CPROFILE = 'cprofile'
+SAMPLE = 'sample'
+DEFAULT_SAMPLE_INTERVAL = 0.005 # seconds
+
+# Since Python 3.12 cProfile is built on sys.monitoring: an enabled profile records the calls
+# of every thread, and enabling a second one while it is enabled raises ValueError.
+CPROFILE_SEES_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class ProfileData:
+    """cProfile statistics in the form pstats.Stats() accepts, so that
+    statistics from worker processes can be merged."""
+    def __init__(self, stats):
+        self.stats = stats
+    def create_stats(self):
+        pass
+
+
+class StageProfiler:
+    """Profiles calls of process() for the stages it is attached to.
+    Each thread has its own cProfile.Profile for each stage; a sampling thread
+    collects stacks from the threads that are inside a profiled stage.
+    Where CPROFILE_SEES_ALL_THREADS, cProfile can only be used by one thread at a time;
+    pipelines that run stages in several threads sample instead. Coroutines, which
+    take turns on the event loop's thread, can only be sampled."""
+    def __init__(self, method=CPROFILE, interval=DEFAULT_SAMPLE_INTERVAL):
+        if method not in (CPROFILE, SAMPLE):
+            raise ValueError(f"unknown profile method {method}")
+        self.method   = method
+        self.interval = interval
+        self.lock     = threading.Lock()
+        self.local    = threading.local()   # stack of profiles active in this thread
+        self.profiles = collections.defaultdict(list)                # stage name -> [Profile or ProfileData]
+        self.samples  = collections.defaultdict(collections.Counter) # stage name -> Counter of collapsed stacks
+        self.active   = {}                  # thread id -> profiled calls running in it
+        self.sampler_pid = None
+
+    def __getstate__(self):
+        """Only the settings are sent to worker processes"""
+        return {'method':self.method, 'interval':self.interval}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def name(stage):
+        return stage.__class__.__name__
+
+    def run(self, stage, func, *args):
+        """Call func(*args) while profiling it for stage."""
+        if self.method == SAMPLE:
+            return self.run_sampled(stage, func, *args)
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+            self.local.profiles = {}
+        prof = self.local.profiles.get(stage)
+        if prof is None:
+            prof = self.local.profiles[stage] = cProfile.Profile()
+            with self.lock:
+                self.profiles[self.name(stage)].append(prof)
+        # Only one profile can be active in a thread; pause the enclosing stage's
+        if stack:
+            stack[-1].disable()
+        stack.append(prof)
+        prof.enable()
+        try:
+            return func(*args)
+        finally:
+            prof.disable()
+            stack.pop()
+            if stack:
+                stack[-1].enable()
+
+    def enter(self):
+        """Note that a profiled call is running in this thread, starting the sampler if need be."""
+        if self.sampler_pid != os.getpid():   # first call in this process
+            self.sampler_pid = os.getpid()
+            self.active = {}
+            threading.Thread(target=self.sampler, daemon=True, name="StageProfiler").start()
+        tid = threading.get_ident()
+        self.active[tid] = self.active.get(tid, 0) + 1
+        return tid
+
+    def leave(self, tid):
+        self.active[tid] -= 1
+        if self.active[tid] == 0:
+            del self.active[tid]
+
+    def run_sampled(self, stage, func, *args):
+        tid = self.enter()
+        try:
+            return func(*args)
+        finally:
+            self.leave(tid)
+
+    async def run_async(self, stage, func, *args):
+        """Await func(*args) while sampling it for stage.
+        The coroutine is on the event loop's stack only while it runs, so only that time is sampled."""
+        if self.method != SAMPLE:
+            raise ValueError("coroutines can only be profiled with method='sample'")
+        tid = self.enter()
+        try:
+            return await func(*args)
+        finally:
+            self.leave(tid)
+
+    def sampler(self):
+        """Sample the stacks of the threads that are inside a profiled stage.
+        A stack is charged to the stage of the innermost run_sampled() or run_async() call in it;
+        a stack without one (an event loop between coroutines) is not counted."""
+        stops = (self.run_sampled.__code__, self.run_async.__code__)
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames() # pylint: disable=protected-access
+            for tid in list(self.active):
+                frame = frames.get(tid)
+                stack = []
+                while frame is not None and frame.f_code not in stops:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack and frame is not None:
+                    name = self.name(frame.f_locals['stage'])
+                    with self.lock:
+                        self.samples[name][";".join(reversed(stack))] += 1
+
+    def take(self, stage):
+        """Return and reset what has been gathered for stage, to send from a worker process."""
+        name = self.name(stage)
+        with self.lock:
+            if self.method == SAMPLE:
+                return self.samples.pop(name, None)
+            profiles = self.profiles.pop(name, [])
+        if not profiles:
+            return None
+        for prof in profiles:
+            prof.create_stats()
+        stats = pstats.Stats(*profiles)
+        self.local = threading.local()   # this thread's profiles were taken
+        return stats.stats
+
+    def merge(self, stage, data):
+        """Add what a worker process gathered for stage."""
+        if not data:
+            return
+        name = self.name(stage)
+        with self.lock:
+            if self.method == SAMPLE:
+                self.samples[name].update(data)
+            else:
+                self.profiles[name].append(ProfileData(data))
+
+    def dump(self, profile_dir):
+        """Write a file for each profiled stage; return the paths"""
+        os.makedirs(profile_dir, exist_ok=True)
+        paths = []
+        with self.lock:
+            if self.method == SAMPLE:
+                for (name, counter) in self.samples.items():
+                    path = os.path.join(profile_dir, name + ".collapsed")
+                    with open(path, "w") as f:
+                        for (stack, count) in sorted(counter.items()):
+                            f.write(f"{name};{stack} {count}\n")
+                    paths.append(path)
+            else:
+                for (name, profiles) in self.profiles.items():
+                    for prof in profiles:
+                        prof.create_stats()
+                    path = os.path.join(profile_dir, name + ".pstats")
+                    pstats.Stats(*profiles).dump_stats(path)
+                    paths.append(path)
+        for path in paths:
+            logging.info("wrote profile %s", path)
+        return paths
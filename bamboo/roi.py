@@ -0,0 +1,114 @@
+"""
+Regions of interest for fixed cameras.
+
+A camera looks at the same scene all the time. Some of it matters (a doorway, a parking space)
+and some of it does not (trees moving in the wind, a timestamp burned into the image).
+An ROI says which parts to look at:
+
+  include - polygons of the parts that matter. If there are none, the whole image matters.
+  exclude - polygons, within those, to ignore.
+
+Points are (x, y) fractions of the image width and height, so one ROI works at every
+resolution the image is decoded or reduced to. In the camera configuration:
+
+  cameras:
+    front:
+      roi:
+        include: [[[0.2, 0.3], [0.8, 0.3], [0.8, 1.0], [0.2, 1.0]]]
+        exclude: [[[0.0, 0.0], [0.3, 0.0], [0.3, 0.05], [0.0, 0.05]]]
+
+Work is saved by cropping to the bounding box of the included polygons before computing,
+and the mask removes the rest.
+"""
+
+import threading
+
+import cv2
+import numpy as np
+
+MASK_CACHE_SIZE = 16
+
+class ROI:
+    """Included and excluded polygons, in fractions of the image size"""
+    def __init__(self, include=(), exclude=()):
+        self.include = tuple(tuple((float(x), float(y)) for (x, y) in poly) for poly in include)
+        self.exclude = tuple(tuple((float(x), float(y)) for (x, y) in poly) for poly in exclude)
+        if self.include:
+            points = np.array([p for poly in self.include for p in poly])
+            (x0, y0) = np.clip(points.min(axis=0), 0.0, 1.0)
+            (x1, y1) = np.clip(points.max(axis=0), 0.0, 1.0)
+            self.box = (float(x0), float(y0), float(x1), float(y1))
+        else:
+            self.box = (0.0, 0.0, 1.0, 1.0)
+        self.masks = {}         # (w, h) -> mask of the box at that size
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Return an ROI from a camera's 'roi' configuration, or None if there is none"""
+        if not config:
+            return None
+        return cls(include=config.get('include', ()), exclude=config.get('exclude', ()))
+
+    def __repr__(self):
+        return f"<ROI include={self.include} exclude={self.exclude}>"
+
+    def __getstate__(self):
+        return {'include':self.include, 'exclude':self.exclude}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def key(self):
+        """Identifies the ROI, for caching"""
+        return (self.include, self.exclude)
+
+    def pixel_box(self, w, h):
+        """(x, y, w, h) in pixels of the bounding box of the included region of a w x h image"""
+        (x0, y0, x1, y1) = self.box
+        (px0, py0) = (int(np.floor(x0 * w)), int(np.floor(y0 * h)))
+        (px1, py1) = (max(int(np.ceil(x1 * w)), px0 + 1), max(int(np.ceil(y1 * h)), py0 + 1))
+        return (px0, py0, min(px1, w) - px0, min(py1, h) - py0)
+
+    def full_side(self, side):
+        """The longest side an image must have for the crop of it to have a longest side of at least side"""
+        (x0, y0, x1, y1) = self.box
+        return int(np.ceil(side / max(min(x1 - x0, y1 - y0), 1e-3)))
+
+    def crop(self, img):
+        """Return (view, (x, y)): the part of img in the bounding box, and where it starts"""
+        (x, y, w, h) = self.pixel_box(img.shape[1], img.shape[0])
+        return (img[y:y+h, x:x+w], (x, y))
+
+    def box_mask(self, w, h):
+        """Return a w x h mask of the bounding box: 255 where the image matters, 0 elsewhere"""
+        with self.lock:
+            mask = self.masks.get((w, h))
+        if mask is not None:
+            return mask
+        (x0, y0, x1, y1) = self.box
+        def points(poly):
+            # from fractions of the image to pixels of the box
+            return np.array([[(x - x0) / max(x1 - x0, 1e-9) * w, (y - y0) / max(y1 - y0, 1e-9) * h]
+                             for (x, y) in poly], dtype=np.float32).round().astype(np.int32)
+        if self.include:
+            mask = np.zeros((h, w), dtype=np.uint8)
+            cv2.fillPoly(mask, [points(poly) for poly in self.include], 255)
+        else:
+            mask = np.full((h, w), 255, dtype=np.uint8)
+        if self.exclude:
+            cv2.fillPoly(mask, [points(poly) for poly in self.exclude], 0)
+        mask.flags.writeable = False
+        with self.lock:
+            if len(self.masks) >= MASK_CACHE_SIZE:
+                self.masks.clear()
+            self.masks[(w, h)] = mask
+        return mask
+
+    def contains(self, x, y, w, h):
+        """True if pixel (x, y) of a w x h image is in the region that matters"""
+        (bx, by, bw, bh) = self.pixel_box(w, h)
+        if not (bx <= x < bx + bw and by <= y < by + bh):
+            return False
+        return self.box_mask(bw, bh)[int(y - by), int(x - bx)] > 0
@@ -0,0 +1,92 @@
+"""
+Listing directories of frames.
+
+scan(root) - yields (path, mime_type, stat) for each non-empty image and video under root,
+             in the order of os.walk() with sorted names: the files of a directory, then each
+             of its subdirectories in turn.
+
+It is built on os.scandir(), which gets the type of each entry from the directory listing,
+and looks up extensions in a table made once rather than calling mimetypes.guess_type()
+for every file. Each file is stat'ed once; the stat is passed along so its size and
+modification time need not be read again.
+
+With threads > 1, subdirectories are listed in a thread pool ahead of the consumer,
+which hides the latency of network filesystems. The order is the same.
+"""
+
+import os
+import sys
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+
+FRAME_TYPES = ('image', 'video')
+
+def frame_types():
+    """Return {extension: mime type} for the image and video types mimetypes knows"""
+    mimetypes.init()
+    types = {}
+    for (ext, mtype) in mimetypes.types_map.items():
+        if mtype.split("/")[0] in FRAME_TYPES:
+            types.setdefault(ext.lower(), mtype)
+    return types
+
+FRAME_EXTENSIONS = frame_types()
+
+def frame_type(name):
+    """The mime type of an image or video file name, or None"""
+    return FRAME_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+
+def scan_dir(path):
+    """List one directory. Returns (files, subdirs), each sorted by name:
+    files is a list of (path, mime_type, stat) of the non-empty images and videos,
+    subdirs a list of the paths of the subdirectories (symbolic links are not followed, as in os.walk)."""
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append((entry.name, entry.path))
+                        continue
+                    mtype = frame_type(entry.name)
+                    if mtype is None or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError as e:
+                    print(f"Cannot read '{entry.path}': {e}",file=sys.stderr)
+                    continue
+                if st.st_size > 0:
+                    files.append((entry.name, entry.path, mtype, st))
+    except OSError as e:
+        print(f"Cannot list '{path}': {e}",file=sys.stderr)
+    files.sort()
+    subdirs.sort()
+    return ([(p, mtype, st) for (_, p, mtype, st) in files], [p for (_, p) in subdirs])
+
+def scan(root, threads=1):
+    """Generate (path, mime_type, stat) for the images and videos under root, in sorted order.
+    :param threads: list subdirectories in this many threads.
+    """
+    if threads <= 1:
+        def walk(path):
+            (files, subdirs) = scan_dir(path)
+            yield from files
+            for d in subdirs:
+                yield from walk(d)
+        yield from walk(root)
+        return
+
+    pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='scan')
+    def walk_ahead(fut):
+        (files, subdirs) = fut.result()
+        # start listing the subdirectories while the files of this one are consumed
+        futs = [pool.submit(scan_dir, d) for d in subdirs]
+        yield from files
+        for f in futs:
+            yield from walk_ahead(f)
+    try:
+        yield from walk_ahead(pool.submit(scan_dir, root))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
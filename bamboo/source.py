@@ -1,8 +1,21 @@
 """
 This module provides the following functions:
 
-FrameStream(root) - A generator of frames from a root
+FrameStream(root) - A generator of frames from a root. Image headers are probed for their
+                    dimensions and capture time; pixels are not decoded.
+                    Directories are listed with scan.scan(); with SourceOptions(scan_threads=n),
+                    subdirectories are listed in n threads.
 DissimilarFrameStream(root, score=0.90) - Generates a stream of frames that have a similarity score less than socre
+                    With SourceOptions(threads=n), frames ahead of the consumer are decoded and
+                    compared in n threads.
+MotionFrameStream(root) - Generates the frames in which something moved, tagged with where.
+CameraFrameStream(camera) - Generates frames from one camera as fast as they are read.
+                    For several live cameras, see cameras.MultiCameraSource.
+Prefetch(source)  - Wraps any of these, reading and decoding the images of frames ahead of the
+                    consumer in a thread pool, so that they are in the frame cache when wanted.
+VideoFrameStream(path) - Generates frames of a video, decoded by ffmpeg and sampled as
+                    SourceOptions.sampling says (see video.py). FrameStream(path) of a video
+                    file does the same, as does FrameStream(root) for each video under root.
 
 Details:
 https://stackoverflow.com/questions/11420748/setting-camera-parameters-in-opencv-python
@@ -19,95 +32,338 @@ import copy
 import mimetypes
 import logging
 import pickle
+import collections
+import itertools
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 import hashlib
 
-from .frame import Frame
+from .frame import Frame,Patch,filename_time,TAG_MOTION
+from .probe import probe
+from .scan import scan
+from .video import ffmpeg_frames
 from .constants import C
-from .image_utils import img_sim
+from .image_utils import SimilarityCascade,SimilarityEngine
 
 DEFAULT_SCORE = 0.90
+LOOKAHEAD_PER_THREAD = 4
+DEFAULT_PREFETCH_DEPTH = 8
+DEFAULT_PREFETCH_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_MOTION_THRESHOLD = 0.002    # fraction of the image that must move
+DEFAULT_MOTION_SIDE = 320
+MOTION_HISTORY = 120                # frames the background model remembers
+MOTION_FOREGROUND = 255             # MOG2 marks shadows 127
 class SourceOptions:
-    __slots__=('limit','sampling','mime_type','score','frameWidth','frameHeight')
+    """Options for the sources.
+    sampling   - which frames of a video: None (all), 'fps=N', 'every=N' or 'keyframes' (see video.py).
+    frameWidth, frameHeight - the size video frames are scaled to, if both are given.
+    start, end - only frames taken in [start, end) are generated. Each is a datetime or
+                 seconds since the epoch.
+    prefilter  - DissimilarFrameStream compares cheap signatures first (see SimilarityCascade)
+                 and computes the full similarity only when they cannot decide.
+    threads    - DissimilarFrameStream compares this many frames at once.
+    motion_threshold - MotionFrameStream generates frames in which at least this fraction of the image moved.
+    motion_side - MotionFrameStream models the background at this resolution (longest side).
+    roi        - DissimilarFrameStream compares only this region of interest (see roi.py).
+    scan_threads - FrameStream lists subdirectories in this many threads.
+    """
+    __slots__=('limit','sampling','mime_type','score','frameWidth','frameHeight','start','end','prefilter',
+               'threads','motion_threshold','motion_side','roi','scan_threads')
     def __init__(self,**kwargs):
+        self.limit = None
+        self.sampling = None
+        self.mime_type = None
         self.score = DEFAULT_SCORE
         self.frameWidth = None
         self.frameHeight = None
-        for (k,v) in kwargs:
+        self.start = None
+        self.end = None
+        self.prefilter = True
+        self.threads = 1
+        self.motion_threshold = DEFAULT_MOTION_THRESHOLD
+        self.motion_side = DEFAULT_MOTION_SIDE
+        self.roi = None
+        self.scan_threads = 1
+        for (k,v) in kwargs.items():
             setattr(self,k,v)
 
+    def in_window(self, t):
+        """Return True if time t (seconds since the epoch) is within [start, end)"""
+        start = self.start.timestamp() if isinstance(self.start, datetime) else self.start
+        end   = self.end.timestamp()   if isinstance(self.end, datetime)   else self.end
+        return (start is None or t >= start) and (end is None or t < end)
+
+
+def frame_time(path, info, st=None):
+    """The time a frame was taken: from its name, then its EXIF, then the file's modification time.
+    :param st: the stat of path, if it has been read already"""
+    t = filename_time(path)
+    if t is None and info is not None:
+        t = info.timestamp
+    if t is None:
+        t = st.st_mtime if st is not None else os.path.getmtime(path)
+    return t
+
 
 def FrameFromFile(path, o=SourceOptions()):
-    if o.mime_type is None:
-        o.mine_type = mimetypes.guess_type(path)[0].split("/")[0]
-    if o.mime_type == 'image':
-        return Frame(path)
-    elif o.mime_type == 'video':
-        cap = cv2.VideoCapture(path)
-        for ct in enumerate():
-            ret, img = cap.read()
-            if not ret:
-                break
-            yield frame.Frame(img = img,
-                              src=pathlib.Path(absolute_path_string).as_uri() + "?frame="+ct)
+    """Generate the frame of an image file, or the frames of a video file"""
+    mtype = o.mime_type or (mimetypes.guess_type(path)[0] or '').split("/")[0]
+    if mtype == 'image':
+        yield Frame(path=path)
+    elif mtype == 'video':
+        yield from VideoFrameStream(path, o)
+
+def VideoFrameStream(path, o=SourceOptions()):
+    """Generate frames of the video at path, sampled as o.sampling says.
+    Each frame's uri is that of the file with its time in the video as a media fragment
+    (file:///.../video.mp4#t=12.345); its mtime is that time after the start of the video,
+    which is taken from the file name or, failing that, the file's modification time."""
+    uri = pathlib.Path(os.path.abspath(path)).as_uri()
+    start = frame_time(path, None)
+    size = (o.frameWidth, o.frameHeight) if o.frameWidth and o.frameHeight else None
+    count = 0
+    for (img, pts_time) in ffmpeg_frames(path, sampling=o.sampling, size=size):
+        t = start + pts_time
+        if not o.in_window(t):
+            continue
+        f = Frame(img=img, mtime=t)
+        f.uri = f"{uri}#t={pts_time:.3f}"
+        yield f
+        count += 1
+        if o.limit is not None and count >= o.limit:
+            break
+
 
+def probe_frame(path, mtype, o, st=None):
+    """Return a Frame for path with its dimensions and time filled in from the headers,
+    or None if it is outside the time window of o."""
+    info = probe(path) if mtype.startswith('image/') else None
+    t = frame_time(path, info, st)
+    if not o.in_window(t):
+        return None
+    f = Frame(path=path, mime_type=mtype, mtime=t)
+    if info is not None:
+        f.probe_dimensions(info)
+    return f
 
 def FrameStream(root, o=SourceOptions()):
     """Generator for a series of Frame() objects from a disk file.
     Returns frames in sort order within each directory"""
     if os.path.isdir(root):
-        for (dirpath, dirnames, filenames) in os.walk(root): # pylint: disable=unused-variable
-            dirnames.sort()                                  # makes the directories recurse in sort order
-            for fname in sorted(filenames):
-                mtype = mimetypes.guess_type(fname)[0]
-                if mtype is None:
-                    continue
-                if mtype.split("/")[0] in ['video','image']:
-                    path = os.path.join(dirpath, fname)
-                    if os.path.getsize(path)>0:
-                        try:
-                            f = Frame(path=path, mime_type=mtype)
-                        except FileNotFoundError as e:
-                            print(f"Cannot read '{path}': {e}",file=sys.stderr)
-                            continue
-                        yield f
+        for (path, mtype, st) in scan(root, o.scan_threads):
+            if mtype.startswith('video/'):
+                try:
+                    yield from VideoFrameStream(path, o)
+                except (OSError, RuntimeError) as e:   # no ffmpeg, or it cannot decode the file
+                    print(f"Cannot read '{path}': {e}",file=sys.stderr)
+                continue
+            try:
+                f = probe_frame(path, mtype, o, st)
+            except OSError as e:
+                print(f"Cannot read '{path}': {e}",file=sys.stderr)
+                continue
+            if f is not None:
+                yield f
     else:
-        yield Frame(path=root)
+        mtype = mimetypes.guess_type(root)[0] or ''
+        if mtype.startswith('video/'):
+            yield from VideoFrameStream(root, o)
+            return
+        f = probe_frame(root, mtype, o)
+        if f is not None:
+            yield f
 
-def DissimilarFrameStream(root, o=SourceOptions):
+def compare_or_none(compare, f, ref):
+    """Return compare(f, ref), or None if f cannot be read"""
+    try:
+        return compare(f, ref)
+    except cv2.error as e: # pylint: disable=catching-non-exception
+        print(f"Error: {e} with {f.path}",file=sys.stderr)
+    except FileNotFoundError as e:
+        print(f"Cannot read '{f.path}': {e}",file=sys.stderr)
+    return None
+
+def similarities(frames, compare, o):
+    """Yield (f, similarity of f to the last frame kept) for each frame, in order.
+    A frame is kept if its similarity is less than o.score."""
     ref = None
-    count = 0
-    for f in FrameStream(root):
+    for f in frames:
+        st = compare_or_none(compare, f, ref)
+        yield (f, st)
+        if st is not None and st < o.score:
+            ref = f
+
+def similarities_lookahead(frames, compare, o):
+    """Like similarities(), but the frames ahead of the consumer are compared in o.threads threads.
+    They are compared with the current reference, on the bet that it will not change: most frames
+    are skipped. When a frame is kept, the comparisons in flight are made again with the new reference,
+    so the results are the same as similarities()."""
+    frames = iter(frames)
+    ref = None
+    pending = collections.deque()       # (frame, future), all compared with ref
+    with ThreadPoolExecutor(o.threads, thread_name_prefix="DissimilarFrameStream") as pool:
+        def submit(f):
+            pending.append((f, pool.submit(compare_or_none, compare, f, ref)))
         try:
-            st = f.similarity(ref)
-        except cv2.error as e: # pylint: disable=catching-non-exception
-            print(f"Error: {e} with {f.path}",file=sys.stderr)
-            continue
-        except FileNotFoundError as e:
-            print(f"Cannot read '{f.path}': {e}",file=sys.stderr)
+            for f in itertools.islice(frames, o.threads * LOOKAHEAD_PER_THREAD):
+                submit(f)
+            while pending:
+                (f, future) = pending.popleft()
+                st = future.result()
+                yield (f, st)
+                if st is not None and st < o.score:
+                    ref = f
+                    for (_, fut) in pending:
+                        fut.cancel()
+                    stale = [g for (g, _) in pending]
+                    pending.clear()
+                    for g in stale:
+                        submit(g)
+                g = next(frames, None)
+                if g is not None:
+                    submit(g)
+        finally:
+            for (_, fut) in pending:
+                fut.cancel()
+
+def DissimilarFrameStream(root, o=SourceOptions()):
+    count = 0
+    cascade = SimilarityCascade(o.score, roi=o.roi) if o.prefilter else None
+    engine = SimilarityEngine(roi=o.roi) if o.roi is not None else None
+    compare = cascade.similarity if cascade else (lambda f, ref: f.similarity(ref, engine))
+    scan = similarities_lookahead if o.threads > 1 else similarities
+    for (f, st) in scan(FrameStream(root, o), compare, o):
+        if st is None:
             continue
         if st < o.score:
             yield f
-            ref = f
         else:
             count += 1
             logging.debug("count=%s skip %s",count,f)
+    if cascade:
+        logging.info("DissimilarFrameStream comparisons: %s", dict(cascade.counts))
+
+
+def load_image(f):
+    """The default Prefetch loader: decode the full image into the frame cache"""
+    return f.img
+
+class Prefetch:
+    """Read and decode the images of frames from source ahead of the consumer.
+    :param depth: how many frames ahead. At most this many images are loaded and not yet taken,
+                  so memory is bounded by depth images (the frame cache must be able to hold them).
+    :param workers: threads reading and decoding. cv2.imdecode releases the GIL, so they run in parallel.
+    :param load: load(frame) puts what the consumer will use into the cache. By default it is the
+                 full image; a detector that uses f.img_at(640) should prefetch that instead.
+    Frames are generated in the order of source, as soon as their load has been started.
+    A consumer that asks for an image still being loaded waits for that load rather than
+    starting another. Errors are left for the consumer to see when it reads the image.
+    """
+    def __init__(self, source, depth=DEFAULT_PREFETCH_DEPTH, workers=DEFAULT_PREFETCH_WORKERS, load=load_image):
+        self.source = source
+        self.depth = max(1, depth)
+        self.workers = workers
+        self.load = load
+        self.ready = 0          # frames whose load had finished when they were taken
+        self.waiting = 0        # frames whose load had not
+
+    def __repr__(self):
+        return f"<Prefetch depth={self.depth} workers={self.workers} ready={self.ready} waiting={self.waiting}>"
+
+    def __iter__(self):
+        frames = iter(self.source)
+        pending = collections.deque()   # (frame, future or None)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prefetch') as pool:
+            try:
+                while True:
+                    while len(pending) < self.depth and (f := next(frames, None)) is not None:
+                        # frames that already carry their image have nothing to load
+                        fut = pool.submit(self.load, f) if f.path is not None and f.img_ is None else None
+                        pending.append((f, fut))
+                    if not pending:
+                        break
+                    (f, fut) = pending.popleft()
+                    if fut is not None:
+                        if fut.done():
+                            self.ready += 1
+                        else:
+                            self.waiting += 1
+                    del fut             # so that a loaded image is held only by the cache
+                    yield f
+            finally:
+                for (_, fut) in pending:
+                    if fut is not None:
+                        fut.cancel()
+
+def motion_boxes(mask, scale):
+    """Return (x, y, w, h) of each moving region of mask, multiplied by scale"""
+    (contours, _) = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for c in contours:
+        (x, y, w, h) = cv2.boundingRect(c)
+        boxes.append(tuple(int(round(v * scale)) for v in (x, y, w, h)))
+    return sorted(boxes)
+
+def MotionFrameStream(root, o=SourceOptions()):
+    """Generate the frames in which something moved.
+    Each frame is decoded at low resolution and compared with a background model (OpenCV MOG2)
+    that adapts to gradual changes such as daylight. A frame is generated if at least
+    o.motion_threshold of it is foreground. It is tagged with a Patch(TAG_MOTION) for each
+    moving region, in full-resolution coordinates, so later stages can look only there.
+    The first frame is always generated, without tags. So is a frame whose size differs from the
+    one before (say, another camera), as the background model then starts again."""
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    shape = None
+    for f in FrameStream(root, o):
+        try:
+            (img, scale) = f.img_at(o.motion_side)
+        except (cv2.error, FileNotFoundError) as e: # pylint: disable=catching-non-exception
+            print(f"Cannot read '{f.path}': {e}",file=sys.stderr)
+            continue
+        if max(img.shape[:2]) > o.motion_side:
+            factor = o.motion_side / max(img.shape[:2])
+            img = cv2.resize(img, (max(round(img.shape[1] * factor), 1), max(round(img.shape[0] * factor), 1)),
+                             interpolation=cv2.INTER_AREA)
+            scale /= factor
+        if img.shape != shape:
+            # MOG2 cannot compare images of different sizes
+            subtractor = cv2.createBackgroundSubtractorMOG2(history=MOTION_HISTORY, detectShadows=True)
+            shape = img.shape
+            subtractor.apply(img)
+            yield f
+            continue
+        mask = subtractor.apply(img)
+        mask = np.where(mask == MOTION_FOREGROUND, np.uint8(255), np.uint8(0))
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)     # remove speckles
+        if cv2.countNonZero(mask) < o.motion_threshold * mask.size:
+            continue
+        mask = cv2.dilate(mask, kernel, iterations=2)               # join the pieces of one object
+        for (x, y, w, h) in motion_boxes(mask, scale):
+            f.add_tag(Patch(TAG_MOTION, xy=(x, y), w=w, h=h))
+        yield f
 
 
 def CameraFrameStream(camera=0, o=SourceOptions()):
     # https://docs.opencv.org/3.4/dd/d01/group__videoio__c.html
+    # For several cameras, or a consumer slower than the camera, use cameras.MultiCameraSource
     cap = cv2.VideoCapture(camera)
     if o.frameWidth is not None:
-        cap.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, frameWidth)
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, o.frameWidth)
     if o.frameHeight is not None:
-        cap.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, frameHeight)
-    while True:
-        ret, img = cap.read()
-        if not ret:
-            break
-        yield Frame(src=f"camera{camera}")
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, o.frameHeight)
+    try:
+        while True:
+            ret, img = cap.read()
+            if not ret:
+                break
+            f = Frame(img=img)
+            f.uri = f"camera:camera{camera}"
+            yield f
+    finally:
+        cap.release()
 
 def TagsFromDirectory(path):
     for (dirpath, dirnames, filenames) in os.walk(path):
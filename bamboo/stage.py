@@ -5,15 +5,18 @@ Stage implementation and some simple stages.
 import sys
 import os
 import time
-import math
 import collections
 import uuid
 import shelve
 import pickle
+import threading
+import asyncio
 from abc import ABC,abstractmethod
 from filelock import FileLock
 
 from .frame import Frame,FrameTagDict
+from .stats import StageStats
+from .trace import frame_id
 
 DEFAULT_JPG_TEMPLATE="frame{counter:08}.jpg"
 
@@ -21,14 +24,16 @@ class Stage(ABC):
     """Abstract base class for processing DAG"""
 
     registered_stages = []
+    parallel = True             # False if process() must not run concurrently (state or GUI)
 
     def __init__(self):
         self.next_stages = set()
         self.config  = {}
-        self.sum_t   = 0
-        self.sum_t2  = 0
-        self.count   = 0
+        self.stats   = StageStats()
+        self.spans   = None     # list of (start, duration, frames, wait, pid, tid) when tracing
+        self.profiler = None    # StageProfiler when this stage is profiled
         self.pipeline = None    # my pipeline
+        self.lock    = threading.Lock() # protects the statistics
         self.registered_stages.append(self)
 
     @abstractmethod
@@ -37,15 +42,85 @@ class Stage(ABC):
         self.output(f)
 
 
-    def _run_frame(self,f):
+    def _run_frame(self, f, wait=None):
         """called at the start of processing of this stage.
-        Processes and then passes the frame to the output stages."""
+        Processes and then passes the frame to the output stages.
+        :param wait: seconds that f waited in the queue for this stage."""
         t0 = time.time()
-        self.process(f)
+        if self.profiler is not None:
+            self.profiler.run(self, self.process, f)
+        else:
+            self.process(f)
         t = time.time() - t0
-        self.sum_t  += t
-        self.sum_t2 += (t*t)
-        self.count  += 1
+        self.record_time(t, wait)
+        if self.spans is not None:
+            self.add_span(t0, t, [f], wait, threading.get_ident())
+
+    async def _run_frame_async(self, f, wait=None):
+        """called by the AsyncPipeline for stages whose process() is a coroutine.
+        Calls overlap on the event loop thread, so each task gets its own row in a trace."""
+        t0 = time.time()
+        if self.profiler is not None:
+            await self.profiler.run_async(self, self.process, f)
+        else:
+            await self.process(f)
+        t = time.time() - t0
+        self.record_time(t, wait)
+        if self.spans is not None:
+            self.add_span(t0, t, [f], wait, id(asyncio.current_task()))
+
+    def add_span(self, start, duration, frames, wait, tid):
+        with self.lock:
+            self.spans.append((start, duration, [frame_id(f) for f in frames], wait, os.getpid(), tid))
+
+    def take_spans(self):
+        """Return the trace spans recorded so far and start a new list."""
+        with self.lock:
+            (spans, self.spans) = (self.spans, [] if self.spans is not None else None)
+        return spans
+
+    def record_time(self, t, wait=None):
+        """Add one call that took t seconds, after waiting wait seconds, to the statistics."""
+        with self.lock:
+            self.stats.add(t, wait, time.time())
+
+    def take_stats(self):
+        """Return the statistics and start new ones. Used to send a worker's statistics to the pipeline."""
+        with self.lock:
+            (stats, self.stats) = (self.stats, StageStats())
+        return stats
+
+    def merge_stats(self, stats):
+        """Add statistics gathered by another thread or process"""
+        with self.lock:
+            self.stats.merge(stats)
+
+    def take_report(self):
+        """Return and reset the statistics, trace spans and profile gathered in this process.
+        Used by worker processes."""
+        return (self.take_stats(), self.take_spans(),
+                self.profiler.take(self) if self.profiler is not None else None)
+
+    def merge_report(self, report):
+        """Add a report from take_report() in another process"""
+        (stats, spans, profile) = report
+        self.merge_stats(stats)
+        if spans and self.spans is not None:
+            with self.lock:
+                self.spans.extend(spans)
+        if profile and self.profiler is not None:
+            self.profiler.merge(self, profile)
+
+    def __getstate__(self):
+        """The pipeline and the lock are not sent to worker processes."""
+        state = self.__dict__.copy()
+        state['pipeline'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
 
     def output(self,f):
         """output(f) queues f for output when the current stage is done.
@@ -55,25 +130,71 @@ class Stage(ABC):
             self.pipeline.queue_output_stage_frame_pair( (s,f) )
 
     @property
-    def t_mean(self):
-        return self.sum_t / self.count if self.count>0 else float("nan")
-
-    @property
-    def t2_mean(self):
-        return self.sum_t2 / self.count if self.count>0 else float("nan")
+    def count(self):
+        return self.stats.timing.count
 
     @property
-    def t_variance(self):
-        return self.t2_mean - self.t_mean * self.t_mean
+    def t_mean(self):
+        return self.stats.timing.mean
 
     @property
     def t_stddev(self):
-        return math.sqrt(self.t_variance)
+        return self.stats.timing.stddev
+
+    def percentile(self, p):
+        """Seconds below which p percent of the calls to process() finished"""
+        return self.stats.timing.percentile(p)
+
+
+class BatchStage(Stage):
+    """Abstract base class for stages that process several frames at once, such as batched inference.
+    The pipeline collects up to batch_size frames, waiting at most max_wait seconds
+    for a batch to fill, and calls process_batch() once for the batch.
+    """
+    batch_size = 8
+    max_wait   = 0.050          # seconds
+
+    def __init__(self, *, batch_size=None, max_wait=None):
+        super().__init__()
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if max_wait is not None:
+            self.max_wait = max_wait
+
+    @abstractmethod
+    def process_batch(self, frames:list):
+        """Process a list of frames. Returns a list with the frame to output for each input frame,
+        or None to output nothing for it."""
+        return frames
+
+    def process(self, f:Frame):
+        self.output_batch([f])
+
+    def output_batch(self, frames):
+        """Process frames and output the results."""
+        for f in self.process_batch(frames):
+            if f is not None:
+                self.output(f)
+
+    def _run_batch(self, frames, waits=None):
+        """called by the pipeline with a batch of frames. Each frame is charged an equal share of the time.
+        :param waits: the seconds that each frame waited in the queue."""
+        t0 = time.time()
+        if self.profiler is not None:
+            self.profiler.run(self, self.output_batch, frames)
+        else:
+            self.output_batch(frames)
+        t = time.time() - t0
+        for wait in (waits if waits is not None else [None] * len(frames)):
+            self.record_time(t / len(frames), wait)
+        if self.spans is not None:
+            self.add_span(t0, t, frames, max(waits) if waits else None, threading.get_ident())
 
 
 class ShowFrames(Stage):
     """Pipeline that shows every frame coming through, and then copy to outpu"""
     wait = None
+    parallel = False
     def __init__(self, wait=None):
         super().__init__()
         if wait is not None:
@@ -86,6 +207,7 @@ class ShowFrames(Stage):
 class ShowTags(Stage):
     """Pipeline that shows the tags for every frame that has a tag, and then copy to output"""
     wait = None
+    parallel = False
     def __init__(self, wait=None):
         super().__init__()
         if wait is not None:
@@ -102,6 +224,7 @@ class Multiplex(Stage):
 
 
 class WriteFramesToDirectory(Stage):
+    parallel = False            # the counter names the files
     def __init__(self, root, *, template=DEFAULT_JPG_TEMPLATE):
         super().__init__()
         self.root     = root
@@ -0,0 +1,117 @@
+"""
+Timing statistics for stages.
+
+LatencyHistogram - A compact histogram of durations with logarithmic buckets.
+                   Percentiles are accurate to within a few percent. Histograms
+                   from several threads or processes can be merged.
+
+StageStats - The processing time, queue wait time and throughput of a stage.
+"""
+
+import math
+import collections
+
+BUCKETS_PER_OCTAVE = 16         # each bucket is 2**(1/16) = 4.4% wider than the one before
+MIN_SECONDS = 1e-6              # everything faster than this goes into bucket 0
+
+class LatencyHistogram:
+    """Histogram of durations in seconds, in logarithmic buckets"""
+    __slots__ = ('buckets','count','sum','sum2','min','max')
+
+    def __init__(self):
+        self.buckets = collections.Counter()  # bucket index -> count
+        self.count = 0
+        self.sum   = 0.0
+        self.sum2  = 0.0
+        self.min   = math.inf
+        self.max   = 0.0
+
+    @staticmethod
+    def bucket(t):
+        if t <= MIN_SECONDS:
+            return 0
+        return int(math.log2(t / MIN_SECONDS) * BUCKETS_PER_OCTAVE) + 1
+
+    @staticmethod
+    def bucket_upper(b):
+        """Upper bound of bucket b"""
+        return MIN_SECONDS * 2 ** (b / BUCKETS_PER_OCTAVE)
+
+    def add(self, t, n=1):
+        self.buckets[self.bucket(t)] += n
+        self.count += n
+        self.sum   += t * n
+        self.sum2  += t * t * n
+        self.min = min(self.min, t)
+        self.max = max(self.max, t)
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.sum   += other.sum
+        self.sum2  += other.sum2
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Return the duration below which p percent of the samples fall, or nan if there are none."""
+        if self.count == 0:
+            return math.nan
+        rank = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return min(max(self.bucket_upper(b), self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else math.nan
+
+    @property
+    def stddev(self):
+        if self.count == 0:
+            return math.nan
+        return math.sqrt(max(self.sum2 / self.count - self.mean * self.mean, 0.0))
+
+
+class StageStats:
+    """Processing and queue-wait time of a stage, and the wall-clock span of its work."""
+    __slots__ = ('timing','wait','first','last')
+
+    def __init__(self):
+        self.timing = LatencyHistogram()    # time in process()
+        self.wait   = LatencyHistogram()    # time waiting in the queue before process()
+        self.first  = math.inf              # when the first call started
+        self.last   = -math.inf             # when the last call finished
+
+    def add(self, t, wait=None, end=None):
+        """Record one call that took t seconds and ended at time end, after waiting wait seconds."""
+        self.timing.add(t)
+        if wait is not None:
+            self.wait.add(wait)
+        if end is not None:
+            self.first = min(self.first, end - t)
+            self.last  = max(self.last, end)
+
+    def merge(self, other):
+        self.timing.merge(other.timing)
+        self.wait.merge(other.wait)
+        self.first = min(self.first, other.first)
+        self.last  = max(self.last, other.last)
+
+    @property
+    def fps(self):
+        """Frames per second, from the start of the first call to the end of the last."""
+        span = self.last - self.first
+        return self.timing.count / span if span > 0 else math.nan
+
+    def summary(self):
+        def ms(t):
+            return f"{t*1000:.1f}ms"
+        tm = self.timing
+        return (f"calls: {tm.count}  fps: {self.fps:.1f}  "
+                f"p50: {ms(tm.percentile(50))}  p90: {ms(tm.percentile(90))}  "
+                f"p99: {ms(tm.percentile(99))}  max: {ms(tm.max if tm.count else math.nan)}  "
+                f"wait p50: {ms(self.wait.percentile(50))}  p99: {ms(self.wait.percentile(99))}")
@@ -0,0 +1,76 @@
+"""
+Tests for the frame cache
+"""
+
+import sys
+import threading
+import time
+
+from os.path import dirname, join
+
+import cv2
+import numpy as np
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.cache import FrameCache,sizeof,key_sizeof
+from bamboo.frame import Frame,frame_cache,CACHE_BYTES,CACHE_IMAGE,CACHE_GRAYSCALE
+
+
+
+def test_budget():
+    cache = FrameCache(max_bytes=1000)
+    for i in range(4):
+        cache.put(i, np.zeros(300, dtype=np.uint8))
+    assert len(cache) == 3 and cache.bytes == 900
+    assert 0 not in cache                       # least recently used went first
+    cache.get(1, None)                          # 1 is now the most recently used
+    cache.put(4, np.zeros(300, dtype=np.uint8))
+    assert 1 in cache and 2 not in cache
+    cache.put(5, np.zeros(2000, dtype=np.uint8))  # larger than the budget; not kept
+    assert 5 not in cache
+    cache.set_budget(300)
+    assert len(cache) == 1 and cache.peek(4) is not None
+    assert cache.stats()['evictions'] == 4
+
+
+def test_charge_keys():
+    """A cache of scores is charged for its keys, which are most of its memory"""
+    cache = FrameCache(max_bytes=100_000, charge_keys=True)
+    key = ('a' * 76, 'b' * 76, 640, 'box', None)
+    cache.put(key, 0.5)
+    assert cache.bytes == sizeof(0.5) + key_sizeof(key)
+    assert cache.bytes > 10 * sizeof(0.5)
+    for i in range(1000):
+        cache.put((str(i) * 76, 'b' * 76, 640, 'box', None), 0.5)
+    assert cache.bytes <= 100_000
+    assert len(cache) < 100_000 // 400
+
+
+def test_one_load():
+    """Threads that miss on the same key at the same time load it only once"""
+    cache = FrameCache()
+    loads = []
+    def loader():
+        loads.append(1)
+        time.sleep(0.05)
+        return b"x"
+    threads = [threading.Thread(target=cache.get, args=('k', loader)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(loads) == 1
+    assert cache.stats()['hits'] == 7 and cache.stats()['misses'] == 1
+
+
+def test_frame_tiers(tmp_path):
+    path = join(tmp_path, "frame.jpg")
+    cv2.imwrite(path, np.random.default_rng(0).integers(0, 255, (120,160,3), dtype=np.uint8))
+    frame_cache.clear()
+    f = Frame(path=path)
+    assert f.img_grayscale.ndim == 2
+    assert not f.img_grayscale.flags.writeable
+    for tier in (CACHE_BYTES, CACHE_IMAGE, CACHE_GRAYSCALE):
+        assert (tier, path) in frame_cache
+    assert frame_cache.bytes == sizeof(f.bytes) + f.img.nbytes + f.img_grayscale.nbytes
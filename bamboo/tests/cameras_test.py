@@ -0,0 +1,121 @@
+"""
+Tests for reading several live cameras
+"""
+
+import sys
+import time
+import threading
+
+from os.path import dirname, join
+
+import numpy as np
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.cameras import MultiCameraSource
+
+
+class FakeCapture:
+    """A camera that sends n frames, one every interval seconds, then ends.
+    Each image is filled with the number of the frame."""
+    def __init__(self, n, interval=0.0):
+        self.n = n
+        self.interval = interval
+        self.sent = 0
+        self.released = False
+
+    def grab(self):
+        if self.sent >= self.n:
+            return False
+        time.sleep(self.interval)
+        self.sent += 1
+        return True
+
+    def retrieve(self):
+        return (True, np.full((4, 4, 3), self.sent % 256, dtype=np.uint8))
+
+    def release(self):
+        self.released = True
+
+class FakeOpener:
+    """Opens FakeCaptures; urls in fail fail that many times first"""
+    def __init__(self, n, interval=0.0, fail=None):
+        self.n = n
+        self.interval = interval
+        self.fail = dict(fail or {})
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def __call__(self, url):
+        with self.lock:
+            if self.fail.get(url, 0) > 0:
+                self.fail[url] -= 1
+                return None
+            cap = FakeCapture(self.n, self.interval)
+            self.opened.append(cap)
+            return cap
+
+
+def test_interleave():
+    opener = FakeOpener(5, interval=0.01)
+    source = MultiCameraSource({'a': 'rtsp://a', 'b': 'rtsp://b'}, opener=opener, max_reconnects=0)
+    frames = list(source)
+    assert {f.uri for f in frames} == {'camera:a', 'camera:b'}
+    for name in ('a', 'b'):
+        stats = source.stats[name]
+        assert stats.frames == 5
+        assert stats.delivered + stats.dropped == 5
+        assert stats.delivered >= 1
+    # frames of each camera are in order
+    for uri in ('camera:a', 'camera:b'):
+        numbers = [int(f.img[0, 0, 0]) for f in frames if f.uri == uri]
+        assert numbers == sorted(numbers)
+    assert all(cap.released for cap in opener.opened)
+
+
+def test_slow_consumer():
+    """A consumer slower than the cameras gets their latest frames, and the others are dropped"""
+    opener = FakeOpener(1000, interval=0.002)
+    with MultiCameraSource(['rtsp://a', 'rtsp://b'], opener=opener, max_reconnects=0) as source:
+        lags = []
+        for (i, f) in enumerate(source):
+            lags.append(time.time() - f.mtime)
+            time.sleep(0.05)            # a slow detector
+            if i == 10:
+                break
+    assert source.dropped() > 0
+    assert max(lags) < 0.05             # never more than about one frame behind
+    assert {name for (name, s) in source.stats.items() if s.delivered} == {'camera0', 'camera1'}
+    assert len(source.slots) == 2       # one slot per camera, however slow the consumer
+
+
+def test_reconnect():
+    opener = FakeOpener(3, fail={'rtsp://a': 2})
+    source = MultiCameraSource({'a': 'rtsp://a'}, opener=opener, reconnect_delay=0.001, max_reconnects=4)
+    frames = list(source)
+    stats = source.stats['a']
+    # two failed connections, then three streams of 3 frames that each end
+    assert stats.reconnects == 4
+    assert len(opener.opened) == 3
+    assert stats.frames == 9
+    assert len(frames) == stats.delivered
+
+
+def test_fps():
+    opener = FakeOpener(50, interval=0.005)
+    source = MultiCameraSource(['rtsp://a'], opener=opener, fps=20, max_reconnects=0)
+    frames = list(source)
+    # 50 frames over about 0.25 seconds, at most 20 a second
+    assert 2 <= source.stats['camera0'].frames <= 8
+    assert len(frames) <= source.stats['camera0'].frames
+
+
+def test_close():
+    opener = FakeOpener(10**6, interval=0.001)
+    source = MultiCameraSource(['rtsp://a', 'rtsp://b'], opener=opener)
+    it = iter(source)
+    next(it)
+    source.close()
+    assert list(it) == []               # iteration ends
+    assert not any(t.is_alive() for t in source.threads)
+    assert all(cap.released for cap in opener.opened)
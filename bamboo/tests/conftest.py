@@ -4,3 +4,14 @@
 # See - https://stackoverflow.com/questions/34466027/what-is-conftest-py-for-in-pytest
 
 import pytest
+import sys
+from os.path import dirname, join
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.hashindex import set_hash_index
+
+@pytest.fixture(autouse=True, scope='session')
+def test_hash_index(tmp_path_factory):
+    """Keep the hashes of test files out of the user's hash index"""
+    set_hash_index(str(tmp_path_factory.mktemp("hashindex") / "hashes.sqlite"))
@@ -0,0 +1,49 @@
+"""
+Tests for tagging faces with YOLOv8
+"""
+
+import sys
+from os.path import dirname,join,abspath
+
+import cv2
+import numpy as np
+
+sys.path.append( dirname(dirname(dirname(abspath(__file__)))))
+
+from bamboo.frame import Frame,TAG_FACE
+from bamboo.face_yolo8 import Yolo8FaceTag
+
+
+class FixedDetector:
+    """Finds one face, at the same place in every image it is given"""
+    input_width = input_height = 640
+    def __init__(self, box):
+        self.box = box
+        self.shapes = []
+    def detect_batch(self, imgs):
+        self.shapes.extend(img.shape for img in imgs)
+        return [(np.array([self.box], dtype=float), np.array([0.9]), np.array([0]), np.array([])) for img in imgs]
+
+class RecordingFQA:
+    """Records the faces whose quality it is asked for"""
+    def __init__(self):
+        self.imgs = []
+    def detect_batch(self, imgs):
+        self.imgs.extend(imgs)
+        return [np.array([0.5]) for img in imgs]
+
+
+def test_full_resolution(tmp_path):
+    """Faces are found in a reduced decode, but tagged and scored at full resolution"""
+    path = join(tmp_path, "frame.jpg")
+    cv2.imwrite(path, np.random.default_rng(0).integers(0, 255, (1920,2560,3), dtype=np.uint8))
+    stage = Yolo8FaceTag()
+    stage.face_detector = FixedDetector((100, 50, 40, 40))
+    stage.fqa = RecordingFQA()
+    (f,) = stage.process_batch([Frame(path=path)])
+    assert stage.face_detector.shapes == [(480, 640, 3)]     # decoded at 1/4
+    (tag,) = [t for t in f.tags if t.tag_type == TAG_FACE]
+    assert (tag.xy, tag.w, tag.h) == ((400, 200), 160, 160)
+    (face,) = stage.fqa.imgs
+    assert face.shape == (160, 160, 3)
+    assert (face == Frame(path=path).img[200:360, 400:560]).all()
@@ -15,7 +15,15 @@ from os.path import abspath, dirname, join, basename
 
 sys.path.append(join(dirname(dirname(dirname(__file__)))))
 
-from bamboo.frame import Frame
+import cv2
+import numpy as np
+
+import pickle
+
+import bamboo.frame
+from bamboo.frame import Frame,Tag,Patch,frame_cache,similarity_memo,CACHE_IMAGE,CACHE_SIGNATURE
+from bamboo.probe import jpeg_dimensions
+from bamboo.image_utils import img_sim,ssim_box,SimilarityEngine,SimilarityCascade,DEFAULT_THUMB_SIDE
 
 TEST_DATA_DIR = join(dirname(abspath(__file__)),"data")
 ROBERTS_DATA  = join(TEST_DATA_DIR, "2022_Roberts_Court_Formal_083122_Web.jpg")
@@ -28,3 +36,145 @@ def test_frame():
     assert len(fc.history) == 2
     assert fc.history[0]==('path',ROBERTS_DATA)
     assert fc.history[1]==('crop',((50,75), (125,60)))
+
+
+def test_img_at(tmp_path):
+    path = join(tmp_path, "big.jpg")
+    img = np.zeros((1200,2000,3), dtype=np.uint8)
+    cv2.rectangle(img, (800,400), (1199,799), (255,255,255), thickness=-1)
+    cv2.imwrite(path, img)
+    with open(path,"rb") as f:
+        assert jpeg_dimensions(f.read()) == (2000,1200)
+    f = Frame(path=path)
+    (small, scale) = f.img_at(640)
+    assert small.shape == (600,1000,3)  # 1/2 keeps the long side >= 640; 1/4 would not
+    assert scale == 2.0
+    # a point in the reduced image maps back to the same place in the full image
+    ys, xs = np.nonzero(small[:,:,0] > 128)
+    assert abs(xs.min() * scale - 800) <= scale and abs(ys.max() * scale - 799) <= scale
+    (full, scale) = f.img_at(5000)
+    assert full.shape == (1200,2000,3) and scale == 1.0
+
+
+def test_crop_view():
+    img = np.arange(20*30*3, dtype=np.uint8).reshape(20,30,3)
+    f = Frame(img=img)
+    fc = f.crop(xy=(5,2), w=10, h=8)
+    assert np.shares_memory(fc.img, img)    # no copy
+    assert not fc.img.flags.writeable
+    assert (fc.img == img[2:10, 5:15]).all()
+    fw = fc.writable_copy()
+    fw.img_[...] = 0
+    assert not np.shares_memory(fw.img, img)
+    assert (fc.img == img[2:10, 5:15]).all() and img.any()
+
+
+def test_slots():
+    f = Frame(img=np.zeros((4,4,3), dtype=np.uint8))
+    assert not hasattr(f, '__dict__')
+    assert isinstance(f.mtime, float)
+    f.add_tag(Tag('reply', text="ok", status=200))
+    g = f.copy()
+    g.add_tag(Patch('face', xy=(1,2), w=3, h=4, fqa=0.5))
+    assert len(f.tags) == 1 and len(g.tags) == 2    # adding to the copy left f alone
+    (tag, patch) = pickle.loads(pickle.dumps(g)).tags
+    assert tag.status == 200 and tag.text == "ok"
+    assert patch.dict() == {'tag_type':'face', 'text':'', 'xy':(1,2), 'w':3, 'h':4, 'fqa':0.5}
+    with pytest.raises(AttributeError):
+        tag.fqa
+
+
+# [Tag('face', text='hi', score=0.5), Patch('face', xy=(1,2), w=3, h=4, fqa=0.75)],
+# pickled by the Tag and Patch classes from before they had slots, as in old .tag files
+LEGACY_TAGS_PICKLE = (
+    b'\x80\x04\x95\x96\x00\x00\x00\x00\x00\x00\x00]\x94(\x8c\x0cbamboo.frame\x94\x8c\x03Tag\x94\x93\x94)'
+    b'\x81\x94}\x94(\x8c\x04text\x94\x8c\x02hi\x94\x8c\x08tag_type\x94\x8c\x04face\x94\x8c\x05score\x94'
+    b'G?\xe0\x00\x00\x00\x00\x00\x00ubh\x01\x8c\x05Patch\x94\x93\x94)\x81\x94}\x94(h\x06\x8c\x00\x94h\x08h\t'
+    b'\x8c\x02xy\x94K\x01K\x02\x86\x94\x8c\x01w\x94K\x03\x8c\x01h\x94K\x04\x8c\x03fqa\x94G?\xe8\x00\x00'
+    b'\x00\x00\x00\x00ube.')
+
+def test_legacy_tag_pickle():
+    (tag, patch) = pickle.loads(LEGACY_TAGS_PICKLE)
+    assert tag.dict() == {'tag_type':'face', 'text':'hi', 'score':0.5}
+    assert tag.score == 0.5
+    assert isinstance(patch, Patch)
+    assert patch.dict() == {'tag_type':'face', 'text':'', 'xy':(1,2), 'w':3, 'h':4, 'fqa':0.75}
+    assert (patch.xy, patch.fqa) == ((1,2), 0.75)
+
+
+def test_dimensions_from_header(tmp_path):
+    path = join(tmp_path, "frame.jpg")
+    cv2.imwrite(path, np.zeros((23,37,3), dtype=np.uint8))
+    frame_cache.clear()
+    f = Frame(path=path)
+    assert (f.w, f.h, f.depth) == (37, 23, 3)
+    assert (CACHE_IMAGE, path) not in frame_cache   # the image was not decoded
+    assert f.crop(xy=(0,0), w=10, h=5).w == 10
+
+
+def test_similarity_memo(tmp_path):
+    img = np.random.default_rng(1).integers(0, 255, (40,60,3), dtype=np.uint8)
+    paths = [join(tmp_path, name) for name in ("a.jpg", "b.jpg", "copy_of_a.jpg")]
+    for (path, i) in zip(paths, (img, 255 - img, img)):
+        cv2.imwrite(path, i)
+    (a, b, a2) = [Frame(path=path) for path in paths]
+    score = a.similarity(b)
+    hits = similarity_memo.hits
+    assert b.similarity(a2) == score    # same content, other frames and other order
+    assert similarity_memo.hits == hits + 1
+    assert a.similarity(a2) == pytest.approx(1.0)
+
+
+def test_similarity_engine():
+    rng = np.random.default_rng(2)
+    a = rng.integers(0, 255, (90,120), dtype=np.uint8)
+    b = cv2.GaussianBlur(a, (5,5), 0)
+    assert ssim_box(a, b) == pytest.approx(img_sim(a, b), abs=1e-5)
+    engine = SimilarityEngine(max_side=60)
+    assert engine.prepare(a).shape == (45,60)
+    assert engine.similarity(a, a) == pytest.approx(1.0)
+    assert engine.similarity(a, b[:80]) == 0       # different shapes
+    f1 = Frame(img=cv2.cvtColor(a, cv2.COLOR_GRAY2BGR))
+    f2 = Frame(img=cv2.cvtColor(b, cv2.COLOR_GRAY2BGR))
+    assert f1.similarity(f2, engine) == pytest.approx(engine.similarity(a, b), abs=0.01)
+
+
+def test_similarity_cascade(tmp_path):
+    rng = np.random.default_rng(3)
+    scene = cv2.resize(rng.integers(0, 255, (30,40,3), dtype=np.uint8), (400,300))
+    def frame(name, img):
+        path = join(tmp_path, name)
+        cv2.imwrite(path, img)
+        return Frame(path=path)
+    noisy = np.clip(scene + rng.normal(0, 2, scene.shape), 0, 255).astype(np.uint8)
+    changed = scene.copy()
+    changed[:150] = 255 - changed[:150]
+    (a, b, c) = (frame("a.jpg", scene), frame("b.jpg", noisy), frame("c.jpg", changed))
+    cascade = SimilarityCascade(0.9)
+    assert cascade.similarity(b, a) >= 0.9
+    assert cascade.counts['similar'] == 1                   # settled by the signatures
+    assert cascade.similarity(c, a) < 0.9
+    assert cascade.counts['full'] == 0
+    assert (CACHE_SIGNATURE, a.hash(), DEFAULT_THUMB_SIDE) in frame_cache
+    # in the band, the full similarity decides
+    narrow = SimilarityCascade(cascade.similarity(b, a), band=(0.5, 0.5))
+    narrow.similarity(b, a)
+    assert narrow.counts['full'] == 1
+
+
+def test_signature_reads_once(tmp_path, monkeypatch):
+    """The signature of a file seen for the first time hashes the bytes it decodes"""
+    path = join(tmp_path, "new.jpg")
+    cv2.imwrite(path, np.random.default_rng(2).integers(0, 255, (120,160,3), dtype=np.uint8))
+    reads = []
+    read = bamboo.frame._bytes_read
+    def counting_read(p):
+        reads.append(p)
+        return read(p)
+    def no_hash_file(p):
+        raise AssertionError(f"{p} was read again to hash it")
+    monkeypatch.setattr("bamboo.frame._bytes_read", counting_read)
+    monkeypatch.setattr("bamboo.hashindex.hash_file", no_hash_file)
+    frame_cache.clear()
+    Frame(path=path).signature()
+    assert reads == [path]
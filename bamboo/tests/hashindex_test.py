@@ -0,0 +1,43 @@
+"""
+Tests for the hash index
+"""
+
+import sys
+import os
+import hashlib
+
+from os.path import dirname, join
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.hashindex import HashIndex,hash_file,hash_bytes
+
+
+def test_hash_file(tmp_path):
+    path = join(tmp_path, "data.bin")
+    data = os.urandom(3 * 1000 + 17)
+    with open(path, "wb") as f:
+        f.write(data)
+    assert hash_file(path, chunk_size=1000) == hash_bytes(data)
+    assert hash_bytes(data) == "SHA-512/256:" + hashlib.sha512(data).digest()[:32].hex()
+
+
+def test_index(tmp_path):
+    path = join(tmp_path, "data.bin")
+    with open(path, "wb") as f:
+        f.write(b"first")
+    db = join(tmp_path, "hashes.sqlite")
+    index = HashIndex(db)
+    h1 = index.hash(path)
+    assert index.hash(path) == h1
+    assert (index.hits, index.misses) == (1, 1)
+
+    # Another run finds the hash without reading the file
+    again = HashIndex(db)
+    assert again.lookup(path) == h1
+
+    # A changed file is hashed again
+    with open(path, "wb") as f:
+        f.write(b"second, longer")
+    assert again.lookup(path) is None
+    assert again.hash(path) == hash_bytes(b"second, longer")
@@ -0,0 +1,98 @@
+"""
+Tests for the archive manifest
+"""
+
+import os
+import sys
+from datetime import datetime
+
+from os.path import dirname, join
+
+import cv2
+import numpy as np
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.manifest import Manifest,MarkProcessed
+import bamboo.scan
+
+
+def write_jpeg(path, w=40, h=30):
+    os.makedirs(dirname(path), exist_ok=True)
+    cv2.imwrite(path, np.zeros((h, w, 3), dtype=np.uint8))
+
+def archive(root):
+    for (camera, day, hour) in [("front", 1, 10), ("front", 1, 11), ("front", 2, 9), ("back", 1, 12)]:
+        write_jpeg(join(root, camera, "2024-01", f"202401{day:02}T{hour:02}0000.jpg"))
+    write_jpeg(join(root, "front", "2024-02", "20240201T080000.jpg"), w=64, h=48)
+
+
+def test_manifest(tmp_path):
+    root = join(tmp_path, "archive")
+    archive(root)
+    m = Manifest(join(tmp_path, "manifest.sqlite"))
+    assert m.update(root, hashes=True) == 5
+    assert len(m) == 5
+
+    front = list(m.frames(camera="front"))
+    assert [os.path.basename(f.path) for f in front] == \
+        ["20240101T100000.jpg", "20240101T110000.jpg", "20240102T090000.jpg", "20240201T080000.jpg"]
+    assert (front[-1].w, front[-1].h, front[-1].depth) == (64, 48, 3)
+    assert front[0].mtime == datetime(2024, 1, 1, 10).timestamp()
+    assert m.hash(front[0].path) == front[0].hash()
+    window = list(m.frames(camera="front", start=datetime(2024, 1, 1, 11), end=datetime(2024, 2, 1)))
+    assert [f.path for f in window] == [f.path for f in front[1:3]]
+
+    # stages
+    m.mark_processed(front[:2], "faces")
+    assert m.processed(front[0].path, "faces")
+    assert [f.path for f in m.frames(camera="front", unprocessed_by="faces")] == [f.path for f in front[2:]]
+    stage = MarkProcessed(m, "faces")
+    stage.process(front[2])
+    assert len(list(m.frames(camera="front", unprocessed_by="faces"))) == 1
+    assert len(list(m.frames(unprocessed_by="faces"))) == 2
+
+    # a second manifest on the same file sees the same thing
+    assert len(Manifest(join(tmp_path, "manifest.sqlite"))) == 5
+
+
+def test_manifest_incremental(tmp_path, monkeypatch):
+    root = join(tmp_path, "archive")
+    archive(root)
+    m = Manifest(":memory:")
+    m.update(root)
+    listed = []
+    scan_dir = bamboo.scan.scan_dir
+    def counting_scan_dir(path):
+        listed.append(path)
+        return scan_dir(path)
+    monkeypatch.setattr("bamboo.manifest.scan_dir", counting_scan_dir)
+
+    # nothing changed: nothing is listed
+    assert m.update(root) == 0
+    assert listed == []
+
+    # a new image is found by listing only its directory
+    write_jpeg(join(root, "back", "2024-01", "20240103T070000.jpg"))
+    assert m.update(root) == 1
+    assert listed == [join(root, "back", "2024-01")]
+    assert len(list(m.frames(camera="back"))) == 2
+
+    # removed images and directories are forgotten, along with what was done with them
+    m.mark_processed(m.frames(camera="front"), "ingest")
+    os.unlink(join(root, "front", "2024-01", "20240101T100000.jpg"))
+    for name in os.listdir(join(root, "front", "2024-02")):
+        os.unlink(join(root, "front", "2024-02", name))
+    os.rmdir(join(root, "front", "2024-02"))
+    assert m.update(root) == 0
+    assert len(list(m.frames(camera="front"))) == 2
+    assert len(list(m.frames(camera="front", unprocessed_by="ingest"))) == 0
+
+    # a file rewritten in place is only seen by a full update
+    path = join(root, "back", "2024-01", "20240101T120000.jpg")
+    write_jpeg(path, w=80, h=60)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    os.utime(dirname(path), ns=(st.st_atime_ns, os.stat(dirname(path)).st_mtime_ns))
+    assert m.update(root, full=True) == 1
+    assert [f.w for f in m.frames(camera="back")] == [80, 40]
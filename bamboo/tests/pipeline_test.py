@@ -0,0 +1,321 @@
+"""
+Tests for the pipelines
+"""
+
+import pytest
+import sys
+import time
+import threading
+import asyncio
+import json
+import os
+import pstats
+
+from os.path import abspath, dirname, join
+
+import numpy as np
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.frame import Frame,Tag
+from bamboo.stage import Stage,BatchStage
+from bamboo.pipeline import SingleThreadedPipeline,ThreadedPipeline,ProcessPoolPipeline,AsyncPipeline,DROP_OLDEST
+from bamboo.profiling import CPROFILE_SEES_ALL_THREADS
+from bamboo.trace import frame_id
+
+
+class Sleep(Stage):
+    """Sleeps (releasing the GIL) and passes the frame on"""
+    def __init__(self, delay=0.0):
+        super().__init__()
+        self.delay = delay
+    def process(self, f:Frame):
+        time.sleep(self.delay)
+        self.output(f)
+
+class Collect(Stage):
+    """Collects every frame it sees"""
+    parallel = False
+    def __init__(self):
+        super().__init__()
+        self.frames = []
+        self.clock = threading.Lock()
+    def process(self, f:Frame):
+        with self.clock:
+            self.frames.append(f)
+        self.output(f)
+
+class Brighten(Stage):
+    """Outputs a modified copy of the frame and a crop of the original"""
+    def process(self, f:Frame):
+        self.output(f.crop(xy=(1,2), w=3, h=4))
+        f = f.writable_copy()
+        f.img_ += 1
+        self.output(f)
+
+class Batcher(BatchStage):
+    """Records the size of each batch"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sizes = []
+    def process_batch(self, frames):
+        self.sizes.append(len(frames))
+        return frames
+
+def make_frames(n):
+    return [Frame(img=np.zeros((8,8,3), dtype=np.uint8)) for i in range(n)]
+
+
+def test_single_threaded():
+    frames = make_frames(10)
+    p = SingleThreadedPipeline()
+    p.addLinearPipeline([Sleep(), c := Collect()])
+    p.process_list(frames)
+    assert c.frames == frames
+
+
+class FanOut(Stage):
+    """Outputs each frame n times"""
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+    def process(self, f:Frame):
+        for i in range(self.n):
+            self.output(f)
+
+
+def test_single_threaded_bounded():
+    p = SingleThreadedPipeline(queue_limit=3)
+    p.addLinearPipeline([FanOut(10), c := Collect()])
+    p.process_list(make_frames(2))
+    assert len(c.frames) == 20
+    assert p.queues[c].high_water == 3
+    assert p.queues[c].dropped == 0
+
+
+def test_drop_oldest():
+    frames = make_frames(3)
+    p = SingleThreadedPipeline(queue_limits={'Collect':(4, DROP_OLDEST)})
+    p.addLinearPipeline([FanOut(10), c := Collect()])
+    p.process_list(frames)
+    assert len(c.frames) == 12
+    assert p.queues[c].dropped == 18
+    assert p.queues[c].high_water == 4
+
+
+@pytest.mark.parametrize("pipeline", [ProcessPoolPipeline, AsyncPipeline])
+def test_queue_limits(pipeline):
+    with pipeline(queue_limits={'Collect':(4, DROP_OLDEST)}) as p:
+        p.addLinearPipeline([FanOut(10), c := Collect()])
+        p.process_list(make_frames(3))
+    q = p.queues[c]
+    assert q.dropped > 0 and q.high_water == 4
+    assert len(c.frames) + q.dropped == 30
+
+    with pipeline(queue_limit=4) as p:
+        p.addLinearPipeline([FanOut(10), c := Collect()])
+        p.process_list(make_frames(3))
+    assert len(c.frames) == 30
+    assert p.queues[c].dropped == 0
+
+
+def test_threaded():
+    frames = make_frames(16)
+    with ThreadedPipeline(workers=8, queue_limit=2) as p:
+        p.addLinearPipeline([s := Sleep(0.05), c := Collect()])
+        t0 = time.time()
+        p.process_stream(frames)
+        elapsed = time.time() - t0
+    assert sorted(map(id,c.frames)) == sorted(map(id,frames))
+    assert s.count == 16
+    assert elapsed < 16 * 0.05 / 2          # the sleeps overlapped
+
+
+def test_threaded_error():
+    class Fail(Stage):
+        def process(self, f:Frame):
+            raise ValueError("bad frame")
+    p = ThreadedPipeline(workers=2)
+    p.addLinearPipeline([Fail(), Collect()])
+    with pytest.raises(ValueError):
+        p.process_list(make_frames(3))
+    p.close()
+
+
+def test_process_pool():
+    frames = make_frames(6)
+    for (i,f) in enumerate(frames):
+        f.img_[...] = np.arange(8*8*3, dtype=np.uint8).reshape(8,8,3) + i
+    with ProcessPoolPipeline(processes=2) as p:
+        p.addLinearPipeline([Brighten(), Sleep(), c := Collect()])
+        p.process_list(frames)
+        assert not p.segments   # every shared memory segment was released
+    assert len(c.frames) == 12
+    crops    = sorted([f for f in c.frames if f.img.shape==(4,3,3)], key=lambda f:f.img[0,0,0])
+    brighter = sorted([f for f in c.frames if f.img.shape==(8,8,3)], key=lambda f:f.img[0,0,0])
+    for (i,(crop,bright)) in enumerate(zip(crops,brighter)):
+        assert (crop.img == frames[i].img[2:6, 1:4]).all()
+        assert (bright.img == frames[i].img + 1).all()
+        assert crop.history[-1] == ('crop', ((1,2),(3,4)))
+
+
+@pytest.mark.parametrize("pipeline", [SingleThreadedPipeline,
+                                      lambda: ThreadedPipeline(workers=1),
+                                      lambda: ThreadedPipeline(workers=4),
+                                      lambda: ProcessPoolPipeline(processes=1, max_pending=4),
+                                      AsyncPipeline])
+def test_batch_stage(pipeline):
+    frames = make_frames(10)
+    with pipeline() as p:
+        p.addLinearPipeline([b := Batcher(batch_size=4, max_wait=1.0), c := Collect()])
+        p.process_list(frames)
+    assert len(c.frames) == 10
+    assert b.count == 10
+    if isinstance(p, ThreadedPipeline) and p.workers > 1:
+        # several workers share the queue, so the batches are split between them
+        assert sum(b.sizes) == 10 and max(b.sizes) <= 4
+    elif not isinstance(p, ProcessPoolPipeline):
+        assert b.sizes == [4,4,2]   # the batch sizes are only visible in this process
+
+
+def test_batch_queue_limit():
+    """A queue limit below the batch size is raised to it, so that batches can fill"""
+    with ThreadedPipeline(workers=1, queue_limit=2) as p:
+        p.addLinearPipeline([b := Batcher(batch_size=4, max_wait=1.0), c := Collect()])
+        p.process_list(make_frames(10))
+    assert p.queues[b].limit == 4 and p.queues[c].limit == 2
+    assert b.sizes == [4,4,2]
+    assert len(c.frames) == 10
+
+
+def test_batch_stage_close():
+    """Closing stops every worker of a batch stage, even when one batch takes several stops"""
+    for _ in range(5):
+        with ThreadedPipeline(workers=4) as p:
+            p.addLinearPipeline([Batcher(batch_size=8, max_wait=0.01), c := Collect()])
+            p.process_list(make_frames(3))
+        assert len(c.frames) == 3
+        assert p.threads == []
+
+
+class Fetch(Stage):
+    """Asks a server about each frame, like an S3 or Rekognition stage"""
+    def __init__(self, port):
+        super().__init__()
+        self.port = port
+        self.in_flight = 0
+        self.max_in_flight = 0
+    async def process(self, f:Frame):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        (reader, writer) = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write(b"frame\n")
+        f = f.copy()
+        f.add_tag(Tag('reply', text=await reader.readline()))
+        writer.close()
+        self.in_flight -= 1
+        self.output(f)
+
+def test_async_pipeline():
+    async def handle(reader, writer):
+        await reader.readline()
+        await asyncio.sleep(0.1)            # network round trip
+        writer.write(b"ok\n")
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        p = AsyncPipeline(stage_concurrency={'Fetch':20})
+        p.addLinearPipeline([fetch := Fetch(port), Sleep(0.01), c := Collect()])
+        t0 = time.time()
+        await p.run_stream(make_frames(40))
+        elapsed = time.time() - t0
+        server.close()
+        return (fetch, c, elapsed)
+
+    (fetch, c, elapsed) = asyncio.run(run())
+    assert len(c.frames) == 40
+    assert all(f.tags[0].text == b"ok\n" for f in c.frames)
+    assert fetch.max_in_flight == 20
+    assert elapsed < 40 * 0.1 / 4
+
+
+@pytest.mark.parametrize("pipeline", [ThreadedPipeline, ProcessPoolPipeline])
+def test_trace(pipeline, tmp_path):
+    trace = join(tmp_path, "trace.json")
+    with pipeline(trace=trace) as p:
+        p.addLinearPipeline([Sleep(0.01), Collect()])
+        p.process_list(make_frames(5))
+    with open(trace) as f:
+        events = json.load(f)['traceEvents']
+    spans = [e for e in events if e['ph']=='X']
+    assert len(spans) == 10
+    assert {e['name'] for e in spans} == {'Sleep','Collect'}
+    for e in spans:
+        assert len(e['args']['frames']) == 1 and e['args']['frames'][0].startswith('frame:')
+        assert e['dur'] >= 0 and 'queue_wait_us' in e['args']
+    # each frame has its own id, which both stages give it
+    for name in ('Sleep', 'Collect'):
+        assert len({e['args']['frames'][0] for e in spans if e['name']==name}) == 5
+    assert ({e['args']['frames'][0] for e in spans if e['name']=='Sleep'} ==
+            {e['args']['frames'][0] for e in spans if e['name']=='Collect'})
+    assert min(e['dur'] for e in spans if e['name']=='Sleep') >= 10000
+
+
+def test_frame_id():
+    """Frames from a camera share a uri, but not an id"""
+    frames = make_frames(2)
+    for f in frames:
+        f.uri = 'camera:door'
+    ids = [frame_id(f) for f in frames]
+    assert ids[0] != ids[1] and all(i.startswith('camera:door#') for i in ids)
+    assert frame_id(frames[0].copy()) == ids[0]
+
+
+def busy_work(seconds):
+    t0 = time.time()
+    while time.time() - t0 < seconds:
+        sum(range(1000))
+
+class Busy(Stage):
+    def process(self, f:Frame):
+        busy_work(0.02)
+        self.output(f)
+
+class AsyncBusy(Stage):
+    async def process(self, f:Frame):
+        await asyncio.sleep(0)
+        busy_work(0.02)
+        self.output(f)
+
+@pytest.mark.parametrize("pipeline,method", [(SingleThreadedPipeline, 'cprofile'),
+                                             (ThreadedPipeline, 'cprofile'),
+                                             (ThreadedPipeline, 'sample'),
+                                             (ProcessPoolPipeline, 'cprofile'),
+                                             (ProcessPoolPipeline, 'sample'),
+                                             (AsyncPipeline, 'cprofile'),
+                                             (AsyncPipeline, 'sample')])
+def test_profile_stages(pipeline, method, tmp_path):
+    # an AsyncPipeline profiles a coroutine stage, and a stage that runs in its threads
+    names = ['AsyncBusy', 'Busy'] if pipeline is AsyncPipeline else ['Busy']
+    with pipeline(profile_stages=set(names), profile_dir=tmp_path, profile_method=method) as p:
+        p.addLinearPipeline([AsyncBusy(), Busy(), Collect()] if pipeline is AsyncPipeline else [Busy(), Collect()])
+        p.process_list(make_frames(5))
+    if pipeline is AsyncPipeline or (pipeline is ThreadedPipeline and method == 'cprofile' and CPROFILE_SEES_ALL_THREADS):
+        assert p.profiler.method == 'sample'
+        method = 'sample'
+    if method == 'cprofile':
+        assert os.listdir(tmp_path) == ['Busy.pstats']
+        stats = pstats.Stats(join(tmp_path, 'Busy.pstats')).stats
+        calls = {func[2]:stat[1] for (func,stat) in stats.items()}
+        assert calls['busy_work'] == 5
+        assert 'make_frames' not in calls
+    else:
+        assert sorted(os.listdir(tmp_path)) == [name + '.collapsed' for name in names]
+        for name in names:
+            with open(join(tmp_path, name + '.collapsed')) as f:
+                lines = f.read().splitlines()
+            assert all(line.startswith(f'{name};process') for line in lines)
+            assert any('busy_work' in line for line in lines)
@@ -0,0 +1,98 @@
+"""
+Tests for reading image headers
+"""
+
+import sys
+import struct
+from datetime import datetime
+
+from os.path import dirname, join
+
+import cv2
+import numpy as np
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.probe import probe,probe_bytes,jpeg_dimensions
+from bamboo.frame import Frame
+
+
+def exif_tiff(orientation, capture_time):
+    """Little-endian EXIF with an Orientation in IFD0 and a DateTimeOriginal in the Exif IFD"""
+    dto = capture_time.encode() + b'\x00'
+    ifd0 = 8
+    exif_ifd = ifd0 + 2 + 2*12 + 4
+    dto_offset = exif_ifd + 2 + 12 + 4
+    return (b'II*\x00' + struct.pack('<I', ifd0) +
+            struct.pack('<H', 2) +
+            struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0) +
+            struct.pack('<HHII', 0x8769, 4, 1, exif_ifd) + struct.pack('<I', 0) +
+            struct.pack('<H', 1) +
+            struct.pack('<HHII', 0x9003, 2, len(dto), dto_offset) + struct.pack('<I', 0) +
+            dto)
+
+def jpeg_with_exif(img, orientation, capture_time):
+    data = cv2.imencode('.jpg', img)[1].tobytes()
+    app1 = b'Exif\x00\x00' + exif_tiff(orientation, capture_time)
+    return data[:2] + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + data[2:]
+
+def box(typ, payload):
+    return struct.pack('>I', 8 + len(payload)) + typ + payload
+
+def full_box(typ, payload, version=0, flags=0):
+    return box(typ, struct.pack('>I', (version << 24) | flags) + payload)
+
+def heic(width, height, irot, capture_time):
+    """A HEIC file with a primary item 1 and an Exif item 2, and no image data"""
+    exif = struct.pack('>I', 6) + b'Exif\x00\x00' + exif_tiff(1, capture_time)
+    ftyp = box(b'ftyp', b'heic' + struct.pack('>I', 0) + b'mif1heic')
+
+    def meta(exif_offset):
+        iinf = full_box(b'iinf', struct.pack('>H', 2) +
+                        full_box(b'infe', struct.pack('>HH', 1, 0) + b'hvc1\x00', version=2) +
+                        full_box(b'infe', struct.pack('>HH', 2, 0) + b'Exif\x00', version=2))
+        iloc = full_box(b'iloc', bytes([0x44, 0x00]) + struct.pack('>H', 1) +
+                        struct.pack('>HHHII', 2, 0, 1, exif_offset, len(exif)))
+        ipco = box(b'ipco', full_box(b'ispe', struct.pack('>II', width, height)) + box(b'irot', bytes([irot])))
+        ipma = full_box(b'ipma', struct.pack('>IHB', 1, 1, 2) + bytes([0x81, 0x02]))
+        return full_box(b'meta', full_box(b'pitm', struct.pack('>H', 1)) + iinf + iloc +
+                        box(b'iprp', ipco + ipma))
+
+    size = len(ftyp) + len(meta(0)) + 8
+    return ftyp + meta(size) + box(b'mdat', exif)
+
+
+def test_jpeg(tmp_path):
+    img = np.zeros((20,40,3), dtype=np.uint8)
+    path = join(tmp_path, "rotated.jpg")
+    with open(path, "wb") as f:
+        f.write(jpeg_with_exif(img, 6, "2023:07:04 12:30:15"))
+    info = probe(path)
+    assert (info.width, info.height, info.components) == (40, 20, 3)
+    assert info.orientation == 6
+    assert info.display_size == (20, 40)
+    assert info.capture_time == datetime(2023, 7, 4, 12, 30, 15)
+    # the dimensions of the frame are those of the image OpenCV decodes
+    f = Frame(path=path)
+    assert (f.h, f.w) == cv2.imread(path).shape[:2] == (40, 20)
+    with open(path, "rb") as fd:
+        assert jpeg_dimensions(fd.read()) == (40, 20)
+
+
+def test_jpeg_without_exif():
+    info = probe_bytes(cv2.imencode('.jpg', np.zeros((7,9), dtype=np.uint8))[1].tobytes())
+    assert (info.width, info.height, info.components, info.orientation) == (9, 7, 1, 1)
+    assert info.capture_time is None
+    assert probe_bytes(b'not an image') is None
+    assert probe_bytes(b'\xff\xd8\xff\xe1\x00') is None      # truncated
+
+
+def test_heic(tmp_path):
+    path = join(tmp_path, "photo.heic")
+    with open(path, "wb") as f:
+        f.write(heic(4032, 3024, 3, "2024:02:29 08:00:01"))
+    info = probe(path)
+    assert (info.width, info.height) == (4032, 3024)
+    assert info.orientation == 6
+    assert info.display_size == (3024, 4032)
+    assert info.capture_time == datetime(2024, 2, 29, 8, 0, 1)
@@ -0,0 +1,82 @@
+"""
+Tests for regions of interest
+"""
+
+import pickle
+import sys
+
+from os.path import dirname, join
+
+import cv2
+import numpy as np
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.roi import ROI
+from bamboo.frame import Frame
+from bamboo.image_utils import img_sim,SimilarityEngine,SimilarityCascade,SKIMAGE
+
+# the bottom half of the image, without the clock in its bottom-left corner
+BOTTOM = ROI(include=[[(0, 0.5), (1, 0.5), (1, 1), (0, 1)]],
+             exclude=[[(0, 0.9), (0.25, 0.9), (0.25, 1), (0, 1)]])
+
+def test_roi():
+    assert BOTTOM.pixel_box(200, 100) == (0, 50, 200, 50)
+    img = np.arange(100*200, dtype=np.uint32).reshape(100, 200)
+    (crop, origin) = BOTTOM.crop(img)
+    assert origin == (0, 50)
+    assert crop.shape == (50, 200) and crop.base is not None
+    mask = BOTTOM.box_mask(200, 50)
+    assert mask.shape == (50, 200)
+    assert mask[10, 10] == 255 and mask[45, 10] == 0 and mask[45, 100] == 255
+    assert BOTTOM.box_mask(200, 50) is mask
+    assert not mask.flags.writeable
+    assert BOTTOM.contains(100, 75, 200, 100)
+    assert not BOTTOM.contains(100, 25, 200, 100)   # above the ROI
+    assert not BOTTOM.contains(10, 95, 200, 100)    # on the clock
+    assert ROI().pixel_box(200, 100) == (0, 0, 200, 100)
+    assert ROI.from_config(None) is None
+    assert ROI.from_config({'include':BOTTOM.include, 'exclude':BOTTOM.exclude}).key == BOTTOM.key
+    assert pickle.loads(pickle.dumps(BOTTOM)).key == BOTTOM.key
+
+
+def scene(seed=0, w=320, h=240):
+    rng = np.random.default_rng(seed)
+    img = cv2.resize(rng.integers(0, 255, (h//8, w//8, 3), dtype=np.uint8), (w, h), interpolation=cv2.INTER_CUBIC)
+    return img
+
+def test_roi_similarity():
+    a = scene()
+    b = a.copy()
+    # the clock and the sky change; neither is in the ROI
+    cv2.rectangle(b, (0, 220), (70, 239), (255, 255, 255), thickness=-1)
+    cv2.rectangle(b, (0, 0), (319, 100), (0, 0, 0), thickness=-1)
+    assert img_sim(a, b) < 0.8
+    assert img_sim(a, b, roi=BOTTOM) > 0.99
+    for engine in (SimilarityEngine(roi=BOTTOM), SimilarityEngine(max_side=None, method=SKIMAGE, roi=BOTTOM)):
+        assert engine.compare(engine.prepare(a), engine.prepare(b)) > 0.99
+    assert SimilarityEngine().key != SimilarityEngine(roi=BOTTOM).key
+    cascade = SimilarityCascade(0.9, roi=BOTTOM)
+    assert cascade.similarity(Frame(img=a), Frame(img=b)) > 0.95
+    assert SimilarityCascade(0.9).similarity(Frame(img=a), Frame(img=b)) < 0.9
+
+    # a change in the ROI is still seen
+    c = a.copy()
+    cv2.rectangle(c, (150, 130), (250, 210), (0, 0, 255), thickness=-1)
+    assert cascade.similarity(Frame(img=a), Frame(img=c)) < 0.9
+
+
+def test_roi_frame_files(tmp_path):
+    a = scene(w=1280, h=960)
+    b = a.copy()
+    cv2.rectangle(b, (0, 0), (1279, 400), (0, 0, 0), thickness=-1)
+    paths = [join(tmp_path, name) for name in ("a.jpg", "b.jpg")]
+    for (path, img) in zip(paths, (a, b)):
+        cv2.imwrite(path, img)
+    (fa, fb) = (Frame(path=paths[0]), Frame(path=paths[1]))
+    engine = SimilarityEngine(max_side=160, roi=BOTTOM)
+    # the crop of the reduced image is still at least max_side
+    assert max(fa.sim_image(engine).shape) >= 160
+    assert fa.similarity(fb, engine) > 0.95
+    assert fa.similarity(fb, SimilarityEngine(max_side=160)) < 0.8
+    assert fa.signature(roi=BOTTOM)[1].shape != fa.signature()[1].shape
@@ -0,0 +1,66 @@
+"""
+Tests for listing directories of frames
+"""
+
+import os
+import sys
+import mimetypes
+
+from os.path import dirname, join
+
+import pytest
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.scan import scan,frame_type
+import bamboo.source as s
+
+
+def walk_sorted(root):
+    """What FrameStream used to list: os.walk() with sorted names"""
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            mtype = mimetypes.guess_type(fname)[0]
+            path = join(dirpath, fname)
+            if mtype and mtype.split("/")[0] in ['video','image'] and os.path.getsize(path) > 0:
+                yield path
+
+@pytest.fixture
+def tree(tmp_path):
+    for (d, names) in [("cam1/2024-01", ["b.jpg", "a.JPG", "notes.txt", "c.mp4"]),
+                       ("cam1/2024-02", ["z.png", "empty.jpg"]),
+                       ("cam1/2024-02/sub", ["y.jpg"]),
+                       ("cam10", ["x.jpeg"]),
+                       ("cam2", []),
+                       ("", ["top.heic"])]:
+        os.makedirs(join(tmp_path, d), exist_ok=True)
+        for name in names:
+            with open(join(tmp_path, d, name), "wb") as f:
+                f.write(b'' if name.startswith('empty') else b'data')
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_scan(tree, threads):
+    found = list(scan(tree, threads))
+    assert [path for (path, _, _) in found] == list(walk_sorted(tree))
+    assert [os.path.basename(path) for (path, _, _) in found] == \
+        ["top.heic", "a.JPG", "b.jpg", "c.mp4", "z.png", "y.jpg", "x.jpeg"]
+    for (path, mtype, st) in found:
+        assert mtype == mimetypes.guess_type(path)[0]
+        assert st.st_size == 4
+    assert frame_type("notes.txt") is None
+
+
+def test_scan_stop_early(tree):
+    it = scan(tree, 4)
+    assert next(it)[0].endswith("top.heic")
+    it.close()
+
+
+def test_frame_stream_scan(tree):
+    frames = list(s.FrameStream(tree, s.SourceOptions(scan_threads=2)))
+    # c.mp4 is not a video that can be decoded, so it gives no frames
+    assert [f.path for f in frames] == [path for path in walk_sorted(tree) if not path.endswith(".mp4")]
+    assert all(f.mtime == os.stat(f.path).st_mtime for f in frames)
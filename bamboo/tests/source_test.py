@@ -1,12 +1,142 @@
 import sys
+import threading
+import pytest
 from os.path import dirname,basename,join,abspath
 
 sys.path.append( dirname(dirname(dirname(abspath(__file__)))))
 
+from datetime import datetime
+
+import cv2
+import numpy as np
+
 import bamboo.face_deepface as face_deepface
 import bamboo.source as s
+from bamboo.frame import frame_cache,CACHE_IMAGE
+from bamboo.tests.probe_test import jpeg_with_exif
 
 def test_source_options():
-    s = s.SourceOptions(limit=10, mime_type='foo/bar')
-    assert s.limit==10
-    assert s.mime_type=='foo/bar'
+    so = s.SourceOptions(limit=10, mime_type='foo/bar')
+    assert so.limit==10
+    assert so.mime_type=='foo/bar'
+    assert so.start is None and so.score == s.DEFAULT_SCORE
+
+
+def test_frame_stream_window(tmp_path):
+    """Frames are selected by the time in their name or EXIF without being decoded"""
+    img = np.zeros((20,40,3), dtype=np.uint8)
+    cv2.imwrite(join(tmp_path, "2024-01-01T10:00:00.jpg"), img)
+    cv2.imwrite(join(tmp_path, "2024-01-01T12:00:00.jpg"), img)
+    with open(join(tmp_path, "IMG_0001.jpg"), "wb") as f:
+        f.write(jpeg_with_exif(img, 6, "2024:01:01 11:00:00"))
+    misses = frame_cache.stats()['misses']
+    o = s.SourceOptions(start=datetime(2024,1,1,10,30), end=datetime(2024,1,1,12))
+    frames = list(s.FrameStream(str(tmp_path), o))
+    assert [basename(f.path) for f in frames] == ["IMG_0001.jpg"]
+    assert frames[0].mtime == datetime(2024,1,1,11).timestamp()
+    assert (frames[0].w, frames[0].h) == (20, 40)
+    assert frame_cache.stats()['misses'] == misses      # nothing was read through the cache
+
+
+def test_dissimilar_prefilter(tmp_path):
+    """The prefilter keeps the same frames as comparing every frame in full"""
+    rng = np.random.default_rng(0)
+    scene = cv2.resize(rng.integers(0, 255, (24,32,3), dtype=np.uint8), (320,240))
+    for i in range(12):
+        img = np.clip(scene + rng.normal(0, 2, scene.shape), 0, 255).astype(np.uint8)
+        if 4 <= i < 8:
+            cv2.rectangle(img, (40*i - 100, 60), (40*i - 40, 220), (0,0,255), thickness=-1)
+        cv2.imwrite(join(tmp_path, f"2024-01-01T10:00:{i:02}.jpg"), img)
+    full = [f.path for f in s.DissimilarFrameStream(str(tmp_path), s.SourceOptions(prefilter=False))]
+    fast = [f.path for f in s.DissimilarFrameStream(str(tmp_path), s.SourceOptions(prefilter=True))]
+    assert fast == full
+    assert 1 < len(full) < 12
+
+
+@pytest.mark.parametrize("prefilter", [False, True])
+def test_dissimilar_threads(tmp_path, prefilter):
+    """Looking ahead in threads keeps the same frames, in the same order"""
+    rng = np.random.default_rng(1)
+    scene = cv2.resize(rng.integers(0, 255, (24,32,3), dtype=np.uint8), (320,240))
+    for i in range(40):
+        img = np.clip(scene + rng.normal(0, 2, scene.shape), 0, 255).astype(np.uint8)
+        if i % 10 >= 6:
+            cv2.rectangle(img, (30*(i%10) - 150, 60), (30*(i%10) - 90, 220), (0,0,255), thickness=-1)
+        cv2.imwrite(join(tmp_path, f"2024-01-01T10:00:{i:02}.jpg"), img)
+    with open(join(tmp_path, "2024-01-01T10:00:07.5.jpg"), "wb") as f:
+        f.write(b"not a jpeg")      # skipped by both
+    one  = [f.path for f in s.DissimilarFrameStream(str(tmp_path), s.SourceOptions(prefilter=prefilter))]
+    many = [f.path for f in s.DissimilarFrameStream(str(tmp_path), s.SourceOptions(prefilter=prefilter, threads=4))]
+    assert many == one
+    assert 4 < len(one) < 40
+
+
+def test_motion(tmp_path):
+    rng = np.random.default_rng(2)
+    scene = cv2.resize(rng.integers(0, 255, (24,32,3), dtype=np.uint8), (640,480))
+    for i in range(20):
+        img = np.clip(scene + rng.normal(0, 2, scene.shape), 0, 255).astype(np.uint8)
+        if i in (12, 16):
+            cv2.rectangle(img, (200, 120), (299, 399), (0,0,255), thickness=-1)
+        cv2.imwrite(join(tmp_path, f"2024-01-01T10:00:{i:02}.jpg"), img)
+    frames = list(s.MotionFrameStream(str(tmp_path), s.SourceOptions(motion_side=160)))
+    assert [basename(f.path) for f in frames] == ["2024-01-01T10:00:00.jpg",
+                                                  "2024-01-01T10:00:12.jpg",
+                                                  "2024-01-01T10:00:16.jpg"]
+    assert frames[0].tags == ()
+    for f in frames[1:]:
+        (tag,) = f.tags
+        assert tag.tag_type == 'motion'
+        (x, y) = tag.xy
+        assert abs(x - 200) <= 12 and abs(y - 120) <= 12     # in full-resolution coordinates
+        assert abs(tag.w - 100) <= 24 and abs(tag.h - 280) <= 24
+
+
+def test_motion_sizes(tmp_path):
+    """A change of frame size restarts the background model rather than failing"""
+    rng = np.random.default_rng(4)
+    for (start, size) in ((0, (640,480)), (12, (480,640))):
+        scene = cv2.resize(rng.integers(0, 255, (24,32,3), dtype=np.uint8), size)
+        for i in range(start, start + 12):
+            img = np.clip(scene + rng.normal(0, 2, scene.shape), 0, 255).astype(np.uint8)
+            if i == 22:
+                cv2.rectangle(img, (100, 200), (299, 479), (0,0,255), thickness=-1)
+            cv2.imwrite(join(tmp_path, f"2024-01-01T10:00:{i:02}.jpg"), img)
+    frames = list(s.MotionFrameStream(str(tmp_path), s.SourceOptions(motion_side=160)))
+    assert [basename(f.path) for f in frames] == ["2024-01-01T10:00:00.jpg",
+                                                  "2024-01-01T10:00:12.jpg",
+                                                  "2024-01-01T10:00:22.jpg"]
+    assert frames[0].tags == () and frames[1].tags == ()
+    (tag,) = frames[2].tags
+    assert tag.tag_type == 'motion'
+
+
+def test_prefetch(tmp_path):
+    rng = np.random.default_rng(3)
+    for i in range(20):
+        cv2.imwrite(join(tmp_path, f"2024-01-02T10:00:{i:02}.jpg"), rng.integers(0, 255, (60,80,3), dtype=np.uint8))
+    frame_cache.clear()
+    expected = [f.path for f in s.FrameStream(str(tmp_path))]
+    loaded = []
+    done = {path: threading.Event() for path in expected}     # set when the prefetcher has loaded path
+    def load(f):
+        loaded.append(f.path)
+        img = f.img
+        done[f.path].set()
+        return img
+    prefetch = s.Prefetch(s.FrameStream(str(tmp_path)), depth=4, workers=2, load=load)
+    paths = []
+    for f in prefetch:
+        assert len(loaded) <= len(paths) + 4           # never more than depth ahead
+        assert done[f.path].wait(10)                   # the prefetcher, not the consumer, loads it
+        assert (CACHE_IMAGE, f.path) in frame_cache
+        assert f.img.shape == (60, 80, 3)
+        paths.append(f.path)
+    assert paths == expected
+    assert sorted(loaded) == paths                     # each image was loaded once
+    assert prefetch.ready + prefetch.waiting == 20
+
+    # stopping early leaves nothing running
+    for (i, f) in enumerate(s.Prefetch(s.FrameStream(str(tmp_path)), depth=4)):
+        if i == 2:
+            break
@@ -0,0 +1,42 @@
+"""
+Tests for the timing statistics
+"""
+
+import pickle
+import random
+import sys
+
+from os.path import dirname, join
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.stats import LatencyHistogram,StageStats
+
+def test_percentiles():
+    random.seed(0)
+    samples = [random.expovariate(100) for i in range(10000)]
+    h = LatencyHistogram()
+    for t in samples:
+        h.add(t)
+    samples.sort()
+    for p in (50, 90, 99):
+        exact = samples[int(len(samples) * p / 100) - 1]
+        assert abs(h.percentile(p) - exact) / exact < 0.05
+    assert h.percentile(100) == h.max == samples[-1]
+    assert abs(h.mean - sum(samples)/len(samples)) < 1e-9
+
+
+def test_merge():
+    a = StageStats()
+    b = StageStats()
+    for i in range(1,101):
+        a.add(i/1000, wait=0.5, end=100+i)
+        b.add(i/100,  wait=0.1, end=300+i)
+    b = pickle.loads(pickle.dumps(b))   # as if from a worker process
+    a.merge(b)
+    assert a.timing.count == 200
+    assert a.wait.count == 200
+    assert a.timing.max == 1.0
+    assert a.first == 101 - 0.001
+    assert a.last  == 400
+    assert 'p99' in a.summary()
@@ -0,0 +1,110 @@
+"""
+Tests for decoding video with ffmpeg
+"""
+
+import sys
+
+from os.path import dirname, join
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.append(join(dirname(dirname(dirname(__file__)))))
+
+from bamboo.video import ffmpeg_path,sampling_args,parse_showinfo,parse_version,passthrough_args,BufferPool,ffmpeg_frames
+import bamboo.source as s
+
+needs_ffmpeg = pytest.mark.skipif(ffmpeg_path() is None, reason="ffmpeg is not installed")
+
+SHOWINFO = ("[Parsed_showinfo_1 @ 0x600003b6c000] n:   3 pts:  12288 pts_time:0.8     duration:   512 "
+            "duration_time:0.0333333 fmt:yuv420p cl:left sar:1/1 s:640x480 i:P iskey:0 type:P "
+            "checksum:5B9B6A27 plane_checksum:[B5C3D4AE 3F1C6D2D 66E3C8AA] mean:[91 126 129] stdev:[58.8 5.5 6.4]")
+
+def test_sampling_args():
+    assert sampling_args(None) == ([], [])
+    assert sampling_args('keyframes') == (['-skip_frame', 'nokey'], [])
+    assert sampling_args('fps=0.5') == ([], ['fps=0.5'])
+    assert sampling_args(2) == ([], ['fps=2'])
+    assert sampling_args('every=10') == ([], ['select=not(mod(n\\,10))'])
+    for bad in ('every=0', 'every=x', 'sometimes'):
+        with pytest.raises(ValueError):
+            sampling_args(bad)
+
+
+def test_parse_showinfo():
+    assert parse_showinfo(SHOWINFO) == (3, 0.8, 640, 480)
+    assert parse_showinfo("[Parsed_showinfo_1 @ 0x6000] config in time_base: 1/15360, frame_rate: 30/1") is None
+    assert parse_showinfo("Stream #0:0: Video: h264, yuv420p, 640x480") is None
+
+
+def test_passthrough_args():
+    assert parse_version("ffmpeg version 4.4.2-0ubuntu0.22.04.1 Copyright (c) 2000-2021") == (4, 4)
+    assert parse_version("ffmpeg version n6.1.1 Copyright (c) 2000-2023") == (6, 1)
+    assert parse_version("ffmpeg version N-113000-g1c2d3e4 Copyright (c) 2000-2024") is None
+    assert passthrough_args((4, 4)) == ['-vsync', 'passthrough']      # -fps_mode is 5.1 and later
+    assert passthrough_args((5, 1)) == ['-fps_mode', 'passthrough']
+    assert passthrough_args(None) == ['-fps_mode', 'passthrough']
+
+
+def test_buffer_pool():
+    pool = BufferPool()
+    a = pool.get((4, 6, 3))
+    b = pool.get((4, 6, 3))
+    assert a is not b                   # a is still in use
+    view = a[1:2]
+    del a
+    assert pool.get((4, 6, 3)) is not view.base     # a view keeps it in use
+    del view
+    assert pool.get((4, 6, 3)) is pool.buffers[0]
+    assert pool.allocated == 3
+
+
+def write_video(path, n=20, fps=10, w=64, h=48):
+    """A video whose frame i is all gray level 10*i"""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
+    for i in range(n):
+        writer.write(np.full((h, w, 3), 10 * i, dtype=np.uint8))
+    writer.release()
+
+@needs_ffmpeg
+def test_ffmpeg_frames(tmp_path):
+    path = join(tmp_path, "20240301T120000.avi")
+    write_video(path)
+    frames = [(img.copy(), t) for (img, t) in ffmpeg_frames(path)]
+    assert len(frames) == 20
+    assert frames[0][0].shape == (48, 64, 3)
+    assert [round(t, 2) for (_, t) in frames[:3]] == [0.0, 0.1, 0.2]
+    assert abs(int(frames[5][0].mean()) - 50) <= 3
+
+    kept = list(ffmpeg_frames(path, sampling='every=5'))
+    assert len(kept) == 4
+    assert len({id(img) for (img, _) in kept}) == 4     # frames that are kept are not overwritten
+    assert [round(t, 2) for (_, t) in kept] == [0.0, 0.5, 1.0, 1.5]
+    assert len(list(ffmpeg_frames(path, sampling='fps=2'))) in (4, 5)
+    assert len(list(ffmpeg_frames(path, sampling='keyframes'))) == 20  # every MJPEG frame is a key frame
+    assert all(img.shape == (24, 32, 3) for (img, _) in ffmpeg_frames(path, size=(32, 24)))
+
+
+@needs_ffmpeg
+def test_video_frame_stream(tmp_path):
+    path = join(tmp_path, "20240301T120000.avi")
+    write_video(path)
+    frames = list(s.FrameStream(path, s.SourceOptions(sampling='every=10')))
+    assert len(frames) == 2
+    assert frames[1].src.startswith("file://") and frames[1].src.endswith("20240301T120000.avi#t=1.000")
+    assert frames[1].mtime - frames[0].mtime == pytest.approx(1.0)
+    assert frames[0].path is None and frames[0].w == 64
+    assert len(list(s.FrameFromFile(path, s.SourceOptions(limit=3)))) == 3
+
+
+@needs_ffmpeg
+def test_directory_with_video(tmp_path):
+    """FrameStream of a directory decodes its videos rather than giving frames of their paths"""
+    write_video(join(tmp_path, "20240301T120000.avi"))
+    cv2.imwrite(join(tmp_path, "20240301T115959.jpg"), np.zeros((48, 64, 3), dtype=np.uint8))
+    frames = list(s.FrameStream(str(tmp_path), s.SourceOptions(sampling='every=10')))
+    assert frames[0].path.endswith(".jpg")
+    assert len(frames) == 3
+    assert all(f.path is None and f.src.endswith(("#t=0.000", "#t=1.000")) for f in frames[1:])
+    assert frames[2].img.shape == (48, 64, 3)
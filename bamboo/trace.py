@@ -0,0 +1,46 @@
+"""
+Chrome trace export of pipeline execution.
+
+When a pipeline is created with trace=path, every stage records a span for each call
+of process(): when it started, how long it took, which frame it was for, which
+process and thread ran it, and how long the frame waited in the queue first.
+When the pipeline closes, the spans are written as Chrome trace JSON, which loads
+in https://ui.perfetto.dev and chrome://tracing.
+"""
+
+import json
+import os
+
+from .frame import P_FRAME
+
+def frame_id(f):
+    """The identity of a frame in a trace: the file it came from or, for a frame made in memory,
+    where it came from (if it has a uri) and its number."""
+    (kind, value) = f.history[0]
+    if kind == P_FRAME and f.src is not None:
+        return f"{f.src}#{value}"
+    return f"{kind}:{value}"
+
+def chrome_trace(stages):
+    """Return the spans of stages as a Chrome trace dictionary. Times are in microseconds."""
+    events = []
+    threads = set()
+    for stage in stages:
+        name = stage.__class__.__name__
+        for (start, duration, frames, wait, pid, tid) in stage.spans or []:
+            args = {'frames': frames}
+            if wait is not None:
+                args['queue_wait_us'] = round(wait * 1e6)
+            events.append({'name': name, 'cat': 'stage', 'ph': 'X',
+                           'ts': round(start * 1e6), 'dur': round(duration * 1e6),
+                           'pid': pid, 'tid': tid, 'args': args})
+            threads.add((pid, tid))
+    events.sort(key=lambda e: e['ts'])
+    for (pid, tid) in sorted(threads, key=str):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                       'args': {'name': f"{'main' if pid == os.getpid() else 'worker'} {pid}/{tid}"}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def write_chrome_trace(path, stages):
+    with open(path, "w") as f:
+        json.dump(chrome_trace(stages), f)
@@ -0,0 +1,174 @@
+"""
+Decoding video with ffmpeg.
+
+ffmpeg_frames(path) - generates (img, pts_time) for the frames of a video. ffmpeg decodes and
+                      samples the video and writes raw BGR frames to a pipe, which are read
+                      into reused buffers; a showinfo filter reports the time of each frame.
+
+Sampling is done by ffmpeg, so only the frames that are wanted are converted and copied:
+
+  None            - every frame
+  'fps=2'         - 2 frames per second (a number alone also means frames per second)
+  'every=30'      - every 30th frame
+  'keyframes'     - only the key frames, which are decoded without decoding the frames between them,
+                    so this is the fastest way through a long video.
+
+ffmpeg is found with paths.ffmpeg_path() if that module is importable, and on the PATH otherwise.
+ffmpeg 4.x, as shipped by Ubuntu 22.04 and Debian 11, works as well as later versions.
+"""
+
+import re
+import sys
+import shutil
+import functools
+import threading
+import subprocess
+import collections
+import queue
+
+import numpy as np
+
+FFMPEG_STDERR_LINES = 20            # kept for the error message if ffmpeg fails
+MAX_BUFFERS = 16                    # buffers tracked for reuse
+KEYFRAMES = 'keyframes'
+
+SHOWINFO_RE = re.compile(r'\bn:\s*(\d+)\s+pts:\s*\S+\s+pts_time:\s*(\S+).*?\bs:(\d+)x(\d+)')
+VERSION_RE = re.compile(r'ffmpeg version n?(\d+)\.(\d+)')
+
+def ffmpeg_path():
+    """Return the path of ffmpeg, or None if it cannot be found"""
+    try:
+        import paths            # pylint: disable=import-outside-toplevel
+        return paths.ffmpeg_path()
+    except ImportError:
+        return shutil.which('ffmpeg')
+
+def parse_version(text):
+    """Return (major, minor) from the output of ffmpeg -version, or None if it has no
+    release number (as builds from git do not)"""
+    m = VERSION_RE.search(text)
+    return (int(m.group(1)), int(m.group(2))) if m else None
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_version(ffmpeg):
+    return parse_version(subprocess.run([ffmpeg, '-version'], capture_output=True, text=True,
+                                        stdin=subprocess.DEVNULL, check=False).stdout)
+
+def passthrough_args(version):
+    """Options that write exactly the frames that showinfo reports, without duplicating any
+    to a constant rate. ffmpeg 5.1 replaced -vsync with -fps_mode."""
+    if version is not None and version < (5, 1):
+        return ['-vsync', 'passthrough']
+    return ['-fps_mode', 'passthrough']
+
+def sampling_args(sampling):
+    """Return (input options, filters) for ffmpeg that sample a video as sampling says"""
+    if sampling is None:
+        return ([], [])
+    if isinstance(sampling, (int, float)):
+        sampling = f"fps={sampling}"
+    if sampling == KEYFRAMES:
+        return (['-skip_frame', 'nokey'], [])
+    (kind, _, value) = sampling.partition('=')
+    try:
+        if kind == 'fps' and float(value) > 0:
+            return ([], [f"fps={value}"])
+        if kind == 'every' and int(value) > 0:
+            return ([], [f"select=not(mod(n\\,{int(value)}))"])
+    except ValueError:
+        pass
+    raise ValueError(f"unknown sampling '{sampling}': use fps=N, every=N or {KEYFRAMES}")
+
+def parse_showinfo(line):
+    """Return (n, pts_time, w, h) from a line that the showinfo filter logs, or None"""
+    if 'showinfo' not in line:
+        return None
+    m = SHOWINFO_RE.search(line)
+    if m is None:
+        return None
+    return (int(m.group(1)), float(m.group(2)), int(m.group(3)), int(m.group(4)))
+
+class BufferPool:
+    """Image buffers that are reused once nothing else refers to them.
+    A frame that is kept (or a view of it) keeps its buffer from being reused, so the
+    images handed out are never overwritten."""
+    def __init__(self, max_buffers=MAX_BUFFERS):
+        self.max_buffers = max_buffers
+        self.buffers = []
+        self.allocated = 0
+
+    def get(self, shape):
+        for i in range(len(self.buffers)):
+            # if the only references are self.buffers and getrefcount's argument, it is free
+            if self.buffers[i].shape == shape and sys.getrefcount(self.buffers[i]) <= 2:
+                return self.buffers[i]
+        buf = np.empty(shape, dtype=np.uint8)
+        self.allocated += 1
+        if len(self.buffers) < self.max_buffers:
+            self.buffers.append(buf)
+        return buf
+
+def read_exactly(stream, buf):
+    """Fill buf from stream. Returns False at the end of the stream."""
+    view = memoryview(buf).cast('B')
+    got = 0
+    while got < len(view):
+        n = stream.readinto(view[got:])
+        if not n:
+            return False
+        got += n
+    return True
+
+def ffmpeg_frames(path, *, sampling=None, size=None, pool=None):
+    """Generate (img, pts_time) for the frames of the video at path.
+    :param sampling: which frames (see above)
+    :param size: (w, h) to scale the frames to, or None
+    :param pool: the BufferPool to read into
+    Each img is read-only. It is not overwritten, even if it is kept.
+    """
+    ffmpeg = ffmpeg_path()
+    if ffmpeg is None:
+        raise FileNotFoundError("ffmpeg is not installed")
+    (input_args, filters) = sampling_args(sampling)
+    if size is not None:
+        filters.append(f"scale={size[0]}:{size[1]}")
+    filters.append("showinfo=checksum=0")  # last, so it reports the frames that are written; checksums are slow
+    cmd = ([ffmpeg, '-hide_banner', '-nostdin', '-nostats', '-loglevel', 'info'] + input_args +
+           ['-i', path, '-an', '-sn', '-vf', ",".join(filters)] +
+           passthrough_args(ffmpeg_version(ffmpeg)) +
+           ['-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1'])
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    infos = queue.Queue()
+    tail = collections.deque(maxlen=FFMPEG_STDERR_LINES)
+
+    def read_stderr():
+        for line in proc.stderr:
+            line = line.decode('utf-8', errors='replace')
+            info = parse_showinfo(line)
+            if info is not None:
+                infos.put(info)
+            else:
+                tail.append(line.rstrip())
+        infos.put(None)
+
+    reader = threading.Thread(target=read_stderr, name='ffmpeg-stderr', daemon=True)
+    reader.start()
+    pool = pool or BufferPool()
+    try:
+        while (info := infos.get()) is not None:
+            (_, pts_time, w, h) = info
+            buf = pool.get((h, w, 3))
+            buf.flags.writeable = True
+            if not read_exactly(proc.stdout, buf):
+                break
+            buf.flags.writeable = False
+            yield (buf, pts_time)
+            buf = None          # so that this generator does not keep it from being reused
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed on {path}: " + "\n".join(tail))
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        reader.join()
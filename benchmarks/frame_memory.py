@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Measure the memory used by Frame objects, as held by ingest.FrameArray.
+
+Frames are created for paths named by their timestamps, as the archive names them,
+so no files need to exist. Each frame gets a face Patch.
+"""
+
+import os
+import sys
+import argparse
+import tracemalloc
+from datetime import datetime, timedelta
+from os.path import dirname, abspath
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from bamboo.frame import Frame,Patch,TAG_FACE
+
+def frame_paths(n, root="/archive/camera1"):
+    t0 = datetime(2024, 1, 1)
+    for i in range(n):
+        t = t0 + timedelta(seconds=i)
+        yield os.path.join(root, t.strftime("%Y-%m"), t.isoformat() + ".jpg")
+
+def bytes_per_frame(n, tags=True):
+    """Return the average bytes allocated per frame for n frames"""
+    paths = list(frame_paths(n))       # the path strings are not counted
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    frames = []
+    for path in paths:
+        f = Frame(path=path)
+        if tags:
+            f.add_tag(Patch(TAG_FACE, xy=(100,200), w=50, h=60, text="face"))
+        frames.append(f)
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return used / n
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=100_000)
+    parser.add_argument("--fps", type=float, default=1.0, help="frames per second, for the monthly estimate")
+    args = parser.parse_args()
+
+    month = args.fps * 60 * 60 * 24 * 31
+    for tags in (False, True):
+        b = bytes_per_frame(args.frames, tags=tags)
+        print(f"{'with' if tags else 'without'} a face tag: {b:.0f} bytes/frame; "
+              f"a month at {args.fps} fps ({month:,.0f} frames) is {b*month/2**20:,.0f} MiB")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Frames per second of a consumer reading FrameStream directly and through Prefetch.
+
+The consumer reads each frame's image and then spends --work milliseconds on it, standing in
+for a detector that runs on a GPU or in another process (so it does not use this CPU).
+Without Prefetch the read and decode happen between detections; with it they overlap them.
+
+By default a directory of synthetic 1920x1080 JPEGs is made in a temporary directory.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+from os.path import dirname, abspath, join
+
+import cv2
+import numpy as np
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+os.environ.setdefault('BAMBOO_HASH_INDEX', ':memory:')
+
+from bamboo.frame import frame_cache
+from bamboo.source import FrameStream,Prefetch
+
+def make_frames(root, n, w=1920, h=1080):
+    rng = np.random.default_rng(0)
+    scene = cv2.resize(rng.integers(0, 255, (h//8, w//8, 3), dtype=np.uint8), (w, h), interpolation=cv2.INTER_CUBIC)
+    for i in range(n):
+        img = np.clip(scene + rng.normal(0, 3, scene.shape), 0, 255).astype(np.uint8)
+        cv2.imwrite(join(root, f"2024-01-01T10:{i//60:02}:{i%60:02}.jpg"), img)
+
+def consume(frames, work):
+    t0 = time.perf_counter()
+    n = 0
+    for f in frames:
+        f.img               # pylint: disable=pointless-statement
+        time.sleep(work)
+        n += 1
+    return n / (time.perf_counter() - t0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", nargs="?", help="directory of JPEGs")
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--work", type=float, default=20, help="milliseconds of detector work per frame")
+    args = parser.parse_args()
+    work = args.work / 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.root
+        if root is None:
+            root = tmp
+            make_frames(root, args.frames)
+        frame_cache.clear()
+        print(f"{'direct':>22}: {consume(FrameStream(root), work):6.1f} fps")
+        for (depth, workers) in [(4, 1), (8, 2), (8, 4)]:
+            frame_cache.clear()
+            p = Prefetch(FrameStream(root), depth=depth, workers=workers)
+            fps = consume(p, work)
+            print(f"{f'depth={depth} workers={workers}':>22}: {fps:6.1f} fps  ready {p.ready}, waited {p.waiting}")
+
+if __name__=="__main__":
+    main()
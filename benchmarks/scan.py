@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Time to list a tree of frames: os.walk() with mimetypes.guess_type() and a getsize()
+per file (what FrameStream used to do), against scan() with 1 and more threads.
+
+By default a synthetic {camera}/{YYYY-MM}/ tree of empty-ish JPEGs is made in a temporary
+directory. Give a directory to list a real archive instead; on a network filesystem the
+threaded listing makes the most difference.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import mimetypes
+from os.path import dirname, abspath, join
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from bamboo.scan import scan
+
+def walk_sorted(root):
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            mtype = mimetypes.guess_type(fname)[0]
+            if mtype is None or mtype.split("/")[0] not in ['video','image']:
+                continue
+            path = join(dirpath, fname)
+            if os.path.getsize(path) > 0:
+                yield (path, mtype, os.path.getmtime(path))
+
+def make_tree(root, cameras, months, per_month):
+    for c in range(cameras):
+        for m in range(months):
+            d = join(root, f"camera{c}", f"2024-{m+1:02}")
+            os.makedirs(d)
+            for i in range(per_month):
+                with open(join(d, f"{i:06}.jpg"), "wb") as f:
+                    f.write(b'\xff\xd8')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", nargs="?", help="directory to list")
+    parser.add_argument("--files", type=int, default=2000, help="files per directory of the synthetic tree")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.root
+        if root is None:
+            root = tmp
+            make_tree(root, 4, 12, args.files)
+        listers = [("os.walk", walk_sorted)] + [(f"scan {t}", lambda r, t=t: scan(r, t)) for t in (1, 4, 16)]
+        for (name, lister) in listers:
+            best = None
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                n = sum(1 for _ in lister(root))
+                t = time.perf_counter() - t0
+                best = t if best is None else min(best, t)
+            print(f"{name:>8}: {n} files in {best:.3f}s, {n/best:,.0f} files/s")
+
+if __name__=="__main__":
+    main()
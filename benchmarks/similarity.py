@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Accuracy and speed of SimilarityEngine settings, compared with img_sim()
+(scikit-image SSIM at full resolution, which DissimilarFrameStream used to use).
+
+Consecutive frames are compared, as DissimilarFrameStream does. By default the frames
+are a synthetic camera sequence: a fixed scene with sensor noise, JPEG artifacts, a
+person-sized box that comes and goes, and lighting changes. Give a directory to use
+real frames instead.
+
+For each setting it prints the time per comparison, the error of the score, and how
+often the keep/skip decision at the threshold agrees with img_sim().
+"""
+
+import os
+import sys
+import time
+import argparse
+from os.path import dirname, abspath, join
+
+import cv2
+import numpy as np
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from bamboo.image_utils import img_sim,SimilarityEngine,BOX,SKIMAGE
+from bamboo.source import DEFAULT_SCORE
+
+SETTINGS = [(None, BOX), (640, BOX), (320, BOX), (320, SKIMAGE), (160, BOX)]
+
+def synthetic_frames(n, w=1920, h=1080, seed=0):
+    rng = np.random.default_rng(seed)
+    scene = cv2.GaussianBlur(rng.integers(0, 255, (h//8, w//8, 3), dtype=np.uint8), (3,3), 0)
+    scene = cv2.resize(scene, (w, h), interpolation=cv2.INTER_CUBIC).astype(np.float32)
+    gain = 1.0
+    for i in range(n):
+        if rng.random() < 0.05:
+            gain = rng.uniform(0.7, 1.2)            # lighting change
+        img = scene * gain + rng.normal(0, 3, scene.shape)
+        if i % 20 >= 15:                            # someone walks through
+            x = int(w * (i % 20 - 15) / 5)
+            cv2.rectangle(img, (x, h//3), (x + w//10, h - h//10), (40, 60, 200), thickness=-1)
+        img = np.clip(img, 0, 255).astype(np.uint8)
+        yield cv2.imdecode(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 85])[1], cv2.IMREAD_COLOR)
+
+def directory_frames(root, n):
+    paths = sorted(join(dirpath, name) for (dirpath, _, names) in os.walk(root)
+                   for name in names if name.lower().endswith(('.jpg', '.jpeg')))
+    for path in paths[:n]:
+        yield cv2.imread(path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", nargs="?", help="directory of frames from one camera")
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_SCORE)
+    args = parser.parse_args()
+
+    frames = list(directory_frames(args.root, args.frames) if args.root else synthetic_frames(args.frames))
+    pairs = list(zip(frames, frames[1:]))
+
+    t0 = time.perf_counter()
+    reference = [img_sim(a, b) for (a, b) in pairs]
+    t_ref = (time.perf_counter() - t0) / len(pairs)
+    print(f"{len(pairs)} pairs of {frames[0].shape[1]}x{frames[0].shape[0]} frames; threshold {args.threshold}")
+    print(f"{'setting':>14} {'ms/pair':>8} {'speedup':>8} {'mean err':>9} {'max err':>8} {'agree':>6}")
+    print(f"{'img_sim':>14} {t_ref*1000:8.1f} {1:8.1f} {0:9.4f} {0:8.4f} {100:5.0f}%")
+
+    for (max_side, method) in SETTINGS:
+        engine = SimilarityEngine(max_side=max_side, method=method)
+        t0 = time.perf_counter()
+        # The reference frame is prepared once and reused, as DissimilarFrameStream does
+        prepared = [engine.prepare(f) for f in frames]
+        scores = [engine.compare(a, b) for (a, b) in zip(prepared, prepared[1:])]
+        t = (time.perf_counter() - t0) / len(pairs)
+        err = np.abs(np.array(scores) - np.array(reference))
+        agree = np.mean([(s < args.threshold) == (r < args.threshold) for (s, r) in zip(scores, reference)])
+        print(f"{str(max_side)+' '+method:>14} {t*1000:8.1f} {t_ref/t:8.1f} {err.mean():9.4f} {err.max():8.4f} "
+              f"{agree*100:5.0f}%")
+
+if __name__=="__main__":
+    main()
@@ -23,6 +23,11 @@ from lib.ctools.timer import Timer
 from bamboo.frame import Tag,TAG_SKIPPED
 from bamboo.constants import C
 from bamboo.source import FrameStream
+from bamboo.image_utils import SimilarityCascade
+from bamboo.roi import ROI
+from bamboo.manifest import Manifest
+
+STAGE_INGEST = 'ingest'
 
 # We use the cache to avoid making the same directory twice
 @functools.lru_cache(maxsize=128)
@@ -95,6 +100,9 @@ class IngestCamera():
         self.show   = show
         self.sim_threshold = self.config['threshold']
         self.total_kept = 0
+        # With a manifest, only images that have not been ingested before are read
+        manifest = config['archive'].get('manifest')
+        self.manifest = Manifest(manifest) if manifest else None
 
     def notice(self, msg, endl=False):
         """Display a message"""
@@ -134,13 +142,22 @@ class IngestCamera():
         This could be replaced with a priority queue or a double-ended queue.
         """
         ary = FrameArray()
-        for f in FrameStream(self.config['source']):
+        if self.manifest:
+            self.manifest.update(self.config['source'], camera=self.camera)
+            frames = self.manifest.frames(camera=self.camera, unprocessed_by=STAGE_INGEST)
+        else:
+            frames = FrameStream(self.config['source'])
+        for f in frames:
             ary.add(f)
+        if not ary:
+            print(f"{self.camera}: no new images")
+            return
 
         # Get the first and retain
         ref = ary.first()
         self.ingest_save_image(ref)
         skipped = 0
+        cascade = SimilarityCascade(self.sim_threshold, roi=ROI.from_config(self.config.get('roi')))
 
         # This could be a pipeline or parallelized? Would be nice to know fps
         with Timer(f"Ingesting {len(ary)} images") as t:
@@ -149,7 +166,7 @@ class IngestCamera():
             for i in ary:
                 self.notice(i.path)
                 try:
-                    score = i.similarity(ref)
+                    score = cascade.similarity(i, ref)
                 except cv2.error as e: # pylint: disable=catching-non-exception
                     print(f"Error {e} with {i.path}")
                     continue
@@ -160,7 +177,10 @@ class IngestCamera():
                     self.ingest_save_image(i)
                     ref = i
             print("fps: ",len(ary) / t.elapsed(),end=' ')
+            print("comparisons:",dict(cascade.counts))
 
+        if self.manifest:
+            self.manifest.mark_processed(ary, STAGE_INGEST)
         print(f"Total kept: {self.total_kept} / {len(ary)} = {self.total_kept * 100//len(ary)}%")
 
 